@@ -2,7 +2,7 @@
 
 # File: start_client.py ; This file is part of Twister.
 
-# version: 3.018
+# version: 3.019
 
 # Copyright (C) 2012-2013 , Luxoft
 
@@ -491,6 +491,189 @@ class TwisterClient(object):
 # # #
 
 
+class FileTagsIndex(object):
+    """
+    Persistent index of the tags from the test case files.\n
+    A file is parsed again only if the modification time or the size changed.
+    The searches use an inverted index: tag -> value -> files
+    and short file name -> files, so the files are never scanned one by one.
+    """
+
+    tags_re = re.compile('^[ ]*?[#]*?[ ]*?<(?P<tag>\\w+)>([ -~\n]+?)</(?P=tag)>', re.MULTILINE)
+
+    def __init__(self, path):
+        self.path = path   # The JSON file
+        self.stamp = None  # Stamp of the JSON file, when loaded
+        self.files = {}    # File name -> [mtime, size, tags]
+        self.tags = {}     # Tag -> value -> set of file names
+        self.names = {}    # Short file name -> set of file names
+        self.tagged = set() # All the files that have tags
+        self.idx_lock = thread.allocate_lock()
+
+
+    def _add(self, fname, tags):
+        """ Add the tags of one file in the inverted index """
+        if not tags:
+            return
+        self.tagged.add(fname)
+        self.names.setdefault(fname[fname.rfind('/')+1:], set()).add(fname)
+        for tag, value in tags.iteritems():
+            self.tags.setdefault(tag, {}).setdefault(value, set()).add(fname)
+
+
+    def _remove(self, fname):
+        """ Remove the tags of one file from the inverted index """
+        if fname not in self.tagged:
+            return
+        self.tagged.discard(fname)
+        short = fname[fname.rfind('/')+1:]
+        self.names.get(short, set()).discard(fname)
+        if not self.names.get(short):
+            self.names.pop(short, None)
+        for tag, value in self.files[fname][2].iteritems():
+            values = self.tags.get(tag, {})
+            values.get(value, set()).discard(fname)
+            if not values.get(value):
+                values.pop(value, None)
+            if not values:
+                self.tags.pop(tag, None)
+
+
+    def load(self):
+        """
+        Load the index from the JSON file, if the file changed.
+        The old format (file name -> tags) is accepted, all the files will be parsed again.
+        """
+        try:
+            fstat = os.stat(self.path)
+        except Exception:
+            return False
+        stamp = (fstat.st_mtime, fstat.st_size)
+        if stamp == self.stamp:
+            return True
+
+        with open(self.path) as data_file:
+            data = json.load(data_file)
+        if 'files' in data and data.get('version') == 2:
+            files = data['files']
+        else:
+            files = dict((fname, [0, -1, tags]) for fname, tags in data.iteritems())
+
+        self.files = {}
+        self.tags = {}
+        self.names = {}
+        self.tagged = set()
+        for fname, entry in files.iteritems():
+            self.files[fname] = entry
+            self._add(fname, entry[2])
+
+        self.stamp = stamp
+        return True
+
+
+    def save(self):
+        """
+        Write the index in the JSON file; the file is never half written.
+        """
+        tmp_path = '{}.{}.tmp'.format(self.path, os.getpid())
+        with open(tmp_path, 'w') as f:
+            json.dump({'version': 2, 'files': self.files}, f)
+        os.rename(tmp_path, self.path)
+        fstat = os.stat(self.path)
+        self.stamp = (fstat.st_mtime, fstat.st_size)
+
+
+    def update(self, root):
+        """
+        Walk the test cases folder and parse only the new, or changed files.
+        Returns the number of parsed files, or an error string.
+        """
+        with self.idx_lock:
+            try:
+                self.load()
+            except Exception as e:
+                logPrint('Cannot load the file tags `{}`: `{}`! Will parse all the files.'.format(self.path, e))
+
+            found = set()
+            parsed = 0
+
+            for path, _, files in os.walk(root):
+                for name in files:
+                    fname = os.path.join(path, name)
+                    found.add(fname)
+                    try:
+                        fstat = os.stat(fname)
+                    except Exception:
+                        return '*ERROR* Cannot find file name `%s` !' % (fname)
+                    old = self.files.get(fname)
+                    if old and old[0] == fstat.st_mtime and old[1] == fstat.st_size:
+                        continue
+                    try:
+                        text = open(fname, 'rb').read()
+                    except Exception:
+                        return '*ERROR* Cannot find file name `%s` !' % (fname)
+                    tags = dict((title, descr) for title, descr in self.tags_re.findall(text))
+                    if old:
+                        self._remove(fname)
+                    self.files[fname] = [fstat.st_mtime, fstat.st_size, tags]
+                    self._add(fname, tags)
+                    parsed += 1
+
+            # The deleted files
+            for fname in set(self.files) - found:
+                self._remove(fname)
+                del self.files[fname]
+
+            self.save()
+            return parsed
+
+
+    def search(self, fname, args):
+        """
+        Returns the sorted list of files that match the file name pattern
+        and contain all the tags. A tag matches if the query is part of the value.
+        """
+        with self.idx_lock:
+            self.load()
+            result = None
+
+            if fname:
+                result = set()
+                bare = fname.replace('*', '')
+                for short, fnames in self.names.iteritems():
+                    if (fname.endswith('*') and short.startswith(fname[:-1])) or bare in short:
+                        result.update(fnames)
+                    elif fname.startswith('*'):
+                        result.update(f for f in fnames if f.endswith(fname[1:]))
+                if not args:
+                    return sorted(result)
+
+            for tag, values in args.items():
+                query = values[0]
+                matched = set()
+                for value, fnames in self.tags.get(tag, {}).iteritems():
+                    if query in value:
+                        matched.update(fnames)
+                # The files without this tag are compared with "None"
+                if query in 'None':
+                    with_tag = set()
+                    for fnames in self.tags.get(tag, {}).itervalues():
+                        with_tag.update(fnames)
+                    matched.update(self.tagged - with_tag)
+                if result is None:
+                    result = matched
+                else:
+                    result &= matched
+
+            return sorted(result or [])
+
+
+FILE_INDEX = FileTagsIndex('{}/config/file_tags.json'.format(TWISTER_PATH))
+
+
+# # #
+
+
 class TwisterClientService(rpyc.Service):
     """ start e service client """
     connections = {}
@@ -692,7 +875,6 @@ class TwisterClientService(rpyc.Service):
         Store in a json file the tags from each test case file
         """
         ti = time.time()
-        globalDict = {}
 
         with open('{}/config/fwmconfig.xml'.format(TWISTER_PATH)) as data_file:
             try:
@@ -700,22 +882,12 @@ class TwisterClientService(rpyc.Service):
             except Exception:
                 return '*ERROR* Cannot find the test cases source path !'
 
-        for path, _, files in os.walk(testCasesPath):
-            for name in files:
-                fname = os.path.join(path, name)
-                try:
-                    text = open(fname, 'rb').read()
-                except Exception:
-                    return '*ERROR* Cannot find file name `%s` !' % (fname)
-                tags = re.findall('^[ ]*?[#]*?[ ]*?<(?P<tag>\\w+)>([ -~\n]+?)</(?P=tag)>', text, re.MULTILINE)
-                tagsDict = {title:descr for title, descr in tags}
-                if tagsDict:
-                    globalDict[fname] = tagsDict
-
-        with open('{}/config/file_tags.json'.format(TWISTER_PATH), 'w') as file_tags:
-            json.dump(globalDict, file_tags, indent=2)
+        parsed = FILE_INDEX.update(testCasesPath)
+        if isinstance(parsed, str):
+            return parsed
 
-        logPrint('Took `{:.4f}` seconds to generate index for {}.'.format(time.time()-ti, len(globalDict)))
+        logPrint('Took `{:.4f}` seconds to generate index for {}, parsed {} files.'.format(time.time()-ti,
+            len(FILE_INDEX.tagged), parsed))
         return True
 
 
@@ -744,30 +916,15 @@ class TwisterClientService(rpyc.Service):
             msg = 'Cannot search having the arguments {} !'.format(query)
             return msg
 
-        len_args = len(args)
-        result = []
-
-        with open('{}/config/file_tags.json'.format(TWISTER_PATH)) as data_file:
-            data = json.load(data_file)
-
-        for key, value in data.items():
-            match = []
-            short_fname = key[key.rfind('/')+1:]
-            if fname:
-                if fname.startswith('*') and key.endswith(fname[1:]) or \
-                    fname.endswith('*') and short_fname.startswith(fname[:-1]) \
-                    or fname.replace('*', '') in short_fname:
-                    if not len_args:
-                        result.append(key)
-                    match = [key for k, v in args.items() if v[0] in value.get(k, "None")]
-            else:
-                match = [key for k, v in args.items() if v[0] in value.get(k, "None")]
-            if len_args and len(match) == len_args:
-                result.append(key)
+        try:
+            result = FILE_INDEX.search(fname, args)
+        except Exception as e:
+            return '*ERROR* Cannot search the file tags: `{}`!'.format(e)
 
         logPrint('Took `{:.4f}` seconds for {} elements and found {} entries' \
-            ' that match.'.format(time.time()-ti, len(data), len(result)))
-        return result
+            ' that match.'.format(time.time()-ti, len(FILE_INDEX.tagged), len(result)))
+        # A tuple is sent by value
+        return tuple(result)
 
 
 # # #
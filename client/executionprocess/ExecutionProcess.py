@@ -1,6 +1,6 @@
 #!/usr/bin/env python2.7
 
-# version: 3.030
+# version: 3.031
 
 # File: ExecutionProcess.py ; This file is part of Twister.
 
@@ -39,10 +39,12 @@ import os
 import sys
 import time
 import copy
+import json
 import socket
 import signal
 import shutil
 import binascii
+import zlib
 import platform
 import inspect
 import traceback
@@ -51,7 +53,7 @@ import argparse
 
 from pprint import pprint
 from string import Template
-from threading import Thread
+from threading import Thread, Condition
 from thread import allocate_lock
 
 import rpyc
@@ -126,6 +128,77 @@ REVERSED_STATUS = dict((v, k) for k, v in TEST_STATUS.iteritems())
 
 # ------------------------------------------------------------------------------
 
+EVENT_POLL = 2.0    # Ask the Central Engine this often, if it cannot push the events
+EVENT_CHECK = 30.0  # Ask the Central Engine this often anyway, in case an event was lost
+
+
+class EpEvents(object):
+    """
+    Events pushed by the Central Engine: the EP status changed, or a watched file changed.
+    The Runner blocks on these events and asks for the new status only when something changed.
+    """
+
+    def __init__(self):
+        self.cond = Condition()
+        self.version = 0       # Incremented for each event
+        self.epname = None     # The subscribed EP, or None
+        self.watch = set()     # The watched file IDs
+        self.ep_status = None  # The last EP status
+
+
+    def subscribe(self, ce, epname, file_ids=()):
+        """
+        Subscribe for events, or add more file IDs to watch.
+        Returns False if the Central Engine cannot push events.
+        """
+        with self.cond:
+            version = self.version
+            watch = self.watch | set(file_ids)
+        try:
+            status = ce.subscribe_events(epname, tuple(watch))
+        except Exception:
+            status = False
+        if not status:
+            return False
+        with self.cond:
+            self.epname = epname
+            self.watch = watch
+            # A newer status might have been pushed already
+            if self.version == version:
+                self.ep_status = status
+        return True
+
+
+    def push(self, ep_status=None):
+        """
+        Called when the Central Engine pushes an event.
+        """
+        with self.cond:
+            self.version += 1
+            if ep_status:
+                self.ep_status = ep_status
+            self.cond.notify_all()
+
+
+    def wait(self, version):
+        """
+        Block until there is an event newer than `version`,
+        or until it's time to ask the Central Engine anyway.
+        Returns the current version.
+        """
+        deadline = time.time() + (EVENT_CHECK if self.epname else EVENT_POLL)
+        with self.cond:
+            while self.version == version:
+                left = deadline - time.time()
+                if left <= 0:
+                    break
+                self.cond.wait(left)
+            return self.version
+
+
+EP_EVENTS = EpEvents()
+
+
 class EpService(rpyc.Service):
     """
     Dummy service.
@@ -163,6 +236,20 @@ class EpService(rpyc.Service):
         DEBUG = False
         return None
 
+    def exposed_ep_status_changed(self, status):
+        """
+        The Central Engine pushed a new status for this EP.
+        """
+        EP_EVENTS.push(status)
+        return True
+
+    def exposed_file_status_changed(self, epname, file_id, status):
+        """
+        The Central Engine pushed a new status for a watched file.
+        """
+        EP_EVENTS.push()
+        return True
+
 
 def proxy():
     """
@@ -232,12 +319,48 @@ def proxy():
                 # Register this EP to the Central Engine
                 p.root.hello('client', {'eps': [EP_NAME]})
                 print('EP Debug: Register EP successful!\n')
-                return CE_PROXY.root
             except Exception:
                 print('*ERROR* Cannot register this EP! Exiting!')
                 return None
-        else:
-            return CE_PROXY.root
+
+        # The events must be pushed on the new connection
+        if EP_EVENTS.epname:
+            EP_EVENTS.subscribe(CE_PROXY.root, EP_EVENTS.epname)
+
+        return CE_PROXY.root
+
+#
+
+LIVE_LOG_MIN = 64 * 1024        # Send the live log when the buffer is this large
+LIVE_LOG_MAX = 16 * 1000 * 1000 # Must send the live log, even if the CE is busy
+LIVE_LOG_INTERVAL = 1.5         # Send the live log at least this often
+
+FILE_CHUNK = 1024 * 1024        # Download the test files in chunks of this size
+FILE_RETRIES = 3                # Resume a broken file download this many times
+
+# Libraries that need other libraries; these are always downloaded together.
+# (the libraries still import without them, for older EPs that don't know this)
+LIB_DEPENDS = {
+    'TscSshLib.py': ['TscExpectLib.py'],
+    'TscTelnetLib.py': ['TscExpectLib.py'],
+}
+
+
+def send_live_log(text):
+    """
+    Send a chunk of CLI log to the Central Engine, as a compressed binary frame.
+    Returns the number of seconds the CE asks the EP to wait, before the next frame.
+    """
+    try:
+        delay = proxy().log_live_stream(EP_NAME, zlib.compress(text), True)
+    except AttributeError:
+        # Old Central Engine, without the log stream
+        proxy().log_live(EP_NAME, binascii.b2a_base64(text))
+        return 0.0
+    try:
+        return float(delay)
+    except Exception:
+        return 0.0
 
 #
 
@@ -247,6 +370,7 @@ class Logger(object):
         self.closed = False
         self.buffer = ''  # The text buffer
         self.timer = 0    # Last time the log was sent to CE
+        self.wait = 0.0   # The CE is busy, must wait before sending again
         sys.__stdout__.write('EP Debug: Creating a portable logger...')
         sys.__stdout__.flush()
         sys.stdout = self
@@ -276,13 +400,17 @@ class Logger(object):
         ctimer = time.time()
         self.buffer += text
 
-        if ((ctimer - self.timer) > 1.5) and len(self.buffer):
-            proxy().log_live(EP_NAME, binascii.b2a_base64(self.buffer))
+        if not self.buffer:
+            return
+        elapsed = ctimer - self.timer
+
+        # The frames are batched; if the CE is busy, the buffer grows until the CE is ready
+        if (elapsed > max(LIVE_LOG_INTERVAL, self.wait)) or \
+            (len(self.buffer) > LIVE_LOG_MIN and elapsed > self.wait) or \
+            len(self.buffer) > LIVE_LOG_MAX:
+            self.wait = send_live_log(self.buffer)
             self.timer = ctimer
             self.buffer = ''
-        elif len(self.buffer) > 256:
-            proxy().log_live(EP_NAME, binascii.b2a_base64(self.buffer))
-            self.buffer = ''
 
     def close(self, *args, **kw):
         """
@@ -292,7 +420,7 @@ class Logger(object):
         sys.stdout = sys.__stdout__
         # Send last chunk
         if self.buffer:
-            proxy().log_live(EP_NAME, binascii.b2a_base64(self.buffer))
+            send_live_log(self.buffer)
             self.buffer = ''
         self.closed = True
 
@@ -309,6 +437,7 @@ class ThreadedLogger(Thread):
         self.buffer = ''   # The text buffer
         self.read_len = 0  # Read file position
         self.timer  = 0    # Last time the log was sent to CE
+        self.wait   = 0.0  # The CE is busy, must wait before sending again
         self.closed = False
         self.acc_lock = allocate_lock()
         print('EP Debug: Creating a threaded logger...')
@@ -358,13 +487,17 @@ class ThreadedLogger(Thread):
         ctimer = time.time()
         self.buffer += text
 
-        if ((ctimer - self.timer) > 1.5) and len(self.buffer):
-            proxy().log_live(EP_NAME, binascii.b2a_base64(self.buffer))
+        if not self.buffer:
+            return
+        elapsed = ctimer - self.timer
+
+        # The frames are batched; if the CE is busy, the buffer grows until the CE is ready
+        if force or (elapsed > max(LIVE_LOG_INTERVAL, self.wait)) or \
+            (len(self.buffer) > LIVE_LOG_MIN and elapsed > self.wait) or \
+            len(self.buffer) > LIVE_LOG_MAX:
+            self.wait = send_live_log(self.buffer)
             self.timer = ctimer
             self.buffer = ''
-        elif len(self.buffer) > 256 or force:
-            proxy().log_live(EP_NAME, binascii.b2a_base64(self.buffer))
-            self.buffer = ''
 
     def write(self, text):
         # The write is from nohup, not here
@@ -546,6 +679,132 @@ class TwisterRunner(object):
         return True
 
 
+    def downloadChunks(self, name, get_chunk):
+        """
+        Downloads a file or a library from Central Engine, in compressed chunks;
+        `get_chunk(offset)` returns a tuple (compressed data, total size).
+        If the connection breaks, the download resumes from the last chunk.
+        Returns the data, or the response from Central Engine (False, or error).
+        """
+        chunks = []
+        offset = 0
+        retries = FILE_RETRIES
+
+        while True:
+            try:
+                resp = get_chunk(offset)
+                # False, or error message
+                if not isinstance(resp, tuple):
+                    return resp
+                data, total = resp
+                data = zlib.decompress(data)
+            except AttributeError:
+                # Old Central Engine, without this method; the caller decides
+                raise
+            except Exception as e:
+                retries -= 1
+                if retries < 0:
+                    return '*ERROR* Cannot download `{}`: `{}`!'.format(name, e)
+                print('EP Debug: Download of `{}` interrupted at byte {}, resuming...'.format(name, offset))
+                time.sleep(0.5)
+                continue
+
+            if not data:
+                break
+            chunks.append(data)
+            offset += len(data)
+            if offset >= total:
+                break
+
+        return ''.join(chunks)
+
+
+    def downloadFile(self, file_id):
+        """
+        Downloads a test file from Central Engine, in compressed chunks.
+        Returns the file data, or the response from Central Engine (False, or error).
+        """
+        try:
+            return self.downloadChunks(file_id, lambda offset: \
+                proxy().download_file_chunk(self.epName, file_id, offset, FILE_CHUNK, True))
+        except AttributeError:
+            # Old Central Engine, without chunks
+            return proxy().download_file(self.epName, file_id)
+
+
+    def downloadLibraries(self, libs):
+        """
+        Downloads a list of libraries from Central Engine.
+        The libraries are kept in a local cache, named by their hash; the hashes are sent
+        to the Central Engine, so only the libraries that changed are downloaded again.
+        Returns a dictionary of library name -> data.
+        """
+        cache_path = '{}/ce_libs_cache'.format(EP_CACHE)
+        index_path = cache_path + '/index.json'
+        try: os.makedirs(cache_path)
+        except Exception: pass
+
+        try:
+            with open(index_path, 'r') as f:
+                index = json.load(f)
+        except Exception:
+            index = {}
+
+        result = {}
+        known = [(lib, index.get(lib, '')) for lib in libs]
+
+        while known:
+            try:
+                resp = proxy().download_libraries(tuple(known), FILE_CHUNK)
+            except AttributeError:
+                # Old Central Engine, download one by one
+                resp = [(lib, '', proxy().download_library(lib)) for lib, _ in known]
+            known = []
+
+            for lib, lib_hash, lib_data in resp:
+                # Big library, download it in chunks
+                if lib_data is None:
+                    lib_data = self.downloadChunks(lib, lambda offset: \
+                        proxy().download_library_chunk(lib, lib_hash, offset, FILE_CHUNK, True))
+                # The library didn't change, read it from the cache
+                if not lib_data and lib_hash and lib_hash == index.get(lib):
+                    try:
+                        with open(cache_path + os.sep + lib_hash, 'rb') as f:
+                            result[lib] = f.read()
+                    except Exception:
+                        # The cache is broken, must download again
+                        del index[lib]
+                        known.append((lib, ''))
+                    continue
+
+                result[lib] = lib_data
+                if not lib_data or not lib_hash or lib_data.startswith('*ERROR*'):
+                    index.pop(lib, None)
+                    continue
+
+                try:
+                    with open(cache_path + os.sep + lib_hash, 'wb') as f:
+                        f.write(lib_data)
+                    index[lib] = lib_hash
+                except Exception as e:
+                    print('Cannot cache library `{}`: `{}`!'.format(lib, e))
+                    index.pop(lib, None)
+
+        # Remove the old versions of the libraries
+        for fname in os.listdir(cache_path):
+            if fname != 'index.json' and fname not in index.values():
+                try: os.remove(cache_path + os.sep + fname)
+                except Exception: pass
+
+        try:
+            with open(index_path, 'w') as f:
+                json.dump(index, f)
+        except Exception as e:
+            print('Cannot save the libraries cache: `{}`!'.format(e))
+
+        return result
+
+
     def saveLibraries(self, libs_list=''):
         """
         Downloads all libraries from Central Engine.
@@ -569,6 +828,15 @@ class TwisterRunner(object):
             libs_list = [lib.strip() for lib in libs_list.split(';') if lib.strip() not in self.libs_list]
             self.libs_list.extend(libs_list)
 
+        # Some libraries need other libraries
+        for lib in list(libs_list):
+            for dep in LIB_DEPENDS.get(lib, []):
+                if dep in libs_list or (dep in self.libs_list and not reset_libs):
+                    continue
+                libs_list.append(dep)
+                if dep not in self.libs_list:
+                    self.libs_list.append(dep)
+
         if reset_libs:
             # Remove libs path only if saving libraries for all project
             shutil.rmtree(libs_path, ignore_errors=True)
@@ -596,9 +864,11 @@ class TwisterRunner(object):
             else:
                 all_libs.append(lib)
 
+        # Only the libraries that changed are downloaded, the rest are in the local cache
+        libs_data = self.downloadLibraries(zip_libs + all_libs)
+
         for lib_file in zip_libs:
-            lib_data = proxy().download_library(lib_file)
-            time.sleep(0.1) # Must take it slow
+            lib_data = libs_data.get(lib_file)
             if not lib_data:
                 print('ZIP library `{}` does not exist!'.format(lib_file))
                 continue
@@ -618,8 +888,7 @@ class TwisterRunner(object):
                 continue
 
         for lib_file in all_libs:
-            lib_data = proxy().download_library(lib_file)
-            time.sleep(0.1) # Must take it slow
+            lib_data = libs_data.get(lib_file)
             if not lib_data or lib_data.startswith('*ERROR*'):
                 print('Library `{}` does not exist!'.format(lib_file))
                 continue
@@ -698,24 +967,36 @@ class TwisterRunner(object):
     def start_logs(self, file_id, filename):
         """
         Write start log messages for current test.
+        This also sets the last seen alive flag, in the same call,
+        and returns the EP status, or False on error.
         """
         msg = '<<< START filename: `{}:{}` >>>\n'.format(file_id, filename)
         print(msg)
-        proxy().log_message('logRunning', msg + '\n')
-        proxy().log_message('logDebug', msg + '\n')
-        proxy().log_message('logTest', msg + '\n')
-        return True
+        try:
+            _, ep_status = proxy().report_file_result(self.epName, file_id, None, 0.0, (), msg + '\n')
+            return ep_status
+        except Exception:
+            trace = traceback.format_exc()[34:].strip()
+            print('Exception on sending start logs `{}`!'.format(trace))
+            return False
 
 
-    def end_logs(self, file_id, filename):
+    def end_logs(self, file_id, filename, new_status=None, time_elapsed=0.0, reason=None, variables=None):
         """
         Write end log messages for current test.
+        The file status, the reason and other file variables are sent in the same call.
         """
         msg = '<<< END filename: `{}:{}` >>>\n'.format(file_id, filename)
         print(msg)
-        proxy().log_message('logRunning', msg + '\n')
-        proxy().log_message('logDebug', msg + '\n')
-        proxy().log_message('logTest', msg + '\n')
+        variables = dict(variables or {})
+        if reason is not None:
+            variables['_reason'] = reason
+        try:
+            proxy().report_file_result(self.epName, file_id, new_status, time_elapsed,
+                tuple(variables.items()), msg + '\n')
+        except Exception:
+            trace = traceback.format_exc()[34:].strip()
+            print('Exception on sending the test result `{}`!'.format(trace))
         return True
 
 
@@ -728,13 +1009,17 @@ class TwisterRunner(object):
         last_time = glob_time
         time_diff = 30
 
+        # The Central Engine pushes the status changes, if it can
+        EP_EVENTS.subscribe(proxy(), self.epName)
+        version = EP_EVENTS.version
+
         if proxy().get_ep_status(self.epName) == 'running':
             print('EP Info: Start running the tests!')
         # Portable ?
         elif PORTABLE:
             print('EP Info: Waiting for the EP to start...\n')
             while True:
-                time.sleep(2)
+                version = EP_EVENTS.wait(version)
                 glob_time = time.time()
                 if  glob_time > last_time + time_diff:
                     last_time = glob_time
@@ -846,11 +1131,9 @@ class TwisterRunner(object):
             # Re-create the ce_libs file
             self.makeCeLibs(suite_id, suite_name, file_id, os.path.split(filename)[1])
 
-            # Write START TEST in all logs
-            self.start_logs(file_id, filename)
-
-            # Set Last seen alive flag on this EP
-            proxy().set_ep_variable(self.epName, 'last_seen_alive', time.strftime('%Y-%m-%d %H:%M:%S'))
+            # Write START TEST in all logs and set Last seen alive flag on this EP
+            version = EP_EVENTS.version
+            ep_status = self.start_logs(file_id, filename)
 
 
             # If a setup file failed, abort the current suite and all sub-suites,
@@ -865,13 +1148,7 @@ class TwisterRunner(object):
                         print('Running a tear-down file...\n')
                     else:
                         print('Not executed file `{}` because of failed setup file!\n\n'.format(filename))
-                        proxy().set_file_status(self.epName, file_id, STATUS_NOT_EXEC, 0.0) # File status NOT EXEC
-                        try:
-                            proxy().set_file_variable(self.epName, file_id, '_reason', 'Not executed, because of failed setup file!')
-                        except Exception:
-                            trace = traceback.format_exc()[34:].strip()
-                            print('Exception on sending reason `{}`!'.format(trace))
-                        self.end_logs(file_id, filename)
+                        self.end_logs(file_id, filename, STATUS_NOT_EXEC, 0.0, 'Not executed, because of failed setup file!')
                         continue
                 del aborted_ids, current_ids
 
@@ -879,29 +1156,24 @@ class TwisterRunner(object):
             if abort_iter == filename and iteration_nr and iteration_sof:
                 print('Not executed file `{}` because of iteration stop on fail!\n'.format(filename))
                 print('Iteration `{}` will not run!!\n\n'.format(iteration_nr))
-                proxy().set_file_status(self.epName, file_id, STATUS_NOT_EXEC, 0.0) # File status NOT EXEC
-                try:
-                    proxy().set_file_variable(self.epName, file_id, '_reason', 'Not executed, because of failed iteration file!')
-                except Exception:
-                    trace = traceback.format_exc()[34:].strip()
-                    print('Exception on sending reason `{}`!'.format(trace))
-                self.end_logs(file_id, filename)
+                self.end_logs(file_id, filename, STATUS_NOT_EXEC, 0.0, 'Not executed, because of failed iteration file!')
                 continue
             else:
                 abort_iter = False
 
 
+            # The EP status was received with the START logs
             try:
-                STATUS = proxy().get_ep_status(self.epName)
+                STATUS = ep_status or proxy().get_ep_status(self.epName)
             except Exception:
                 print('Cannot connect to the Central Engine! Exiting!\n')
                 return False
 
             # When a test file is about to be executed and STOP is received, send status ABORTED
             if STATUS == 'stopped':
-                proxy().set_file_status(self.epName, file_id, STATUS_ABORTED, 0.0) # File status ABORTED
                 try:
-                    proxy().set_file_variable(self.epName, file_id, '_reason', 'Manual stop! Time to exit!')
+                    proxy().report_file_result(self.epName, file_id, STATUS_ABORTED, 0.0,
+                        (('_reason', 'Manual stop! Time to exit!'),))
                 except Exception:
                     trace = traceback.format_exc()[34:].strip()
                     print('Exception on sending reason `{}`!'.format(trace))
@@ -920,8 +1192,8 @@ class TwisterRunner(object):
                         print('~ PAUSE: Waiting for RESUME signal... ~\n')
                         vPauseMsg = True
 
-                    # Wait ...
-                    time.sleep(2)
+                    # Wait for an event ...
+                    version = EP_EVENTS.wait(version)
 
                     try:
                         STATUS = proxy().get_ep_status(self.epName)
@@ -936,9 +1208,9 @@ class TwisterRunner(object):
                     # On stop...
                     elif STATUS == 'stopped':
                         # When a test is waiting for resume, but receives STOP, send status NOT EXECUTED
-                        proxy().set_file_status(self.epName, file_id, STATUS_NOT_EXEC, 0.0)
                         try:
-                            proxy().set_file_variable(self.epName, file_id, '_reason', 'Manual stop, while waiting for resume!')
+                            proxy().report_file_result(self.epName, file_id, STATUS_NOT_EXEC, 0.0,
+                                (('_reason', 'Manual stop, while waiting for resume!'),))
                         except Exception:
                             trace = traceback.format_exc()[34:].strip()
                             print('Exception on sending reason `{}`!'.format(trace))
@@ -975,14 +1247,17 @@ class TwisterRunner(object):
                     # Wait for dependency to run
                     if  dep_curr_status in ['invalid', 'pending', 'working']:
                         print('\nWaiting for file `{}::{}` to finish execution...\n'.format(dep_info['id'], dep_info['file']))
+                        # The Central Engine pushes the status changes of this file, if it can
+                        EP_EVENTS.subscribe(proxy(), self.epName, [dep_info['id']])
+                        version = EP_EVENTS.version
                         while 1:
-                            time.sleep(2)
                             dep_info['status'] = proxy().get_file_variable(dep_info['ep'], dep_info['id'], 'status')
                             dep_curr_status = REVERSED_STATUS.get(dep_info.get('status', -1), 'invalid')
                             # Reload info about dependency file
                             if  dep_curr_status not in ['invalid', 'pending', 'working']:
                                 print('Dependency `{}::{}` ended with `{}`.\n'.format(dep_info['id'], dep_info['file'], dep_curr_status))
                                 break
+                            version = EP_EVENTS.wait(version)
                     else:
                         print('Dependency `{}::{}` ended with `{}`.\n'.format(dep_info['id'], dep_info['file'], dep_curr_status))
 
@@ -996,23 +1271,13 @@ class TwisterRunner(object):
                         print('Dependency matched with success: `{}`.\n'.format(dep_status))
 
                 if not dep_ok:
-                    try:
-                        # Send status SKIP
-                        proxy().set_file_status(self.epName, file_id, STATUS_SKIPPED, 0.0)
-                    except Exception:
-                        trace = traceback.format_exc()[34:].strip()
-                        print('Exception on dependency change file status `{}`!\n'.format(trace))
-                    try:
-                        proxy().set_file_variable(self.epName, file_id, '_reason', 'Skip, dependency not ok!')
-                    except Exception:
-                        trace = traceback.format_exc()[34:].strip()
-                        print('Exception on sending reason `{}`!'.format(trace))
-                    self.end_logs(file_id, filename)
+                    # Send status SKIP
+                    self.end_logs(file_id, filename, STATUS_SKIPPED, 0.0, 'Skip, dependency not ok!')
                     continue
 
 
             # Download file from Central Engine!
-            str_to_execute = proxy().download_file(self.epName, file_id)
+            str_to_execute = self.downloadFile(file_id)
 
             # If CE sent False, it means the file is empty, does not exist, or it's not runnable.
             if str_to_execute == '' or str_to_execute.startswith('*ERROR*'):
@@ -1020,33 +1285,13 @@ class TwisterRunner(object):
                 if setup_file:
                     abort_suite = suite_id
                     print('*ERROR* Setup file for suite `{}` cannot run! No such file! All suite will be ABORTED!\n\n'.format(suite_name))
-                try:
-                    proxy().set_file_status(self.epName, file_id, STATUS_SKIPPED, 0.0) # Status SKIPPED
-                except Exception:
-                    trace = traceback.format_exc()[34:].strip()
-                    print('Exception on change file status `{}`!\n'.format(trace))
-                try:
-                    proxy().set_file_variable(self.epName, file_id, '_reason', 'Skip, invalid setup file!')
-                except Exception:
-                    trace = traceback.format_exc()[34:].strip()
-                    print('Exception on sending reason `{}`!'.format(trace))
-                self.end_logs(file_id, filename)
+                self.end_logs(file_id, filename, STATUS_SKIPPED, 0.0, 'Skip, invalid setup file!')
                 continue
 
             elif not str_to_execute:
                 print('EP Debug: File `{}` will be skipped.\n'.format(filename))
                 # Skipped setup files are ok, no need to abort.
-                try:
-                    proxy().set_file_status(self.epName, file_id, STATUS_SKIPPED, 0.0) # Status SKIPPED
-                except Exception:
-                    trace = traceback.format_exc()[34:].strip()
-                    print('Exception on change file status `{}`!\n'.format(trace))
-                try:
-                    proxy().set_file_variable(self.epName, file_id, '_reason', 'File marked skip!')
-                except Exception:
-                    trace = traceback.format_exc()[34:].strip()
-                    print('Exception on sending reason `{}`!'.format(trace))
-                self.end_logs(file_id, filename)
+                self.end_logs(file_id, filename, STATUS_SKIPPED, 0.0, 'File marked skip!')
                 continue
 
             # Don' Run NON-runnable files, but Download them!
@@ -1056,17 +1301,7 @@ class TwisterRunner(object):
                 f = open(fpath, 'wb')
                 f.write(str_to_execute)
                 f.close() ; del f
-                try:
-                    proxy().set_file_status(self.epName, file_id, STATUS_SKIPPED, 0.0) # Status SKIPPED
-                except Exception:
-                    trace = traceback.format_exc()[34:].strip()
-                    print('Exception on change file status `{}`!\n'.format(trace))
-                try:
-                    proxy().set_file_variable(self.epName, file_id, '_reason', 'Skip, file is not runnable!')
-                except Exception:
-                    trace = traceback.format_exc()[34:].strip()
-                    print('Exception on sending reason `{}`!'.format(trace))
-                self.end_logs(file_id, filename)
+                self.end_logs(file_id, filename, STATUS_SKIPPED, 0.0, 'Skip, file is not runnable!')
                 continue
 
 
@@ -1102,17 +1337,7 @@ class TwisterRunner(object):
                 if setup_file:
                     abort_suite = suite_id
                     print('*ERROR* Setup file for suite `{}` cannot run! Unknown file extension! All suite will be ABORTED!\n\n'.format(suite_name))
-                try:
-                    proxy().set_file_status(self.epName, file_id, STATUS_NOT_EXEC, 0.0) # Status NOT_EXEC
-                except Exception:
-                    trace = traceback.format_exc()[34:].strip()
-                    print('Exception on change file status `{}`!\n'.format(trace))
-                try:
-                    proxy().set_file_variable(self.epName, file_id, '_reason', 'Not executed, unknown file extension!')
-                except Exception:
-                    trace = traceback.format_exc()[34:].strip()
-                    print('Exception on sending reason `{}`!'.format(trace))
-                self.end_logs(file_id, filename)
+                self.end_logs(file_id, filename, STATUS_NOT_EXEC, 0.0, 'Not executed, unknown file extension!')
                 continue
 
 
@@ -1122,9 +1347,13 @@ class TwisterRunner(object):
                 time.sleep(self.tc_delay)
 
 
-            # Check the general status again...
+            # Check the general status again; if the EP is subscribed, the status was pushed
             try:
-                if proxy().get_ep_status(self.epName) == 'stopped':
+                if EP_EVENTS.epname:
+                    STATUS = EP_EVENTS.ep_status
+                else:
+                    STATUS = proxy().get_ep_status(self.epName)
+                if STATUS == 'stopped':
                     # Exit the cycle
                     diff_time = time.time() - glob_time
                     return self.exit(timer_f=diff_time, stop=False)
@@ -1207,24 +1436,15 @@ class TwisterRunner(object):
                 print('\n>>> File `{}` execution CRASHED. <<<\n'.format(filename))
 
                 proxy().echo('*ERROR* Error executing file `{}`!'.format(filename))
-                try:
-                    proxy().set_file_status(self.epName, file_id, STATUS_FAIL, (time.time() - timer_i))
-                except Exception:
-                    trace = traceback.format_exc()[34:].strip()
-                    print('Exception on change file status `{}`!\n'.format(trace))
-
-                try:
-                    proxy().set_file_variable(self.epName, file_id, '_reason', 'Test execution CRASHED!')
-                except Exception:
-                    trace = traceback.format_exc()[34:].strip()
-                    print('Exception on sending reason `{}`!'.format(trace))
+                # Stop counting time. END OF TEST!
+                timer_f = time.time() - timer_i
 
                 # If status is FAIL and the file is not Optional and Exit on test fail is ON, CLOSE the EP
                 if not optional_test and self.exit_on_test_fail:
                     print('*ERROR* Mandatory file `{}` CRASHED! Closing the EP!\n\n'.format(filename))
                     proxy().echo('*ERROR* Mandatory file `{}::{}::{}` CRASHED! Closing the EP!'\
                         ''.format(self.epName, suite_name, filename))
-                    self.end_logs(file_id, filename)
+                    self.end_logs(file_id, filename, STATUS_FAIL, timer_f, 'Test execution CRASHED!')
                     # Exit the cycle
                     break
 
@@ -1235,13 +1455,11 @@ class TwisterRunner(object):
                     proxy().echo('*ERROR* Setup file for `{}::{}` returned FAIL! All suite will be ABORTED!'\
                         ''.format(self.epName, suite_name))
 
-                # Send crash detected = True
-                proxy().set_file_variable(self.epName, file_id, 'twister_tc_crash_detected', 1)
-                # Stop counting time. END OF TEST!
-                timer_f = time.time() - timer_i
                 end_time = time.strftime('%Y-%m-%d %H:%M:%S')
                 print('Test statistics: Start time {} -- End time {} -- {:0.2f} sec.\n'.format(start_time, end_time, timer_f))
-                self.end_logs(file_id, filename)
+                # Send status FAIL and crash detected = True
+                self.end_logs(file_id, filename, STATUS_FAIL, timer_f, 'Test execution CRASHED!',
+                    {'twister_tc_crash_detected': 1})
                 # Skip this cycle, go to next file
                 continue
 
@@ -1260,36 +1478,27 @@ class TwisterRunner(object):
             except Exception:
                 result = str(result).upper()
 
-            try:
-                if  result == 0 or result == STATUS_PASS or result == 'PASS':
-                    result = STATUS_PASS
-                    proxy().set_file_status(self.epName, file_id, STATUS_PASS, timer_f) # File status PASS
-                elif result == STATUS_SKIPPED or result in ['SKIP', 'SKIPPED']:
-                    result = STATUS_SKIPPED
-                    proxy().set_file_status(self.epName, file_id, STATUS_SKIPPED, timer_f) # File status SKIPPED
-                elif result == STATUS_ABORTED or result in ['ABORT', 'ABORTED']:
-                    result = STATUS_ABORTED
-                    proxy().set_file_status(self.epName, file_id, STATUS_ABORTED, timer_f) # File status ABORTED
-                elif result == STATUS_NOT_EXEC or result in ['NOT-EXEC', 'NOT EXEC', 'NOT EXECUTED']:
-                    result = STATUS_NOT_EXEC
-                    proxy().set_file_status(self.epName, file_id, STATUS_NOT_EXEC, timer_f) # File status NOT_EXEC
-                elif result == STATUS_TIMEOUT or result == 'TIMEOUT':
-                    result = STATUS_TIMEOUT
-                    proxy().set_file_status(self.epName, file_id, STATUS_TIMEOUT, timer_f) # File status TIMEOUT
-                elif result == STATUS_INVALID or result == 'INVALID':
-                    proxy().set_file_status(self.epName, file_id, STATUS_INVALID, timer_f) # File status INVALID
-                else:
-                    result = STATUS_FAIL
-                    proxy().set_file_status(self.epName, file_id, STATUS_FAIL, timer_f) # File status FAIL
-            except Exception:
-                trace = traceback.format_exc()[34:].strip()
-                print('EXCEPTION on changing file status `{}`!'.format(trace))
-
-            try:
-                proxy().set_file_variable(self.epName, file_id, '_reason', reason)
-            except Exception:
-                trace = traceback.format_exc()[34:].strip()
-                print('EXCEPTION on sending reason `{}`!'.format(trace))
+            # The file status is sent with the END logs
+            if  result == 0 or result == STATUS_PASS or result == 'PASS':
+                result = STATUS_PASS
+                file_status = STATUS_PASS
+            elif result == STATUS_SKIPPED or result in ['SKIP', 'SKIPPED']:
+                result = STATUS_SKIPPED
+                file_status = STATUS_SKIPPED
+            elif result == STATUS_ABORTED or result in ['ABORT', 'ABORTED']:
+                result = STATUS_ABORTED
+                file_status = STATUS_ABORTED
+            elif result == STATUS_NOT_EXEC or result in ['NOT-EXEC', 'NOT EXEC', 'NOT EXECUTED']:
+                result = STATUS_NOT_EXEC
+                file_status = STATUS_NOT_EXEC
+            elif result == STATUS_TIMEOUT or result == 'TIMEOUT':
+                result = STATUS_TIMEOUT
+                file_status = STATUS_TIMEOUT
+            elif result == STATUS_INVALID or result == 'INVALID':
+                file_status = STATUS_INVALID
+            else:
+                result = STATUS_FAIL
+                file_status = STATUS_FAIL
 
 
             # If status is not PASS
@@ -1300,7 +1509,7 @@ class TwisterRunner(object):
                     print('*ERROR* Mandatory file `{}` did not PASS! Closing the EP!\n\n'.format(filename))
                     proxy().echo('*ERROR* Mandatory file `{}::{}::{}` did not PASS! Closing the EP!'\
                         ''.format(self.epName, suite_name, filename))
-                    self.end_logs(file_id, filename)
+                    self.end_logs(file_id, filename, file_status, timer_f, reason)
                     # Exit the cycle
                     break
 
@@ -1328,7 +1537,7 @@ class TwisterRunner(object):
                     print('Test was skipped because: `{}`.\n'.format(reason))
 
 
-            self.end_logs(file_id, filename)
+            self.end_logs(file_id, filename, file_status, timer_f, reason)
 
             #---------------------------------------------------------------------------------------
 
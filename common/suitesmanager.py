@@ -1,7 +1,7 @@
 
 # File: suitesmanager.py ; This file is part of Twister.
 
-# version: 3.001
+# version: 3.002
 
 # Copyright (C) 2012-2013 , Luxoft
 
@@ -44,64 +44,102 @@ class SuitesManager(OrderedDict):
     a lot of suites with subsuites that contain other subsuites.
     All this structure must allow files execution in order.
     This class is common for Central Engine and Execution Process!
+
+    Besides the tree, the manager keeps an index with all the nodes,
+    the parent of each node and the ordered list of files for each suite,
+    so the lookups don't have to walk the tree every time.
+    The index is rebuilt lazily, after the tree structure changes.
     """
 
-    def _recursive_find_suites(self, nodes, result=[]):
-        """ search suites in recursive mode """
-        # Nodes are Ordered Dicts
-        for id, node in nodes.iteritems():
-            if node.get('type', 'file') != 'suite':
-                continue
-            result.append(id)
-            ids = self._recursive_find_suites(node['children'], [])
-            result.extend(ids)
-        return result
+    def __init__(self, *args, **kwargs):
+        self._clear_index()
+        OrderedDict.__init__(self, *args, **kwargs)
 
 
-    def get_suites(self):
+    def __setitem__(self, key, value, *args, **kwargs):
+        OrderedDict.__setitem__(self, key, value, *args, **kwargs)
+        self._clear_index()
+
+
+    def __delitem__(self, key, *args, **kwargs):
+        OrderedDict.__delitem__(self, key, *args, **kwargs)
+        self._clear_index()
+
+
+    def __reduce__(self):
         """
-        Returns a list of suite IDs.
+        The index is NOT sent over the wire (eg: to the Execution Process),
+        it will be rebuilt on the first lookup.
         """
-        # Must pass a null result as default parameter!
-        result = self._recursive_find_suites(self, [])
-        return result
+        items = [[k, self[k]] for k in self]
+        return (self.__class__, (items,))
+
+
+    def clear(self):
+        OrderedDict.clear(self)
+        self._clear_index()
 
 
-    def _recursive_find_files(self, nodes, result=[]):
-        """ search for files recursive mode """
+    def _clear_index(self):
+        """ invalidate the index """
+        self._nodes   = {}   # ID -> node
+        self._parents = {}   # ID -> parent suite ID
+        self._suites  = []   # ordered suite IDs
+        self._files   = {}   # suite ID -> ordered file IDs (recursive), None = all files
+        self._indexed = False
+
+
+    def _recursive_index(self, nodes, parent, parents):
+        """ index suites and files in recursive mode """
         # Nodes are Ordered Dicts
         for id, node in nodes.iteritems():
+            self._nodes[id] = node
+            self._parents[id] = parent
             # This is a file
             if node.get('type', 'file') == 'file':
-                result.append(id)
+                self._files[None].append(id)
+                for suite_id in parents:
+                    self._files[suite_id].append(id)
             # This is a suite
             else:
-                self._recursive_find_files(node['children'], result)
-        return result
+                self._suites.append(id)
+                self._files[id] = []
+                self._recursive_index(node['children'], id, parents + [id])
+
+
+    def _check_index(self):
+        """ build the index, if the structure was changed """
+        if self._indexed:
+            return
+        self._clear_index()
+        self._files[None] = []
+        self._recursive_index(self, None, [])
+        self._indexed = True
+
+
+    def get_suites(self):
+        """
+        Returns a list of suite IDs.
+        """
+        self._check_index()
+        return list(self._suites)
 
 
     def get_files(self, suite_id=None, recursive=True):
         """
         Returns a list of file IDs. Can filter for one suite.
         """
+        self._check_index()
         if suite_id:
-            suite = self.find_id(suite_id, self)
-            if not suite:
+            if suite_id not in self._files:
                 return []
             if recursive:
-                # Must pass a null result as default parameter!
-                return self._recursive_find_files(suite['children'], [])
+                return list(self._files[suite_id])
             else:
-                result = []
-                for id, node in suite['children'].iteritems():
-                    # This is a file
-                    if node.get('type', 'file') == 'file':
-                        result.append(id)
-                return result
+                return [id for id in self._files[suite_id] if self._parents[id] == suite_id]
         else:
             if recursive:
-                # Must pass a null result as default parameter!
-                return self._recursive_find_files(self, [])
+                return list(self._files[None])
             else:
                 result = []
                 for id, node in self.iteritems():
@@ -111,6 +149,30 @@ class SuitesManager(OrderedDict):
                 return result
 
 
+    def has_suite(self, suite_id):
+        """
+        Check if a suite ID exists.
+        """
+        self._check_index()
+        return suite_id in self._files and suite_id is not None
+
+
+    def has_file(self, file_id):
+        """
+        Check if a file ID exists.
+        """
+        self._check_index()
+        return file_id in self._nodes and file_id not in self._files
+
+
+    def get_parent(self, node_id):
+        """
+        Returns the ID of the parent suite, or None for top level nodes.
+        """
+        self._check_index()
+        return self._parents.get(node_id)
+
+
     def iter_nodes(self, nodes=None, result=[]):
         """
         Depth iterate through suites and files.
@@ -129,8 +191,9 @@ class SuitesManager(OrderedDict):
         """
         Find a node, using the ID.
         """
-        if not nodes:
-            nodes = self
+        if nodes is None or nodes is self:
+            self._check_index()
+            return self._nodes.get(node_id)
         if _found:
             return _found
         for id, node in nodes.iteritems():
@@ -141,4 +204,39 @@ class SuitesManager(OrderedDict):
                 _found = self.find_id(node_id, node['children'], _found)
         return _found
 
+
+    def add_file(self, suite_id, file_id, node):
+        """
+        Add a file node at the end of a suite.
+        """
+        suite = self.find_id(suite_id)
+        if not suite or suite.get('type', 'file') != 'suite':
+            return False
+        suite['children'][file_id] = node
+        self._clear_index()
+        return True
+
+
+    def del_file(self, file_id):
+        """
+        Remove a file node from its suite.
+        The index is updated in place, so it's cheap to remove many files.
+        """
+        self._check_index()
+        if not self.has_file(file_id):
+            return False
+        parent = self._parents[file_id]
+        if parent is None:
+            OrderedDict.__delitem__(self, file_id)
+        else:
+            del self._nodes[parent]['children'][file_id]
+        # Update the index for all the parent suites
+        while parent is not None:
+            self._files[parent].remove(file_id)
+            parent = self._parents[parent]
+        self._files[None].remove(file_id)
+        del self._nodes[file_id]
+        del self._parents[file_id]
+        return True
+
 #
@@ -1,7 +1,7 @@
 
 # File: xmlparser.py ; This file is part of Twister.
 
-# version: 3.031
+# version: 3.032
 
 # Copyright (C) 2012-2014 , Luxoft
 
@@ -31,6 +31,7 @@ import time
 import hashlib
 
 from collections import OrderedDict
+from thread import allocate_lock
 
 TWISTER_PATH = os.getenv('TWISTER_PATH')
 if not TWISTER_PATH:
@@ -54,7 +55,7 @@ etree.set_default_parser(parser)
 
 localFs = LocalFS() # Singleton
 
-__all__ = ['TSCParser', 'DBParser', 'PluginParser', 'ClearCaseParser']
+__all__ = ['TSCParser', 'DBParser', 'PluginParser', 'PluginRegistry', 'ClearCaseParser']
 
 
 # # #   Helpers   # # #
@@ -1159,6 +1160,39 @@ class DBParser(object):
 # # #   Plugins   # # #
 
 
+plugin_lock = allocate_lock() # Plugin modules lock
+plugin_modules = {} # Plugin module name -> (file stamp, Plugin class)
+
+
+def fileStamp(fpath):
+    """
+    Modification time and size of a file, or None.
+    """
+    try:
+        fstat = os.stat(fpath)
+        return fstat.st_mtime, fstat.st_size
+    except Exception:
+        return None
+
+
+def loadPlugin(mod, force=False):
+    """
+    Import a plugin module and return the Plugin class.
+    The module is executed again only when the python file changes.
+    """
+    stamp = fileStamp('{}/plugins/{}.py'.format(TWISTER_PATH, mod))
+    with plugin_lock:
+        cached = plugin_modules.get(mod)
+        if cached and cached[0] == stamp and not force:
+            return cached[1]
+        # Import the plugin module
+        mm = __import__('plugins.' + mod, fromlist=['Plugin'])
+        # Reload all data, the file is new, or was changed
+        mm = reload(mm)
+        plugin_modules[mod] = (stamp, mm.Plugin)
+        return mm.Plugin
+
+
 class PluginParser(object):
     """
     Requirements: LXML.
@@ -1230,11 +1264,7 @@ class PluginParser(object):
                 continue
             plug = None
             try:
-                # Import the plugin module
-                mm = __import__('plugins.' + mod, fromlist=['Plugin'])
-                # Reload all data, just in case
-                mm = reload(mm)
-                plug = mm.Plugin
+                plug = loadPlugin(mod)
             except Exception, e:
                 logWarning('User {}: PluginParser ERROR: Unhandled exception' \
                 ' in plugin file `{}`! Exception: {}!'.\
@@ -1258,6 +1288,76 @@ class PluginParser(object):
         return plugins
 
 
+    def getFiles(self):
+        """ The python files of all enabled plugins """
+        return sorted('{}/plugins/{}.py'.format(TWISTER_PATH, os.path.splitext(self.config[k]['pyfile'])[0])
+                      for k in self.config if self.config[k]['status'] == 'enabled')
+
+
+class PluginRegistry(object):
+    """
+    The plugins of each user, parsed from plugins.xml.
+    The XML and the plugin modules are loaded again only when their files change;
+    the files are checked at most once every `check_interval` seconds.
+    """
+
+    def __init__(self, check_interval=2.0):
+
+        self.check_interval = check_interval
+        self.users = {} # User -> plugins, files, file stamps, last check
+        self.reg_lock = allocate_lock() # Registry lock
+
+
+    def _stamps(self, user, files):
+        """ File stamps of plugins.xml and all the plugin files """
+        config_data = '{}/twister/config/plugins.xml'.format(userHome(user))
+        return [fileStamp(config_data)] + [fileStamp(f) for f in files]
+
+
+    def getPlugins(self, user):
+        """
+        Return all plugins info, like PluginParser.getPlugins.
+        The result is shared, it must not be changed.
+        """
+        with self.reg_lock:
+            entry = self.users.get(user)
+            now = time.time()
+            if entry and now - entry['checked'] < self.check_interval:
+                return entry['plugins']
+            if entry and self._stamps(user, entry['files']) == entry['stamps']:
+                entry['checked'] = now
+                return entry['plugins']
+
+            parser = PluginParser(user)
+            plugins = parser.getPlugins()
+            files = parser.getFiles()
+            self.users[user] = {
+                'plugins': plugins,
+                'files': files,
+                'stamps': self._stamps(user, files),
+                'checked': now
+            }
+            logDebug('User {}: PluginRegistry loaded plugins `{}`.'.format(user, ', '.join(sorted(plugins))))
+            return plugins
+
+
+    def reload(self, user):
+        """
+        Forget the plugins of the user and reload all the plugin modules.
+        """
+        with self.reg_lock:
+            entry = self.users.pop(user, None)
+            if not entry:
+                return
+            for pdict in entry['plugins'].values():
+                mod = os.path.splitext(pdict['pyfile'])[0]
+                try:
+                    loadPlugin(mod, force=True)
+                except Exception, e:
+                    logWarning('User {}: PluginRegistry ERROR: Cannot reload plugin file `{}`! ' \
+                        'Exception: {}!'.format(user, mod, e))
+
+
 # # #   ClearCase   # # #
 
 
@@ -0,0 +1,166 @@
+# File: TscExpectLib.py ; This file is part of Twister.
+
+# version: 2.001
+#
+# Copyright (C) 2012-2014 , Luxoft
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at:
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+"""
+    This module contains the expect engine used by the SSH and Telnet libraries.
+    The data is read as soon as it arrives (using select), into a buffer,
+    and the expected prompt is searched only in the new data.
+"""
+
+
+import re
+from select import select
+from time import time
+
+__all__ = ['ExpectBuffer', 'QUIET_TIME']
+
+# when reading without a prompt, the output ends when nothing
+# arrives for this many seconds
+QUIET_TIME = 0.3
+
+#
+
+class ExpectBuffer(object):
+    """ incremental read buffer, with expect """
+
+    def __init__(self, fileno, read_now, window=4096):
+        """
+        fileno: function that returns the file descriptor to wait on;
+        read_now: function that returns the available data, without blocking,
+        '' if there is no data, or raises EOFError if the connection is closed;
+        window: the new data is searched together with this many old bytes,
+        so a match can be at most this long.
+        """
+
+        self.fileno = fileno
+        self.read_now = read_now
+        self.window = window
+
+        self.buffer = ''
+        self.searched = 0
+        self.eof = False
+
+
+    def clear(self):
+        """ drop the buffered data """
+
+        self.buffer = ''
+        self.searched = 0
+        self.eof = False
+
+
+    def flush(self):
+        """ return and remove all the buffered data """
+
+        data = self.buffer
+        self.buffer = ''
+        self.searched = 0
+        return data
+
+
+    def fill(self, timeout=0):
+        """ wait at most timeout seconds for new data and add it to the buffer;
+        returns the number of new bytes """
+
+        if self.eof:
+            return 0
+
+        deadline = time() + timeout
+        while True:
+            try:
+                data = self.read_now()
+            except EOFError:
+                self.eof = True
+                return 0
+
+            if data:
+                self.buffer += data
+                return len(data)
+
+            left = deadline - time()
+            if left <= 0:
+                return 0
+
+            # the connection might be readable, without new data (eg: telnet
+            # commands), so wait again, until the deadline
+            try:
+                if not select([self.fileno()], [], [], left)[0]:
+                    return 0
+            except Exception as e:
+                print('expect select error: {er}'.format(er=e))
+                return 0
+
+
+    def read(self, timeout=0):
+        """ wait at most timeout seconds for data; returns all the data """
+
+        if not self.buffer:
+            self.fill(timeout)
+        while self.fill(0):
+            pass
+
+        return self.flush()
+
+
+    def read_quiet(self, timeout=0, quiet=QUIET_TIME, max_time=1200):
+        """ wait at most timeout seconds for data, then read until nothing
+        arrives for quiet seconds, or max_time passes; returns all the data """
+
+        if not self.buffer and not self.fill(timeout):
+            return self.flush()
+
+        deadline = time() + max_time
+        while self.fill(min(quiet, deadline - time())):
+            pass
+
+        return self.flush()
+
+
+    def expect(self, patterns, timeout):
+        """
+        wait at most timeout seconds until one of the patterns is found;
+        the patterns are strings, or compiled regular expressions;
+        returns (index, match, text), the text is the data up to the end of the match;
+        on timeout or if the connection is closed, returns (-1, None, all the data)
+        """
+
+        regexes = []
+        for pattern in patterns:
+            if isinstance(pattern, basestring):
+                pattern = re.compile(re.escape(pattern))
+            regexes.append(pattern)
+        deadline = time() + timeout
+
+        while True:
+            # search only the new data
+            start = max(0, self.searched - self.window)
+            self.searched = len(self.buffer)
+
+            for index, regex in enumerate(regexes):
+                match = regex.search(self.buffer, start)
+                if match:
+                    text = self.buffer[:match.end()]
+                    self.buffer = self.buffer[match.end():]
+                    self.searched = 0
+                    return index, match, text
+
+            left = deadline - time()
+            if left <= 0 or not self.fill(left):
+                return -1, None, self.flush()
@@ -1,6 +1,6 @@
 # File: TscSshLib.py ; This file is part of Twister.
 
-# version: 2.004
+# version: 2.005
 #
 # Copyright (C) 2012-2013 , Luxoft
 #
@@ -28,10 +28,83 @@
 """
 
 
+import re
 import time
 
 import paramiko
 
+try:
+    from TscExpectLib import ExpectBuffer
+except ImportError:
+    # Older Execution Processes download this library without TscExpectLib;
+    # fall back to a simple buffer, that searches all the data every time
+    import re
+    from select import select
+    from time import time as _now
+
+    class ExpectBuffer(object):
+        """ minimal replacement for TscExpectLib.ExpectBuffer """
+
+        def __init__(self, fileno, read_now, window=4096):
+            self.fileno = fileno
+            self.read_now = read_now
+            self.buffer = ''
+            self.eof = False
+
+        def clear(self):
+            self.buffer = ''
+            self.eof = False
+
+        def flush(self):
+            data, self.buffer = self.buffer, ''
+            return data
+
+        def fill(self, timeout=0):
+            deadline = _now() + timeout
+            while not self.eof:
+                try:
+                    data = self.read_now()
+                except EOFError:
+                    self.eof = True
+                    break
+                if data:
+                    self.buffer += data
+                    return len(data)
+                left = deadline - _now()
+                if left <= 0 or not select([self.fileno()], [], [], left)[0]:
+                    break
+            return 0
+
+        def read(self, timeout=0):
+            if not self.buffer:
+                self.fill(timeout)
+            while self.fill(0):
+                pass
+            return self.flush()
+
+        def read_quiet(self, timeout=0, quiet=0.3, max_time=1200):
+            if self.buffer or self.fill(timeout):
+                deadline = _now() + max_time
+                while self.fill(min(quiet, deadline - _now())):
+                    pass
+            return self.flush()
+
+        def expect(self, patterns, timeout):
+            regexes = [re.compile(re.escape(p)) if isinstance(p, basestring) else p
+                       for p in patterns]
+            deadline = _now() + timeout
+            while True:
+                for index, regex in enumerate(regexes):
+                    match = regex.search(self.buffer)
+                    if match:
+                        text = self.buffer[:match.end()]
+                        self.buffer = self.buffer[match.end():]
+                        return index, match, text
+                left = deadline - _now()
+                if left <= 0 or not self.fill(left):
+                    return -1, None, self.flush()
+
+
 __all__ = ['SshManager', 'SshConnection', 'SshShell']
 
 #
@@ -202,6 +275,7 @@ class SshConnection:
         self.timeout = 2
 
         self.nbytes = 4096
+        self.buffer = ExpectBuffer(lambda: self.session.fileno(), self._recv)
 
         try:
             self.connection = paramiko.Transport((self.host, self.port))
@@ -239,38 +313,42 @@ class SshConnection:
         return False
 
 
-    def read(self):
+    def _recv(self):
+        """ read the available data, without blocking """
+
+        if self.session.recv_ready():
+            return self.session.recv(self.nbytes)
+        if self.session.closed or self.session.eof_received:
+            raise EOFError('ssh channel closed')
+
+        return ''
+
+
+    def read(self, new_session=True):
         """ read from ssh connection """
 
-        self.session = self.connection.open_channel(kind='session')
+        if new_session:
+            self.session = self.connection.open_channel(kind='session')
+            self.buffer.clear()
 
         if not self.session or not self.session.active:
             return False
 
-        d1 = time.time()
-        while not self.session.recv_ready():
-            time.sleep(2)
-
-            d2 = time.time()
-            if int(d2 - d1) > self.timeout:
-                break
+        # wait for the output, not longer than timeout, then read
+        # until the command ends, or nothing new arrives
+        response = self.buffer.read_quiet(self.timeout)
 
         if self.session.recv_stderr_ready():
             print self.session.recv_stderr(self.nbytes)
 
-        if self.session.recv_ready():
-            return self.session.recv(self.nbytes)
-
-        if self.session.exit_status_ready():
-            return False
-
-        return False
+        return response or False
 
 
     def write(self, command, result=True):
         """ write command to ssh connection """
 
         self.session = self.connection.open_channel(kind='session')
+        self.buffer.clear()
 
         if not self.session or not self.session.active:
             return False
@@ -278,7 +356,7 @@ class SshConnection:
         self.session.exec_command(command)
 
         if result:
-            return self.read()
+            return self.read(False)
 
         return False
 
@@ -299,9 +377,12 @@ class SshShell:
         }
         self.name = name
         self.timeout = 0.2
+        # wait at most this many seconds for the prompt, after the output starts
+        self.expect_timeout = 30
 
         self.nbytes = 4096
         self.prompt = ''
+        self.buffer = ExpectBuffer(lambda: self.session.fileno(), self._recv)
 
         try:
             self.connection = paramiko.SSHClient()
@@ -343,6 +424,27 @@ class SshShell:
         return False
 
 
+    def _recv(self):
+        """ read the available data, without blocking """
+
+        if self.session.recv_ready():
+            return self.session.recv(self.nbytes)
+        if self.session.closed or self.session.eof_received:
+            raise EOFError('ssh channel closed')
+
+        return ''
+
+
+    def set_expect_timeout(self, timeout):
+        """ set how long to wait for the prompt, after the output starts """
+
+        if isinstance(timeout, (int, float)) and timeout > 0:
+            self.expect_timeout = timeout
+            return True
+
+        return False
+
+
     def read(self, timeout=True, prompt_set=True):
         """  read from ssh connection """
 
@@ -353,55 +455,44 @@ class SshShell:
             print self.session.recv_stderr(self.nbytes)
             return False
 
-        readBuffer = ''
-        d1 = time.time()
-        while not self.session.recv_ready():
-            time.sleep(1)
+        # wait for the output; at least 1 second (slow login banners),
+        # at most the expect timeout, or 20 minutes without timeout
+        if timeout:
+            first_wait = min(max(1.0, self.timeout), self.expect_timeout)
+        else:
+            first_wait = 1200
+        if not self.buffer.buffer and not self.buffer.fill(first_wait):
+            return False
+
+        if prompt_set:
+            # read output untill last line is the one with the prompt
+            last_line = re.compile(re.escape('\n' + self.prompt) + r'\Z')
+            index, _, readBuffer = self.buffer.expect([last_line], self.expect_timeout)
+            if index < 0:
+                print('CC_LIB: Read timeout; prompt is set to `{}`.'.format(self.prompt))
+        else:
+            # No prompt is set; just read untill nothing new arrives
+            readBuffer = self.buffer.read_quiet()
 
-            d2 = time.time()
-            # wait at most 20 minutes
-            if (((int(d2 - d1) > self.timeout) and timeout) or int(d2 - d1) > 1200):
-                break
+        return readBuffer
 
-        if self.session.recv_ready():
-            if prompt_set:
-                # read output untill last line is the one with the prompt
-                last_line = '\n' + self.prompt
-                iter = 0
-                while iter < 5:
-                    try:
-                        resp = self.session.recv(self.nbytes)
-                        readBuffer += resp
-                        # check if it's the prompt line
-                        #print('CC_LIB buffer: `{}`.'.format(readBuffer))
-                        if last_line == readBuffer[-(len(self.prompt)+1):]:
-                            #print('CC_LIB Found last line `{}`.'.format(last_line))
-                            break;
-                        time.sleep(0.5)
-                    except Exception as e:
-                        time.sleep(1)
-                        if iter == 4:
-                            print('CC_LIB: Read retry; prompt is set to `{}`.'.format(self.prompt))
-                    iter += 1
-            else:
-                # No prompt is set; just try to read untill timeout;
-                # repeat 5 times
-                iter = 0
-                while iter < 5:
-                    try:
-                        resp = self.session.recv(self.nbytes)
-                        readBuffer += resp
-                        time.sleep(0.5)
-                    except Exception as e:
-                        time.sleep(1)
-                    iter += 1
-
-            return readBuffer
-
-        if self.session.exit_status_ready():
+
+    def expect(self, patterns, timeout=None):
+        """ read from ssh connection, until one of the patterns (strings,
+        or compiled regular expressions) is found; returns the output """
+
+        if not self.session or not self.session.active:
             return False
 
-        return False
+        if isinstance(patterns, basestring) or hasattr(patterns, 'search'):
+            patterns = [patterns]
+
+        index, _, readBuffer = self.buffer.expect(patterns,
+                                        (timeout, self.expect_timeout)[timeout is None])
+        if index < 0:
+            print('CC_LIB: Expect timeout; nothing matched `{}`.'.format(patterns))
+
+        return readBuffer
 
 
     def write(self, command, result=True, read_timeout=False):
@@ -421,7 +512,7 @@ class SshShell:
             return ''
 
         if result:
-            time.sleep(0.8)
+            # returns as soon as the prompt is received
             return self.read(read_timeout)
 
         return False
@@ -451,6 +542,9 @@ class SshShell:
 
         """ we have to do a first read to get the initial prompt """
         welcome_msg = self.read(True, False)
+        if not welcome_msg:
+            print('CC_LIB: no login banner received; cannot set the prompt.')
+            return False
         welcome_msg = welcome_msg.splitlines()#('\r\n')
         """ last line is the prompt """
         self.prompt = welcome_msg[len(welcome_msg)-1]
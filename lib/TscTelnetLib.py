@@ -1,6 +1,6 @@
 # File: TscTelnetLib.py ; This file is part of Twister.
 
-# version: 2.003
+# version: 2.004
 #
 # Copyright (C) 2012 , Luxoft
 #
@@ -35,6 +35,78 @@ from thread import start_new_thread
 #from os.path import dirname, exists, abspath, join, getsize
 #Efrom json import load, dump
 
+try:
+    from TscExpectLib import ExpectBuffer
+except ImportError:
+    # Older Execution Processes download this library without TscExpectLib;
+    # fall back to a simple buffer, that searches all the data every time
+    import re
+    from select import select
+    from time import time as _now
+
+    class ExpectBuffer(object):
+        """ minimal replacement for TscExpectLib.ExpectBuffer """
+
+        def __init__(self, fileno, read_now, window=4096):
+            self.fileno = fileno
+            self.read_now = read_now
+            self.buffer = ''
+            self.eof = False
+
+        def clear(self):
+            self.buffer = ''
+            self.eof = False
+
+        def flush(self):
+            data, self.buffer = self.buffer, ''
+            return data
+
+        def fill(self, timeout=0):
+            deadline = _now() + timeout
+            while not self.eof:
+                try:
+                    data = self.read_now()
+                except EOFError:
+                    self.eof = True
+                    break
+                if data:
+                    self.buffer += data
+                    return len(data)
+                left = deadline - _now()
+                if left <= 0 or not select([self.fileno()], [], [], left)[0]:
+                    break
+            return 0
+
+        def read(self, timeout=0):
+            if not self.buffer:
+                self.fill(timeout)
+            while self.fill(0):
+                pass
+            return self.flush()
+
+        def read_quiet(self, timeout=0, quiet=0.3, max_time=1200):
+            if self.buffer or self.fill(timeout):
+                deadline = _now() + max_time
+                while self.fill(min(quiet, deadline - _now())):
+                    pass
+            return self.flush()
+
+        def expect(self, patterns, timeout):
+            regexes = [re.compile(re.escape(p)) if isinstance(p, basestring) else p
+                       for p in patterns]
+            deadline = _now() + timeout
+            while True:
+                for index, regex in enumerate(regexes):
+                    match = regex.search(self.buffer)
+                    if match:
+                        text = self.buffer[:match.end()]
+                        self.buffer = self.buffer[match.end():]
+                        return index, match, text
+                left = deadline - _now()
+                if left <= 0 or not self.fill(left):
+                    return -1, None, self.flush()
+
+
 #__dir__ = dirname(abspath(__file__))
 
 __all__ = ['TelnetManager', 'TelnetConnection']
@@ -149,6 +221,21 @@ class TelnetManager(object):
 
         return False
 
+    def set_prompt(self, prompt, name=None):
+        """ set the prompt expected after each command on telnet connection """
+
+        if ((not name and not self.activeConnection) or
+                (name and not self.connections.has_key(name))):
+            print 'connection not found'
+            return False
+
+        if name:
+            return self.connections[name].set_prompt(prompt)
+        elif self.activeConnection:
+            return self.connections[self.activeConnection].set_prompt(prompt)
+
+        return False
+
     def set_timeout(self, timeout, name=None):
         """ set timeout for operations on telnet connection """
 
@@ -255,6 +342,10 @@ class TelnetConnection:
         }
         self.name = name
         self.newline = '\n'
+        # if the prompt is set, the command output ends with the prompt
+        self.prompt = None
+        # without a prompt, wait at most this many seconds for the output
+        self.resultTimeout = 2
 
         self.timeout = 4
         self.keepAliveRetries = 0
@@ -273,6 +364,8 @@ class TelnetConnection:
         """
         try:
             self.connection = Telnet(self.host, self.port, self.timeout)
+            self.buffer = ExpectBuffer(self.connection.fileno,
+                                        self.connection.read_very_eager)
             print('telnet connection created!')
 
             self.login()
@@ -318,6 +411,8 @@ class TelnetConnection:
 
         try:
             self.connection = Telnet(self.host, self.port)
+            self.buffer = ExpectBuffer(self.connection.fileno,
+                                        self.connection.read_very_eager)
             print('telnet connection created!')
 
             self.login()
@@ -350,6 +445,17 @@ class TelnetConnection:
         return False
 
 
+    def set_prompt(self, prompt):
+        """ set the prompt expected after each command on telnet connection;
+        the prompt is a string, or a compiled regular expression """
+
+        if prompt is None or isinstance(prompt, str) or hasattr(prompt, 'search'):
+            self.prompt = prompt
+            return True
+
+        return False
+
+
     def set_timeout(self, timeout):
         """ set timeout for operations on telnet connection """
 
@@ -367,7 +473,7 @@ class TelnetConnection:
             return False
 
         try:
-            response = self.connection.read_very_eager()
+            response = self.buffer.read()
             if response:
                 return response
 
@@ -385,7 +491,7 @@ class TelnetConnection:
             return False
 
         try:
-            response = self.connection.read_until(expected, self.timeout)
+            _, _, response = self.buffer.expect([expected], self.timeout)
             if response:
                 return response
 
@@ -396,6 +502,17 @@ class TelnetConnection:
         return False
 
 
+    def read_result(self):
+        """ read the output of the last command: until the prompt,
+        if it's set, or until nothing new arrives """
+
+        if self.prompt is not None:
+            _, _, response = self.buffer.expect([self.prompt], self.timeout)
+            return response
+
+        return self.buffer.read_quiet(self.resultTimeout)
+
+
     def write(self, command, result=True, display=True):
         """ write command to telnet connection """
 
@@ -404,10 +521,9 @@ class TelnetConnection:
 
         try:
             self.connection.write( str(command) + self.newline )
-            sleep(2)
             if display: print('command: {c}'.format(c=command))
             if result:
-                return self.connection.read_very_eager()
+                return self.read_result()
 
             else:
                 return True
@@ -425,15 +541,14 @@ class TelnetConnection:
             return False
 
         try:
-            response = self.connection.read_until(expected, self.timeout)
+            _, _, response = self.buffer.expect([expected], self.timeout)
             if response:
                 if command:
                     self.connection.write( str(command) + self.newline)
-                    sleep(2)
                     if display: print('command: {c}'.format(c=command))
 
                 if result:
-                    return self.connection.read_very_eager()
+                    return self.read_result()
                 else:
                     return True
 
@@ -2,7 +2,7 @@
 #
 # -*- coding: utf-8 -*-
 #
-# version: 3.001
+# version: 3.002
 #
 # File: PacketSnifferPlugin.py ; This file is part of Twister.
 #
@@ -35,8 +35,9 @@ from ast import literal_eval
 
 from copy import deepcopy
 from time import time
+from collections import namedtuple
 
-from json import dumps
+from json import dumps, loads
 from scapy.all import Packet, NoPayload, Ether, wrpcap
 
 from rpyc import Service as rpycService
@@ -58,6 +59,80 @@ from BasePlugin import BasePlugin
 
 
 
+# a captured packet: sequence number, packet id, json with the sniffer and
+# the packet head (as sent by query), raw packet (dissected only on demand)
+PacketRecord = namedtuple('PacketRecord', 'seq id summary source')
+
+
+class PacketRing(object):
+    """
+    Fixed capacity ring buffer of packets, indexed by packet id.
+    Every packet gets a monotonic sequence number; when the buffer
+    is full, the oldest packet is overwritten.
+    """
+
+    def __init__(self, capacity):
+        self.capacity = max(int(capacity), 1)
+        self.slots = [None] * self.capacity
+        self.ids = dict() # packet id -> sequence number
+        self.first = 0 # sequence number of the oldest packet
+        self.next = 0 # sequence number of the next packet
+
+
+    def __len__(self):
+        return self.next - self.first
+
+
+    def clear(self):
+        """ Drop all packets; the sequence numbers keep growing """
+
+        self.slots = [None] * self.capacity
+        self.ids = dict()
+        self.first = self.next
+
+
+    def append(self, packetID, summary, source):
+        """ Add a packet and return its sequence number """
+
+        seq = self.next
+        slot = seq % self.capacity
+        old = self.slots[slot]
+        if old is not None:
+            if self.ids.get(old.id) == old.seq:
+                del self.ids[old.id]
+            self.first = old.seq + 1
+
+        self.slots[slot] = PacketRecord(seq, packetID, summary, source)
+        self.ids[packetID] = seq
+        self.next = seq + 1
+
+        return seq
+
+
+    def get(self, seq):
+        """ The packet with this sequence number, or None """
+
+        if self.first <= seq < self.next:
+            return self.slots[seq % self.capacity]
+        return None
+
+
+    def since(self, seq, count):
+        """ At most count packets, starting with sequence number seq """
+
+        start = max(seq, self.first)
+        end = min(start + count, self.next)
+        return [self.slots[s % self.capacity] for s in xrange(start, end)]
+
+
+    def records(self):
+        """ All packets, the oldest first """
+
+        return self.since(self.first, len(self))
+
+
+
+
 class Plugin(BasePlugin):
     """
     Packet Sniffer plugin.
@@ -82,14 +157,13 @@ class Plugin(BasePlugin):
         # plugin status, packets list, temporary path to save pcap files,
         # packets list index limit, registered sniffers
         self.status = 'paused'
-        self.packets = list()
+        self.packets = PacketRing(self.data['historyLength'])
         self.packetsLock = allocate_lock()
         self.pcapPath = getenv('TWISTER_PATH') + '/tmp'
         if not exists(self.pcapPath):
             makedirs(self.pcapPath)
-        self.packetsIndexLimit = (int(self.data['historyLength'])
-                                    - int(self.data['packetsBuffer']))
         self.filters = dict()
+        self.dropped = dict() # packets dropped by each sniffer
 
         self.commands = {
             'simple': [
@@ -101,7 +175,7 @@ class Plugin(BasePlugin):
                 'setfilters',
             ],
             'argumented': [
-                'query', 'querypkt', 'pushpkt'
+                'query', 'querypkt', 'pushpkt', 'pushpkts'
             ]
         }
 
@@ -131,6 +205,45 @@ class Plugin(BasePlugin):
             return packet
 
 
+    def packet_decode(self, source):
+        """ Dissect a raw packet; only done when the packet is queried """
+
+        packet = Ether(source)
+
+        if of_message_parse:
+            try:
+                return of_message_parse(str(packet.payload.payload.load)).show()
+            except Exception as e:
+                pass
+
+        return self.packet_to_dict(packet)
+
+
+    def packet_summary(self, sniffer, packetHead):
+        """ The json sent by query, for one packet """
+
+        return dumps({'sniffer': sniffer, 'packet_head': packetHead}, encoding='latin')
+
+
+    def packet_seq(self, data):
+        """ Find the sequence number for the query data: a packet id,
+        seq:N (the cursor from the last query reply), or the position
+        of the packet in the buffer; returns (sequence number, found by id) """
+
+        data = str(data)
+
+        if data != '0' and data in self.packets.ids:
+            return self.packets.ids[data], True
+
+        if data.startswith('seq:'):
+            return int(data[4:]), False
+
+        try:
+            return self.packets.first + int(data), False
+        except Exception, e:
+            return None, False
+
+
     def run(self, args):
         args = {k: v[0] if isinstance(v, list) else v for k,v in args.iteritems()}
 
@@ -179,7 +292,7 @@ class Plugin(BasePlugin):
                     self.filters = {}
 
                 with self.packetsLock:
-                    self.packets = list()
+                    self.packets.clear()
                 response['data'] = {'index': 0}
 
                 with self.data['ce'].rsrv.conn_lock:
@@ -259,7 +372,7 @@ class Plugin(BasePlugin):
         elif args['command'] == 'reset':
             response['type'] = 'reset reply'
             with self.packetsLock:
-                self.packets = []
+                self.packets.clear()
 
             response['data'] = {'index': 0}
 
@@ -271,59 +384,47 @@ class Plugin(BasePlugin):
         # query for packet command (you must supply data field
         # in argument dictionary which represents the id of the packet) """
         elif args['command'] in ['query', 'querypkt']:
-            with self.packetsLock:
-                try:
-                    try:
-                        packetIndex = int(args['data'])
-                        packet = deepcopy(self.packets[packetIndex])
-                    except Exception, e:
-                        packetIndex = None
-                        packet = None
-
-                    if not packetIndex == 0:
-                        packetID = str(args['data'])
-                        for _packet in self.packets:
-                            if _packet['packet_head']['id'] == packetID:
-                                packetIndex = self.packets.index(_packet) + 1
-                                packet = deepcopy(_packet)
-
-
-                    if packetIndex is not None:
-                        if args['command'] == 'query':
-                            response['type'] = 'query reply'
-
-                            queriedPackets = []
-                            packetID = None
-                            for _packet in self.packets[packetIndex:packetIndex \
-                                                        + int(self.data['packetsBuffer'])]:
-                                pk = deepcopy(_packet)
-                                pk.pop('packet_source')
-                                packetID = pk['packet_head']['id']
-                                queriedPackets.append(dumps(pk, encoding='latin'))
-
-                            response['data'] = {
-                                'id': (args['data'], packetID)[packetID is not None],
-                                'packets': queriedPackets
-                            }
-
-                        else:
-                            #response['type'] = 'querypkt reply'
-
-                            packet = dumps(packet['packet_dict'], encoding='latin')
-                            response = packet    #response['data'] = packet
-                    else:
-                        response['status']['success'] = False
-                        if self.packets:
-                            response['status']['message'] = 'packet index unknown'
-                        else:
-                            response['data'] = dict()
-                            response['status']['message'] = 'packets list empty'
-
-                    del packet
-                except Exception, e:
+            try:
+                with self.packetsLock:
+                    packetSeq, foundByID = self.packet_seq(args['data'])
+
+                    if packetSeq is not None and args['command'] == 'query':
+                        # the reply starts after the packet with the queried id
+                        if foundByID:
+                            packetSeq += 1
+                        records = self.packets.since(packetSeq,
+                                                    int(self.data['packetsBuffer']))
+                    elif packetSeq is not None:
+                        packet = self.packets.get(packetSeq)
+                    empty = not len(self.packets)
+
+                if packetSeq is not None and args['command'] == 'query':
+                    response['type'] = 'query reply'
+
+                    # the records are immutable, the json is built on push
+                    response['data'] = {
+                        'id': records[-1].id if records else args['data'],
+                        'seq': records[-1].seq + 1 if records else max(packetSeq, self.packets.first),
+                        'dropped': sum(self.dropped.values()),
+                        'packets': [r.summary for r in records]
+                    }
+
+                elif packetSeq is not None and packet is not None:
+                    #response['type'] = 'querypkt reply'
+
+                    response = dumps(self.packet_decode(packet.source),
+                                        encoding='latin')
+                else:
                     response['status']['success'] = False
-                    response['status']['message'] = 'command data not valid: \
-                                                        {err}'.format(err=e)
+                    if not empty:
+                        response['status']['message'] = 'packet index unknown'
+                    else:
+                        response['data'] = dict()
+                        response['status']['message'] = 'packets list empty'
+            except Exception, e:
+                response['status']['success'] = False
+                response['status']['message'] = 'command data not valid: \
+                                                    {err}'.format(err=e)
 
         # # pushpkt
         elif args['command'] == 'pushpkt':
@@ -331,23 +432,34 @@ class Plugin(BasePlugin):
 
             try:
                 packet = deepcopy(args['data'])
-                packet.update([('packet_source', Ether(packet['packet_source'])), ])
+                summary = self.packet_summary(packet['sniffer'], packet['packet_head'])
 
-                if of_message_parse:
-                    try:
-                        _packet = of_message_parse(str(packet['packet_source'].payload.payload.load))
-                        _packet = _packet.show()
-                    except Exception as e:
-                        _packet = self.packet_to_dict(packet['packet_source'])
-                else:
-                    _packet = self.packet_to_dict(packet['packet_source'])
-
-                packet.update([('packet_dict' , _packet), ])
                 with self.packetsLock:
-                    self.packets.append(packet)
+                    self.packets.append(str(packet['packet_head']['id']), summary,
+                                        str(packet['packet_source']))
 
-                if len(self.packets) >= self.packetsIndexLimit:
-                    del self.packets[:int(self.data['packetsBuffer'])]
+                response['status']['success'] = True
+            except Exception as e:
+                response['status']['success'] = False
+                response['status']['message'] = str(e)
+
+        # # pushpkts
+        # """ a frame of packets from one sniffer: json string with the
+        # sniffer, the number of packets it dropped and the packets, as
+        # [packet head, base64 raw packet] """
+        elif args['command'] == 'pushpkts':
+            response['type'] = 'pushpkts reply'
+
+            try:
+                frame = loads(str(args['data']))
+                sniffer = frame['sniffer']
+                records = [(str(head['id']), self.packet_summary(sniffer, head),
+                            a2b_base64(source)) for head, source in frame['packets']]
+
+                with self.packetsLock:
+                    for record in records:
+                        self.packets.append(*record)
+                    self.dropped[sniffer.get('hostname')] = frame.get('dropped', 0)
 
                 response['status']['success'] = True
             except Exception as e:
@@ -364,7 +476,9 @@ class Plugin(BasePlugin):
                                     user=self.user,
                                     epoch_time=str(time()).replace('.', '|'))
 
-                wrpcap(filePath, [p['packet_source'] for p in self.packets])
+                with self.packetsLock:
+                    records = self.packets.records()
+                wrpcap(filePath, [Ether(r.source) for r in records])
 
                 response = filePath
             except Exception, e:
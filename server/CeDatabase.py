@@ -1,7 +1,7 @@
 
 # File: CeDatabase.py ; This file is part of Twister.
 
-# version: 3.008
+# version: 3.009
 
 # Copyright (C) 2012-2014 , Luxoft
 
@@ -35,10 +35,14 @@ import sys
 import time
 import socket
 import platform
+import Queue
+import thread
+import threading
+import itertools
 import subprocess
 import MySQLdb
 from string import Template
-from thread import allocate_lock
+from thread import allocate_lock, start_new_thread
 
 TWISTER_PATH = os.getenv('TWISTER_PATH')
 if not TWISTER_PATH:
@@ -51,6 +55,10 @@ from common.xmlparser import DBParser
 from common.helpers import execScript
 from common.tsclogging import logDebug, logInfo, logWarning, logError
 
+# MySQL errors worth a retry: lock wait timeout, deadlock, cannot connect,
+# server has gone away, lost connection
+TRANSIENT_ERRORS = (1205, 1213, 2003, 2006, 2013)
+
 
 
 class CeDbManager(object):
@@ -59,8 +67,17 @@ class CeDbManager(object):
     """
 
     project = None   # Pointer to Project instance
-    connections = {} # Saved connections
-    db_lock = allocate_lock() # Global database lock
+    connections = {} # Saved connections, for each user + server + DB, for each thread
+    configs = {}     # Parsed DB.xml, for each user, with the stamp of the files
+    cfg_lock = allocate_lock() # Connections and configs lock
+    ping_interval = 30.0 # Idle connections are checked after this many seconds
+    jobs = {}        # Save to database jobs, by ID
+    job_events = {}  # Wake up and done events of the unfinished jobs, by ID
+    job_queues = {}  # Queue of save jobs, for each user
+    user_locks = {}  # Save lock, for each user
+    job_lock = allocate_lock() # Jobs and queues lock
+    job_ids = itertools.count(1)
+    db_retries = 3   # Retries on transient MySQL errors
 
 
     def __init__(self, project):
@@ -70,42 +87,72 @@ class CeDbManager(object):
         self.project = project
 
 
-    def connect_db(self, user, db_server='', db_name=''):
+    @staticmethod
+    def _file_stamp(fpath):
         """
-        Connect to database.
+        Modification time and size of a file, or None.
+        """
+        try:
+            fstat = os.stat(fpath)
+            return fstat.st_mtime, fstat.st_size
+        except Exception:
+            return None
+
+
+    def _db_config(self, user):
+        """
+        Returns the DB.xml + Shared DB parser for a user, the users and groups
+        and a cache of connection parameters.
+        The files are parsed again only when they change.
         """
         # Get the path to DB.XML
         db_file = self.project.get_user_info(user, 'db_config')
         if not db_file:
-            logError('Database: Null DB.XML file for user `{}`! Cannot connect!'.format(user))
-            return False
+            return None, None, None
 
-        c_time = time.time()
-        usr_server = '{}_{}_{}'.format(user, db_server, db_name)
+        users_groups = self.project._load_users_and_groups() or {}
+        shared_db_path = users_groups.get('shared_db_cfg', '')
+        stamp = (db_file, shared_db_path, self._file_stamp(db_file), self._file_stamp(shared_db_path))
 
-        # Existing connection ?
-        if self.connections.get(usr_server):
-            # This is a very fresh connection !
-            if c_time - self.connections[usr_server]['dt'] < 1.0:
-                return self.connections[usr_server]['conn']
+        with self.cfg_lock:
+            cached = self.configs.get(user)
+            if cached and cached[0] == stamp:
+                return cached[1], users_groups, cached[2]
 
         # DB.xml + Shared DB parser
-        users_groups = self.project._parse_users_and_groups()
-        shared_db_path = users_groups['shared_db_cfg']
         if os.path.isfile(shared_db_path):
-            db_config = DBParser(user, db_file, shared_db_path).db_config
+            parser = DBParser(user, db_file, shared_db_path)
         else:
-            db_config = DBParser(user, db_file).db_config
+            parser = DBParser(user, db_file)
+
+        with self.cfg_lock:
+            self.configs[user] = (stamp, parser, {})
+            return parser, users_groups, self.configs[user][2]
+
+
+    def _db_params(self, user, db_server, db_name):
+        """
+        Returns the connection parameters for a server + DB pair,
+        with the password decoded only once per DB.xml change.
+        """
+        parser, users_groups, params = self._db_config(user)
+        if not parser:
+            logError('Database: Null DB.XML file for user `{}`! Cannot connect!'.format(user))
+            return None
+        db_config = parser.db_config
 
         # Try to use the default pair
         if not db_server and not db_name:
             db_server, db_name = db_config['default_server']
 
+        if (db_server, db_name) in params:
+            return params[(db_server, db_name)]
+
         # Check server + DB pair
         if (db_server, db_name) not in db_config['servers']:
             logWarning('Database: Invalid server + DB pair {} for user `{}`! '\
                 'Cannot connect!'.format((db_server, db_name), user))
-            return False
+            return None
 
         db_user = db_config['servers'][(db_server, db_name)]['u']
         db_passwd = db_config['servers'][(db_server, db_name)]['p']
@@ -117,16 +164,64 @@ class CeDbManager(object):
         # Decode database password
         db_password = self.project.decrypt_text(user, db_passwd, encr_key)
 
+        params[(db_server, db_name)] = {'host': db_server, 'db': db_name, 'user': db_user, 'passwd': db_password}
+        return params[(db_server, db_name)]
+
+
+    def connect_db(self, user, db_server='', db_name=''):
+        """
+        Connect to database.
+        Each thread has its own connection for a user + server + DB, that is kept open;
+        a connection idle for more than `ping_interval` is checked before using it.
+        """
+        params = self._db_params(user, db_server, db_name)
+        if not params:
+            return False
+
+        c_time = time.time()
+        usr_server = '{}_{}_{}'.format(user, params['host'], params['db'])
+        thread_id = thread.get_ident()
+
+        with self.cfg_lock:
+            saved = self.connections.get(usr_server, {}).get(thread_id)
+
+        # Existing connection ? It must use the same parameters
+        if saved and saved['params'] is params:
+            try:
+                if c_time - saved['dt'] > self.ping_interval:
+                    saved['conn'].ping()
+                # End the previous transaction, so the reads are not stale
+                saved['conn'].rollback()
+                saved['dt'] = c_time
+                return saved['conn']
+            except MySQLdb.Error as e:
+                logDebug('Database: Connection for user `{}` to `{} / {}` is broken: `{}`.'.format(
+                    user, params['host'], params['db'], e))
+        if saved:
+            try:
+                saved['conn'].close()
+            except Exception:
+                pass
+
         try:
-            logDebug('User `{}` connecting to MySQL `{} @ {} / {}`...'.format(user, db_user, db_server, db_name))
-            conn = MySQLdb.connect(host=db_server, db=db_name, user=db_user, passwd=db_password)
-            conn.autocommit = False
+            logDebug('User `{}` connecting to MySQL `{} @ {} / {}`...'.format(user, params['user'], params['host'], params['db']))
+            conn = MySQLdb.connect(**params)
+            conn.autocommit(False)
         except MySQLdb.Error as e:
             logError('MySQL error for user `{}`: `{} - {}`!'.format(user, e.args[0], e.args[1]))
             return False
 
-        # Keep connection
-        self.connections[usr_server] = {'conn': conn, 'dt': c_time}
+        # Keep connection; drop the connections of the threads that ended
+        alive = set(t.ident for t in threading.enumerate())
+        with self.cfg_lock:
+            thread_conns = self.connections.setdefault(usr_server, {})
+            for ident in thread_conns.keys():
+                if ident not in alive:
+                    try:
+                        thread_conns.pop(ident)['conn'].close()
+                    except Exception:
+                        pass
+            thread_conns[thread_id] = {'conn': conn, 'dt': c_time, 'params': params}
 
         return conn
 
@@ -188,6 +283,15 @@ class CeDbManager(object):
 
             SuitesManager = ep_info['suites']
 
+            # The logs of all the files of this EP, each log is parsed once
+            ep_files = [(file_id, SuitesManager.find_id(file_id)['file']) for file_id in SuitesManager.get_files()]
+            ep_logs = {}
+            for ltype in ['logCli', 'logRunning', 'logDebug', 'logTest']:
+                try:
+                    ep_logs[ltype] = self.project.find_logs(user, ltype, ep_files, epname)
+                except Exception:
+                    ep_logs[ltype] = {}
+
             for file_id in SuitesManager.get_files():
 
                 # Default substitute data
@@ -261,30 +365,26 @@ class CeDbManager(object):
 
                 # Log CLI for this EP - Suite - Test
                 try:
-                    tc_log = self.project.find_log(user, ltype='logCli', epname=epname,
-                       file_id=file_id, file_name=file_info['file'])
+                    tc_log = ep_logs['logCli'].get(file_id, '*no log*')
                     subst_data['twister_tc_log'] = fix_log(tc_log)
                 except Exception:
                     subst_data['twister_tc_log'] = '*no log*'
 
                 # The rest of the logs
                 try:
-                    tc_log = self.project.find_log(user, ltype='logRunning', epname=epname,
-                        file_id=file_id, file_name=file_info['file'])
+                    tc_log = ep_logs['logRunning'].get(file_id, '*no log*')
                     subst_data['twister_tc_log_running'] = fix_log(tc_log)
                 except Exception:
                     subst_data['twister_tc_log_running'] = '*no log*'
 
                 try:
-                    tc_log = self.project.find_log(user, ltype='logDebug', epname=epname,
-                        file_id=file_id, file_name=file_info['file'])
+                    tc_log = ep_logs['logDebug'].get(file_id, '*no log*')
                     subst_data['twister_tc_log_debug'] = fix_log(tc_log)
                 except Exception:
                     subst_data['twister_tc_log_debug'] = '*no log*'
 
                 try:
-                    tc_log = self.project.find_log(user, ltype='logTest', epname=epname,
-                        file_id=file_id, file_name=file_info['file'])
+                    tc_log = ep_logs['logTest'].get(file_id, '*no log*')
                     subst_data['twister_tc_log_test'] = fix_log(tc_log)
                 except Exception:
                     subst_data['twister_tc_log_test'] = '*no log*'
@@ -300,22 +400,21 @@ class CeDbManager(object):
         return all_data
 
 
-    def project_data(self, user, save_to_db=False):
+    def project_data(self, user, save_to_db=False, progress=None):
         """
         Collect all data from a user, using the DB.XML for the current project.
         If save to DB is active, the function will also save.
+        The `progress` function is called with the number of files done and the total.
+        Transient MySQL errors are raised, so the save can be retried.
         """
-        # Get the path to DB.XML
-        db_file = self.project.get_user_info(user, 'db_config')
-        if not db_file:
+        parser, usr_roles, _ = self._db_config(user)
+        if not parser:
             logError('Database: Null DB.XML file for user `{}`! Nothing to do!'.format(user))
             return False
 
-        usr_roles = self.project._parse_users_and_groups()
-        shared_db_path = usr_roles['shared_db_cfg']
         db_cfg_role = 'CHANGE_DB_CFG' in usr_roles['users'][user]['roles']
         # Get inserts will automatically handle private/ shared DB.xml
-        all_inserts = DBParser(user, db_file, shared_db_path).get_inserts(db_cfg_role)
+        all_inserts = parser.get_inserts(db_cfg_role)
 
         if not all_inserts:
             logWarning('Database: Cannot use inserts defined for user `{}`!'.format(user))
@@ -331,10 +430,17 @@ class CeDbManager(object):
 
         conn, curs = None, None
 
+        # Connection and cursor for every host; all the queries of a host are one transaction
+        host_conns = {}
+        # Number of queries for every host
+        host_queries = {}
+
         # Pre-calculated data
         all_data = []
 
-        for subst_data in self.static_project_data(user):
+        static_data = self.static_project_data(user)
+
+        for file_nr, subst_data in enumerate(static_data, 1):
 
             # For every host, build correct data...
             for host_db in all_inserts:
@@ -342,10 +448,12 @@ class CeDbManager(object):
                 c_inserts = all_inserts[host_db]['inserts']
                 c_fields = all_inserts[host_db]['fields']
 
-                conn = self.connect_db(user, *host_db)
+                if host_db not in host_conns:
+                    conn = self.connect_db(user, *host_db)
+                    host_conns[host_db] = (conn, conn.cursor()) if conn else (None, None)
+                conn, curs = host_conns[host_db]
                 if not conn:
                     continue
-                curs = conn.cursor()
 
                 # Escape all unicodes variables before SQL Statements!
                 subst_data = {k: conn.escape_string(v) if isinstance(v, unicode) else v for \
@@ -440,6 +548,7 @@ class CeDbManager(object):
                         if not u_query:
                             logError('User `{}`, file `{}`: Cannot build query! Field `{}` '\
                                 'is not defined in the fields section!'.format(user, subst_data['file'], field))
+                            self._rollback(host_conns)
                             return False
 
                         # Execute User Query based on level
@@ -492,19 +601,21 @@ class CeDbManager(object):
                     except Exception as e:
                         logError('User `{}`, file `{}`: Cannot build query! '\
                             'Error on `{}`!'.format(user, subst_data['file'], e))
+                        self._rollback(host_conns)
                         return False
 
                     # Save query in database ?
                     if save_to_db:
-                        # Execute MySQL Query!
+                        # Execute MySQL Query! The commit is done once, at the end
                         try:
                             curs.execute(query)
-                            logDebug('Executed query\n\t``{}``\n\t on {} OK.'.format(query.strip(), host_db))
-                            conn.commit()
+                            host_queries[host_db] = host_queries.get(host_db, 0) + 1
                         except MySQLdb.Error as e:
                             logError('Error in query ``{}`` , for user `{}`!\n\t'\
                                 'MySQL Error {}: {}!'.format(query, user, e.args[0], e.args[1]))
-                            conn.rollback()
+                            self._rollback(host_conns)
+                            if e.args[0] in TRANSIENT_ERRORS:
+                                raise
                             return False
 
             # :: Debug ::
@@ -513,16 +624,195 @@ class CeDbManager(object):
             # Append all data for current file
             all_data.append(subst_data)
 
+            if progress:
+                progress(file_nr, len(static_data))
+
+        # One commit for every host, after all the queries of all hosts succeeded.
+        # The commits are not atomic across hosts: a host that was already committed
+        # cannot be rolled back if the commit of a later host fails.
+        if save_to_db:
+            committed = []
+            for host_db, (conn, curs) in host_conns.iteritems():
+                if not conn:
+                    continue
+                try:
+                    conn.commit()
+                    committed.append(host_db)
+                    logDebug('Executed {} queries on {} OK.'.format(host_queries.get(host_db, 0), host_db))
+                except MySQLdb.Error as e:
+                    logError('Cannot commit queries on {}, for user `{}`!\n\t'\
+                        'MySQL Error {}: {}!'.format(host_db, user, e.args[0], e.args[1]))
+                    self._rollback(host_conns)
+                    if committed:
+                        # Saving again would duplicate the data on these hosts
+                        logError('Database: The queries for user `{}` were already committed on {}; '\
+                            'the save is not retried!'.format(user, committed))
+                        return False
+                    if e.args[0] in TRANSIENT_ERRORS:
+                        raise
+                    return False
+
         return all_data
 
 
+    @staticmethod
+    def _rollback(host_conns):
+        """
+        Rollback the transactions of all hosts that are not committed yet.
+        """
+        for conn, curs in host_conns.itervalues():
+            if not conn:
+                continue
+            try:
+                conn.rollback()
+            except MySQLdb.Error:
+                pass
+
+
+    def _user_lock(self, user):
+        """
+        The save lock of a user; the saves of different users don't wait for each other.
+        """
+        with self.job_lock:
+            if user not in self.user_locks:
+                self.user_locks[user] = allocate_lock()
+            return self.user_locks[user]
+
+
+    def _save(self, user, job=None):
+        """
+        Save all data from a user, retrying on transient MySQL errors.
+        """
+        progress = None
+        if job:
+            def progress(done, total):
+                job['progress'] = (done, total)
+
+        with self._user_lock(user):
+            for attempt in range(self.db_retries + 1):
+                try:
+                    ret = self.project_data(user, True, progress)
+                    if ret:
+                        # The reports must show the new results
+                        self.project.report.invalidate_cache()
+                    return ret
+                except MySQLdb.Error as e:
+                    if e.args[0] not in TRANSIENT_ERRORS or attempt == self.db_retries:
+                        logError('Database: Cannot save for user `{}`! MySQL Error {}!'.format(user, e.args))
+                        if job:
+                            job['error'] = str(e.args)
+                        return False
+                    logWarning('Database: Transient error for user `{}`: `{}`; retry {} of {}...'.format(
+                        user, e.args, attempt + 1, self.db_retries))
+                    if job:
+                        job['retries'] = attempt + 1
+                    time.sleep(2 ** attempt)
+
+
     def save_to_database(self, user):
         """
         Save all data from a user: Ep, Suite, File, into database,
         using the DB.XML files for the current project.
         """
-        with self.db_lock:
-            return self.project_data(user, True)
+        return self._save(user)
+
+
+    def save_to_database_async(self, user, delay=0):
+        """
+        Queue a save to database for a user and return the job ID immediately.
+        The jobs of a user are executed in order, by a background worker.
+        """
+        job_id = 'db-{}'.format(next(self.job_ids))
+        job = {'id': job_id, 'user': user, 'status': 'queued', 'progress': (0, 0),
+            'retries': 0, 'error': '', 'queued': time.time(), 'started': 0, 'ended': 0}
+
+        with self.job_lock:
+            self.jobs[job_id] = job
+            self.job_events[job_id] = (threading.Event(), threading.Event())
+            # Forget the oldest finished jobs
+            finished = sorted((j['queued'], i) for i, j in self.jobs.iteritems() if j['ended'])
+            for _, old_id in finished[:-100]:
+                del self.jobs[old_id]
+            start = user not in self.job_queues
+            if start:
+                self.job_queues[user] = Queue.Queue()
+            self.job_queues[user].put((job, delay))
+
+        if start:
+            start_new_thread(self._save_worker, (user,))
+
+        logDebug('Database: Queued save job `{}` for user `{}`.'.format(job_id, user))
+        return job_id
+
+
+    def _save_worker(self, user):
+        """
+        Execute the queued save jobs of a user. The worker ends when the queue is empty.
+        """
+        queue = self.job_queues[user]
+        while 1:
+            try:
+                job, delay = queue.get(timeout=10.0)
+            except Queue.Empty:
+                with self.job_lock:
+                    if queue.empty():
+                        del self.job_queues[user]
+                        return
+                continue
+
+            wake, done = self.job_events[job['id']]
+            if delay:
+                wake.wait(delay)
+            job['status'] = 'running'
+            job['started'] = time.time()
+            try:
+                ret = self._save(user, job)
+            except Exception as e:
+                logError('Database: Save job `{}` for user `{}` crashed: `{}`!'.format(job['id'], user, e))
+                job['error'] = str(e)
+                ret = False
+            job['status'] = 'done' if ret else 'failed'
+            job['ended'] = time.time()
+            with self.job_lock:
+                del self.job_events[job['id']]
+            done.set()
+            logDebug('Database: Save job `{}` for user `{}` is {}, in {:.2f}s.'.format(
+                job['id'], user, job['status'], job['ended'] - job['started']))
+
+
+    def wait_jobs(self, user):
+        """
+        Wait until the queued and running save jobs of a user end; a delayed job starts at once.
+        Must be called before the project and the logs of the user are reset,
+        because the jobs read the live project data and log files.
+        """
+        with self.job_lock:
+            events = [ev for job_id, ev in self.job_events.iteritems() if self.jobs[job_id]['user'] == user]
+        if not events:
+            return
+        logDebug('Database: Waiting for {} save jobs of user `{}`...'.format(len(events), user))
+        for wake, done in events:
+            wake.set()
+            done.wait()
+
+
+    def save_job_status(self, job_id):
+        """
+        Returns a copy of a save job: status (queued, running, done, failed),
+        progress (files done, total files), retries and error.
+        """
+        with self.job_lock:
+            job = self.jobs.get(job_id)
+            return dict(job) if job else {}
+
+
+    def save_jobs(self, user):
+        """
+        Returns all the save jobs of a user, oldest first.
+        """
+        with self.job_lock:
+            jobs = [dict(j) for j in self.jobs.values() if j['user'] == user]
+        return sorted(jobs, key=lambda j: j['queued'])
 
 
 # Eof()
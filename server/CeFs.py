@@ -1,7 +1,7 @@
 
 # File: CeFs.py ; This file is part of Twister.
 
-# version: 3.024
+# version: 3.025
 
 # Copyright (C) 2012-2014, Luxoft
 
@@ -29,9 +29,11 @@ Local file system; used to help workign with files where user is owner
 import os, sys
 import time
 import copy
+import json
 import random
 import socket
 import subprocess
+from thread import allocate_lock, start_new_thread
 from plumbum import local
 import rpyc
 
@@ -48,6 +50,28 @@ from common.helpers    import *
 from common.tsclogging import *
 
 
+def _str_tree(node):
+    """
+    Convert the unicode strings from a parsed JSON into utf-8 strings.
+    """
+    if isinstance(node, dict):
+        return dict((_str_tree(k), _str_tree(v)) for k, v in node.iteritems())
+    if isinstance(node, list):
+        return [_str_tree(v) for v in node]
+    if isinstance(node, unicode):
+        return node.encode('utf-8')
+    return node
+
+
+def _by_value(patterns):
+    """
+    Lists must be sent as tuples, otherwise the UserService would access them remotely.
+    """
+    if isinstance(patterns, list):
+        return tuple(patterns)
+    return patterns
+
+
 class BaseFS(object):
     """
     Base file system class.
@@ -119,16 +143,19 @@ class BaseFS(object):
             return -1
 
 
-    def read_user_file(self, user, fpath, flag='r', fstart=0):
+    def read_user_file(self, user, fpath, flag='r', fstart=0, fend=None):
         """
         Read 1 file. Client access via RPyc.
+        If `fend` is defined, only the bytes from `fstart` to `fend` are read.
         """
         if not fpath:
             return '*ERROR* Empty `fpath` parameter on read file, user `{}`!'.format(user)
         srvr = self._usr_service(user)
         if srvr:
             try:
-                return srvr.root.read_file(fpath, flag, fstart)
+                if fend is None:
+                    return srvr.root.read_file(fpath, flag, fstart)
+                return srvr.root.read_file(fpath, flag, fstart, fend)
             except Exception as e:
                 err = '*ERROR* Cannot read file `{}`, user `{}`! {}'.format(fpath, user, e)
                 logWarning(err)
@@ -137,6 +164,47 @@ class BaseFS(object):
             return '*ERROR* Cannot access the UserService on read file, user `{}`!'.format(user)
 
 
+    def read_user_file_chunk(self, user, fpath, fstart=0, fsize=1024*1024, compress=False):
+        """
+        Read a chunk of 1 file, starting at `fstart`. Client access via RPyc.
+        Returns a tuple (data, file size), or an error string.
+        """
+        if not fpath:
+            return '*ERROR* Empty `fpath` parameter on read file chunk, user `{}`!'.format(user)
+        srvr = self._usr_service(user)
+        if srvr:
+            try:
+                resp = srvr.root.read_file_chunk(fpath, fstart, fsize, compress)
+            except Exception as e:
+                err = '*ERROR* Cannot read file `{}`, user `{}`! {}'.format(fpath, user, e)
+                logWarning(err)
+                return err
+            # Tuples are passed by value; strings are errors
+            if isinstance(resp, tuple):
+                return resp
+            return str(resp)
+        else:
+            return '*ERROR* Cannot access the UserService on read file chunk, user `{}`!'.format(user)
+
+
+    def iter_user_file(self, user, fpath, fstart=0, fsize=1024*1024):
+        """
+        Generator with the chunks of 1 file, so a big file is never kept in memory twice.
+        Raises IOError if a chunk cannot be read.
+        """
+        while True:
+            resp = self.read_user_file_chunk(user, fpath, fstart, fsize)
+            if not isinstance(resp, tuple):
+                raise IOError(resp)
+            data, total = resp
+            if not data:
+                break
+            yield data
+            fstart += len(data)
+            if fstart >= total:
+                break
+
+
     def write_user_file(self, user, fpath, fdata, flag='w'):
         """
         Write 1 file. Client access via RPyc.
@@ -159,6 +227,29 @@ class BaseFS(object):
             return '*ERROR* Cannot access the UserService on write file, user `{}`!'.format(user)
 
 
+    def append_user_file(self, user, fpath, fdata):
+        """
+        Append data in 1 file, kept open by the UserService. Client access via RPyc.
+        Returns the size of the file, after writing.
+        """
+        if not fpath:
+            return '*ERROR* Empty `fpath` parameter on append file, user `{}`!'.format(user)
+        srvr = self._usr_service(user, 'write')
+        if len(fdata) > 20*1000*1000:
+            err = '*ERROR* File data too long `{}`: {}; User {}.'.format(fpath, len(fdata), user)
+            logWarning(err)
+            return err
+        if srvr:
+            try:
+                return srvr.root.append_file(fpath, fdata)
+            except Exception as e:
+                err = '*ERROR* Cannot append into file `{}`, user `{}`! {}'.format(fpath, user, e)
+                logWarning(err)
+                return err
+        else:
+            return '*ERROR* Cannot access the UserService on append file, user `{}`!'.format(user)
+
+
     def copy_user_file(self, user, fpath, newpath):
         """
         Copy 1 user file.
@@ -214,13 +305,17 @@ class BaseFS(object):
     def list_user_files(self, user, fdir, hidden=True, recursive=True, accept=[], reject=[]):
         """
         List the files in user directory.
+        `recursive` can be True, False, or the number of levels.
         """
         if not fdir:
             return '*ERROR* Empty `fdir` parameter on list files, user `{}`!'.format(user)
         srvr = self._usr_service(user)
         if srvr:
             try:
-                files = srvr.root.list_files(fdir, hidden, recursive, accept, reject)
+                files = srvr.root.list_files(fdir, hidden, recursive, _by_value(accept), _by_value(reject), True)
+                # The listing is sent as JSON
+                if isinstance(files, str) and not files.startswith('*ERROR*'):
+                    return _str_tree(json.loads(files))
                 return copy.copy(files)
             except Exception as e:
                 err = '*ERROR* Cannot list files `{}`, user `{}`! {}'.format(fdir, user, e)
@@ -230,6 +325,27 @@ class BaseFS(object):
             return '*ERROR* Cannot access the UserService on list files, user `{}`!'.format(user)
 
 
+    def list_user_files_delta(self, user, fdir, token='', hidden=True, accept=[], reject=[]):
+        """
+        List the files in user directory, only the changes since the listing identified by `token`.
+        """
+        if not fdir:
+            return '*ERROR* Empty `fdir` parameter on list files, user `{}`!'.format(user)
+        srvr = self._usr_service(user)
+        if srvr:
+            try:
+                files = srvr.root.list_files_delta(fdir, token, hidden, _by_value(accept), _by_value(reject))
+                if files.startswith('*ERROR*'):
+                    return files
+                return _str_tree(json.loads(files))
+            except Exception as e:
+                err = '*ERROR* Cannot list files `{}`, user `{}`! {}'.format(fdir, user, e)
+                logWarning(err)
+                return err
+        else:
+            return '*ERROR* Cannot access the UserService on list files, user `{}`!'.format(user)
+
+
     def delete_user_folder(self, user, fdir):
         """
         Delete a user folder.
@@ -250,10 +366,25 @@ class BaseFS(object):
         if not fdir:
             return '*ERROR* Empty `fdir` parameter on tar.gz folder, user `{}`!'.format(user)
         srvr = self._usr_service(user)
-        if srvr:
-            return srvr.root.targz_folder(fdir, root)
-        else:
+        if not srvr:
             return '*ERROR* Cannot access the UserService on tar.gz folder, user `{}`!'.format(user)
+        try:
+            fpath = srvr.root.targz_folder_file(fdir, root)
+        except AttributeError:
+            # Old UserService, builds the archive in memory
+            return srvr.root.targz_folder(fdir, root)
+        fpath = str(fpath)
+        if fpath.startswith('*ERROR*'):
+            return fpath
+        # The archive is written on disk by the UserService and read back in chunks
+        try:
+            return ''.join(self.iter_user_file(user, fpath))
+        except IOError as e:
+            err = '*ERROR* Cannot read tar.gz folder `{}`, user `{}`! {}'.format(fdir, user, e)
+            logWarning(err)
+            return err
+        finally:
+            self.delete_user_file(user, fpath)
 
 
     def detect_libraries(self, user, files):
@@ -491,6 +622,143 @@ class BaseFS(object):
 
 #
 
+class UserServicePool(object):
+    """
+    A pool of RPyc connections to the User Service of 1 user.
+    Every remote call goes on the connection with the fewest calls in flight;
+    the write calls for the same path always go on the same connection, to keep their order.
+    """
+
+    def __init__(self, user, proc, port, conns):
+        self.user = user
+        self.proc = proc
+        self.port = port
+        self.conns = conns
+        self.busy = [0] * len(conns)
+        self.dead = set()
+        self.lock = allocate_lock() # Pool counters lock
+        self.stats = {'calls': 0, 'errors': 0, 'reconnects': 0, 'in_flight': 0,
+            'max_in_flight': 0, 'call_time': 0.0, 'wait_time': 0.0}
+
+
+    def alive(self):
+        """
+        The pool is usable while at least one connection is open.
+        """
+        return len(self.dead) < len(self.conns)
+
+
+    def service(self, op='read'):
+        """
+        A connection-like object: `service.root.method(...)` calls the User Service.
+        """
+        return _PoolService(self, op)
+
+
+    def call(self, op, name, args, kwargs):
+        """
+        Call a User Service method on the best connection.
+        """
+        with self.lock:
+            alive = [i for i in range(len(self.conns)) if i not in self.dead]
+            if not alive:
+                raise EOFError('All User Service connections for `{}` are closed!'.format(self.user))
+            if op == 'write' and args:
+                idx = alive[hash(args[0]) % len(alive)]
+            else:
+                idx = min(alive, key=self.busy.__getitem__)
+            self.busy[idx] += 1
+            self.stats['calls'] += 1
+            self.stats['in_flight'] += 1
+            self.stats['max_in_flight'] = max(self.stats['max_in_flight'], self.stats['in_flight'])
+            conn = self.conns[idx]
+
+        t0 = time.time()
+        try:
+            return getattr(conn.root, name)(*args, **kwargs)
+        except (EOFError, socket.error):
+            with self.lock:
+                self.stats['errors'] += 1
+                if self.conns[idx] is conn:
+                    self.dead.add(idx)
+            raise
+        finally:
+            with self.lock:
+                self.busy[idx] -= 1
+                self.stats['in_flight'] -= 1
+                self.stats['call_time'] += time.time() - t0
+
+
+    def check(self, connect):
+        """
+        Ping the idle connections and re-connect the broken ones.
+        Called by the health check thread, never by the remote calls.
+        """
+        for idx, conn in enumerate(self.conns):
+            with self.lock:
+                if self.busy[idx] and idx not in self.dead:
+                    continue
+            if idx not in self.dead:
+                try:
+                    conn.ping(data='Hello', timeout=10.0)
+                    continue
+                except Exception as e:
+                    logWarning('User Service connection {} for `{}` is broken: `{}`.'.format(idx, self.user, e))
+            new_conn = connect(self.port)
+            if not new_conn:
+                with self.lock:
+                    self.dead.add(idx)
+                continue
+            with self.lock:
+                self.conns[idx] = new_conn
+                self.dead.discard(idx)
+                self.stats['reconnects'] += 1
+            try:
+                conn.close()
+            except Exception:
+                pass
+
+
+    def close(self):
+        """
+        Close all the connections.
+        """
+        with self.lock:
+            self.dead.update(range(len(self.conns)))
+        for conn in self.conns:
+            try:
+                conn.close()
+            except Exception:
+                pass
+
+
+class _PoolService(object):
+    """
+    Behaves like a RPyc connection, for `srvr.root.method(...)`.
+    """
+
+    def __init__(self, pool, op):
+        self.root = _PoolRoot(pool, op)
+
+
+class _PoolRoot(object):
+    """
+    Sends the method calls to the connection pool.
+    """
+
+    def __init__(self, pool, op):
+        self._pool = pool
+        self._op = op
+
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        def call(*args, **kwargs):
+            return self._pool.call(self._op, name, args, kwargs)
+        return call
+
+#
+
 class LocalFS(BaseFS, FsBorg):
     """
     All local file operations should be done via THIS class.
@@ -505,30 +773,93 @@ class LocalFS(BaseFS, FsBorg):
         logInfo('Created {} FS.'.format(self.name))
 
 
+    def _pool_config(self, key, default):
+        """
+        Read a User Service pool option from `server_init.ini`.
+        """
+        try:
+            return type(default)(self.project.server_init.get(key, default))
+        except Exception:
+            return default
+
+
+    def _connect(self, port):
+        """
+        Open 1 RPyc connection to a User Service.
+        """
+        config = {
+            'allow_pickle': True,
+            'allow_getattr': True,
+            'allow_setattr': True,
+            'allow_delattr': True
+        }
+        try:
+            stream = rpyc.SocketStream.connect('127.0.0.1', port, timeout=5.0)
+            conn = rpyc.connect_stream(stream, config=config)
+            conn.root.hello()
+            return conn
+        except Exception as e:
+            logDebug('Cannot connect to User Service on port `{}`: `{}`.'.format(port, e))
+            return None
+
+
+    def _pool_loop(self):
+        """
+        Health check for the User Service pools, out of the way of the remote calls.
+        """
+        while 1:
+            time.sleep(self._pool_config('user_service_check', 10.0))
+            for user, pool in self._services.items():
+                if not pool.alive():
+                    continue
+                pool.check(self._connect)
+                if pool.stats['calls']:
+                    logDebug('User Service pool for `{}`: {}.'.format(user, self.service_stats(user)))
+
+
+    def service_stats(self, user):
+        """
+        Metrics for the User Service pool of a user: calls, errors, reconnects,
+        calls in flight, time spent in calls and time spent waiting for the pool.
+        """
+        pool = self._services.get(user)
+        if not pool:
+            return {}
+        with pool.lock:
+            stats = dict(pool.stats)
+        stats['connections'] = len(pool.conns) - len(pool.dead)
+        return stats
+
+
     def _usr_service(self, user, op='read'):
         """
-        Launch a user service.
+        Launch a user service and return a connection from the pool.
         """
         if op not in ['read', 'write']:
             logWarning('Invalid FS operation `{}`, for user `{}`! Will reset to "read".'.format(op, user))
             op = 'read'
 
+        t0 = time.time()
+
         # Must block here, so more users cannot launch Logs at the same time and lose the PID
         with self._srv_lock:
 
-            # Try to re-use the logger server, if available
-            conn = self._services.get(user, {}).get('conn_' + op, None)
-            if conn:
-                try:
-                    conn.ping(data='Hello', timeout=30.0)
-                    # logDebug('Reuse old {} User Service connection for `{}` OK.'.format(op, user))
-                    return conn
-                except Exception as e:
-                    logWarning('Cannot reuse {} User Service for `{}`: `{}`.'.format(op, user, e))
-                    self._kill(user)
+            # Re-use the pool, if available; the connections are checked by the health thread
+            pool = self._services.get(user)
+            if pool and pool.alive():
+                pool.stats['wait_time'] += time.time() - t0
+                return pool.service(op)
+            elif pool:
+                logWarning('Cannot reuse the User Service for `{}`: all connections are closed.'.format(user))
+                pool.close()
+                self._kill(user)
             else:
                 logInfo('Launching a User Service for `{}`, the first time...'.format(user))
 
+            if not getattr(self, '_pool_thread', False):
+                self._pool_thread = True
+                start_new_thread(self._pool_loop, ())
+
             port = None
 
             # If the server is not available, search for a free port in the safe range...
@@ -546,57 +877,38 @@ class LocalFS(BaseFS, FsBorg):
             proc.poll()
             time.sleep(2.0)
 
-            config = {
-                'allow_pickle': True,
-                'allow_getattr': True,
-                'allow_setattr': True,
-                'allow_delattr': True
-            }
-
+            size = max(1, self._pool_config('user_service_pool', 4))
             retry = 10
             delay = 0.5
-            success = False
+            conns = []
 
             while retry > 0:
-                if success:
-                    break
-
-                try:
-                    stream_r = rpyc.SocketStream.connect('127.0.0.1', port, timeout=5.0)
-                    conn_read = rpyc.connect_stream(stream_r, config=config)
-                    conn_read.root.hello()
-                    logDebug('Connected to User Service for `{}`, operation `read`.'.format(user))
-                    success = True
-                except Exception as e:
-                    logWarning('Cannot connect to User Service for `{}` - Exception: `{}`! '
-                            'Wait {}s...'.format(user, e, delay))
-
-                if success:
-                    try:
-                        stream_w = rpyc.SocketStream.connect('127.0.0.1', port, timeout=5.0)
-                        conn_write = rpyc.connect_stream(stream_w, config=config)
-                        conn_write.root.hello()
-                        logDebug('Connected to User Service for `{}`, operation `write`.'.format(user))
+                conn = self._connect(port)
+                if conn:
+                    conns.append(conn)
+                    logDebug('Connected to User Service for `{}`, connection {} of {}.'.format(user, len(conns), size))
+                    if len(conns) == size:
                         break
-                    except Exception as e:
-                        logWarning('Cannot connect to User Service for `{}` - Exception: `{}`! '
-                                'Wait {}s...'.format(user, e, delay))
-                        success = False
+                    continue
 
+                logWarning('Cannot connect to User Service for `{}`! Wait {}s...'.format(user, delay))
                 time.sleep(delay)
                 retry -= 1
                 delay += 0.75
 
-            if not success:
+            if not conns:
                 logError('Error on starting User Service for `{}`!'.format(user))
                 return None
 
             # Save the process inside the block.  99% of the time, this block is executed instantly!
-            self._services[user] = {'proc': proc, 'conn_read': conn_read, 'conn_write': conn_write, 'port': port}
+            pool = UserServicePool(user, proc, port, conns)
+            pool.stats['wait_time'] += time.time() - t0
+            self._services[user] = pool
 
-        logDebug('User Service for `{}` launched on `127.0.0.1:{}` - PID `{}`.'.format(user, port, proc.pid))
+        logDebug('User Service for `{}` launched on `127.0.0.1:{}` - PID `{}`, {} connections.'.format(
+            user, port, proc.pid, len(conns)))
 
-        return self._services[user].get('conn_' + op, None)
+        return pool.service(op)
 
 #
 
@@ -1,7 +1,7 @@
 
 # File: CeProject.py ; This file is part of Twister.
 
-# version: 3.066
+# version: 3.067
 
 # Copyright (C) 2012-2014 , Luxoft
 
@@ -77,6 +77,7 @@ import sys
 import re
 import time
 import datetime
+import copy
 import random
 import subprocess
 import socket
@@ -84,6 +85,7 @@ socket.setdefaulttimeout(5)
 import platform
 import smtplib
 import binascii
+import zlib
 import traceback
 import threading
 import paramiko
@@ -138,6 +140,9 @@ from CeDatabase import CeDbManager
 usrs_and_pwds = {}
 usr_pwds_lock = allocate_lock()
 
+# The START/ END markers of one test file, in the logs
+LOG_MARKER = re.compile(r'<<< (START|END) filename: `([^:`]+):[^`\n]*` >>>')
+
 #
 
 def cache_users():
@@ -245,7 +250,9 @@ class Project(object):
         self.parsers = {}
         self.test_ids = {}  # IDs shortcut
         self.suite_ids = {} # IDs shortcut
-        self.plugins = {}   # User plugins
+        self.plugins = {}   # User plugins, with their config
+        self.plugin_registry = PluginRegistry() # Parsed plugins.xml and plugin classes
+        self.roles_cache = None # Users and groups, with the file stamp
 
         self.usr_lock = allocate_lock()  # User change lock
         self.auth_lock = allocate_lock()  # Authenticate change lock
@@ -254,6 +261,14 @@ class Project(object):
         self.int_lock = allocate_lock()  # Internal use lock
         self.log_lock = allocate_lock()  # Log access lock
         self.eml_lock = allocate_lock()  # E-mail lock
+        self.dmp_lock = allocate_lock()  # Dirty users lock
+        self.wrt_lock = allocate_lock()  # Project dump write lock
+        self.liv_lock = allocate_lock()  # Live logs queue lock
+        self.lfl_lock = allocate_lock()  # Live logs flush lock
+
+        # Users that must be saved on HDD
+        self.dirty_users = set()
+        self.dump_path = '{}/config/project_users'.format(TWISTER_PATH)
 
         # Read the production/ development option.
         cfg_path = '{}/config/server_init.ini'.format(TWISTER_PATH)
@@ -273,15 +288,56 @@ class Project(object):
 
         logInfo('Running server type `{ce_server_type}`.'.format(**self.server_init))
 
+        # How often the project structure is saved on HDD, in seconds
+        try:
+            self.dump_interval = float(self.server_init.get('dump_interval', 1.0))
+        except Exception:
+            self.dump_interval = 1.0
+
+        # How many EPs are started, or stopped in parallel, and how long to wait for each EP
+        try:
+            self.ep_workers = max(1, int(self.server_init.get('ep_workers', 16)))
+        except Exception:
+            self.ep_workers = 16
+        try:
+            self.ep_timeout = float(self.server_init.get('ep_timeout', 30.0))
+        except Exception:
+            self.ep_timeout = 30.0
+
         # Panic Detect, load config for current user
         self.pdConfigPath = '{}/config/PanicDetectData.json'.format(TWISTER_PATH)
         if not os.path.isfile(self.pdConfigPath):
             with open(self.pdConfigPath, 'wb') as config:
                 config.write('{}')
+        self.panicDetectRegularExpressions = {}
+        self.pd_stamp = None   # Panic Detect file stamp
+        self.pd_engines = {}   # Compiled expressions, for each user
+        self.pd_tails = {}     # The end of the last log chunk, for each EP
+        self.pd_tail_size = 1024
+
+        # Live CLI logs, waiting to be written, for each EP
+        self.live_logs = {}
+        self.live_sizes = {}
+        self.log_plugins = {} # Plugins built for the live logs, for each user
+        # When the queue of one EP is larger than this, the EP must slow down
+        self.live_max_size = 4 * 1024 * 1024
+        self.live_interval = 0.5
+
+        # Byte offsets of the test files, in each log
+        self.log_offsets = {}
+        self.log_tails = {}
+        self.log_tail_size = 4096
 
         # Start cache users at the beggining...
         start_new_thread(cache_users, ())
 
+        # Save the dirty users in background
+        if not os.path.isdir(self.dump_path):
+            os.makedirs(self.dump_path)
+        start_new_thread(self._dump_loop, ())
+        # Write the live logs in background
+        start_new_thread(self._log_live_loop, ())
+
         logInfo('SERVER INITIALIZATION TOOK `{:.4f}` SECONDS.'.format(time.time()-ti))
 
 
@@ -417,7 +473,7 @@ class Project(object):
             logDebug('Reload Execution-Process `{}:{}` with `{}` suites and `{}` files.'.format(user, epname, len(suites), len(files)))
 
         # Save everything.
-        self._dump()
+        self._dump(user)
 
         return True
 
@@ -444,9 +500,10 @@ class Project(object):
 
             logDebug('Un-Registered Execution-Process `{}:{}`.'.format(user, epname))
             del self.users[user]['eps'][epname]
+            self.pd_tails.pop((user, epname), None)
 
         # Save everything.
-        self._dump()
+        self._dump(user)
 
         return True
 
@@ -476,6 +533,9 @@ class Project(object):
         self.suite_ids[user] = []
         # Ordered list of file IDs, used for Get Status ALL
         self.test_ids[user] = []
+        # The Panic Detect log tails of the previous run
+        for key in [k for k in self.pd_tails.keys() if k[0] == user]:
+            self.pd_tails.pop(key, None)
 
         # List with all registered EPs for this User
         epList = self.rsrv.service.exposed_registered_eps(user)
@@ -514,12 +574,12 @@ class Project(object):
         self.users[user]['bindings'] = self.parsers[user].getBindingsConfig()
 
         # Groups and roles for current user
-        self.roles = self._parse_users_and_groups()
-        if not self.roles:
+        roles = self._load_users_and_groups()
+        if not roles:
             return False
 
         # List of roles for current user
-        user_roles = self.roles['users'].get(user)
+        user_roles = roles['users'].get(user)
 
         # This user doesn't exist in users and groups
         if not user_roles:
@@ -587,7 +647,7 @@ class Project(object):
                 return False
 
         # Save everything.
-        self._dump()
+        self._dump(user)
         logInfo('Project: Registered user `{}`.'.format(user))
 
         return True
@@ -639,7 +699,7 @@ class Project(object):
                 return False
 
         # Save everything.
-        self._dump()
+        self._dump(user)
         logInfo('Project: Reload user operation took `{:.4f}` seconds.'.format(time.clock()-ti))
         return True
 
@@ -661,7 +721,8 @@ class Project(object):
             del self.test_ids[name]
             del self.suite_ids[name]
 
-        self._dump()
+        self._dump(name)
+        self._dump(new_name)
         logDebug('Project: Renamed user `{}` to `{}`...'.format(name, new_name))
 
         return True
@@ -679,7 +740,7 @@ class Project(object):
             del self.test_ids[user]
             del self.suite_ids[user]
 
-        self._dump()
+        self._dump(user)
         logDebug('Project: Deleted user `{}` ...'.format(user))
 
         return True
@@ -720,60 +781,184 @@ class Project(object):
             if not r:
                 return False
 
-        with self.auth_lock:
-
-            # Reload users and groups
-            self.roles = self._parse_users_and_groups()
-            if not self.roles:
-                return False
+        # Users and groups from cache; the lock is used only if the file changed
+        roles = self._load_users_and_groups()
+        if not roles:
+            return False
 
-            # List of roles for current CherryPy user
-            user_roles = self.roles['users'].get(user)
+        # List of roles for current CherryPy user
+        user_roles = roles['users'].get(user)
 
-            # This user doesn't exist in users and groups
-            if not user_roles:
-                # The user doesn't exist ...
-                logWarning('Production Server: Username `{}` doesn\'t have any roles!'.format(user))
-                user_roles = {'roles': [], 'groups': []}
+        # This user doesn't exist in users and groups
+        if not user_roles:
+            # The user doesn't exist ...
+            logWarning('Production Server: Username `{}` doesn\'t have any roles!'.format(user))
+            user_roles = {'roles': [], 'groups': []}
 
-            # Add the user in the dict
-            user_roles['user'] = user
+        # Add the user in the dict; the cached data must not change
+        user_roles = dict(user_roles)
+        user_roles['user'] = user
 
-            # Populate the roles in project structure
-            self.users[user]['user_groups'] = ', '.join(user_roles['groups'])
-            self.users[user]['user_roles']  = ', '.join(user_roles['roles'])
+        # Populate the roles in project structure
+        user_groups = ', '.join(user_roles['groups'])
+        if self.users[user].get('user_groups') != user_groups:
+            self.users[user]['user_groups'] = user_groups
+        user_roles_str = ', '.join(user_roles['roles'])
+        if self.users[user].get('user_roles') != user_roles_str:
+            self.users[user]['user_roles'] = user_roles_str
 
         return user_roles
 
 
-    def _dump(self):
+    def _dump(self, user=None):
         """
-        Internal function. Save all data structure on HDD.\n
-        This function must use a lock!
+        Internal function. Mark one user (or all users) to be saved on HDD.\n
+        The data is written by a background thread, every `dump_interval` seconds,
+        so the callers never wait for the disk.
         """
-        with self.int_lock:
+        with self.dmp_lock:
+            if user:
+                self.dirty_users.add(user)
+            else:
+                self.dirty_users.update(self.users.keys())
 
-            with open(TWISTER_PATH + '/config/project_users.json', 'w') as f:
-                try:
-                    json.dump(self.users, f, indent=4)
-                except Exception:
-                    pass
+
+    def _dump_user(self, user):
+        """
+        Internal function. Save the data structure of one user on HDD.\n
+        The file is written in a temporary file and renamed, so it's never half written.
+        """
+        fpath = '{}/{}.json'.format(self.dump_path, user)
+        # This user was deleted, or renamed
+        if user not in self.users:
+            try:
+                os.remove(fpath)
+            except Exception:
+                pass
+            return True
+
+        tmp_path = '{}.{}.tmp'.format(fpath, os.getpid())
+        try:
+            with open(tmp_path, 'w') as f:
+                json.dump(self.users[user], f, indent=4)
+            os.rename(tmp_path, fpath)
+            return True
+        except Exception as e:
+            logWarning('Cannot save project data for user `{}`: `{}`!'.format(user, e))
+            try:
+                os.remove(tmp_path)
+            except Exception:
+                pass
+            return False
+
+
+    def _flush_dump(self):
+        """
+        Internal function. Save all the dirty users on HDD.\n
+        This is called by the dump thread and when the server stops.
+        """
+        with self.wrt_lock:
+            with self.dmp_lock:
+                users = self.dirty_users
+                self.dirty_users = set()
+
+            failed = [user for user in users if not self._dump_user(user)]
+
+            # The structure might have changed while dumping, try again later
+            if failed:
+                with self.dmp_lock:
+                    self.dirty_users.update(failed)
+
+
+    def _dump_loop(self):
+        """
+        Internal function. Dump thread.
+        """
+        while 1:
+            time.sleep(self.dump_interval)
+            try:
+                self._flush_dump()
+            except Exception as e:
+                logWarning('Project dump thread error: `{}`!'.format(e))
+
+
+    def load_dump(self):
+        """
+        Returns the saved data structure of all users, as a JSON string.
+        """
+        data = []
+        for fname in sorted(os.listdir(self.dump_path)):
+            if not fname.endswith('.json'):
+                continue
+            try:
+                data.append('{}: {}'.format(json.dumps(fname[:-5]),
+                    open(self.dump_path + os.sep + fname, 'r').read()))
+            except Exception:
+                pass
+        return '{' + ', '.join(data) + '}'
 
 
 # # #
 
 
-    def _parse_users_and_groups(self):
+    def _load_users_and_groups(self):
         """
-        Parse users and groups and return the values.
+        Returns the parsed users and groups, from the memory cache.\n
+        The file is parsed again only if the modification time or size changed,
+        or if the cache was reset by the users and groups manager.
+        The result is shared, so it must NOT be changed by the caller!
         """
-        logFull('CeProject:_parse_users_and_groups')
         cfg_path = '{}/config/users_and_groups.ini'.format(TWISTER_PATH)
 
-        if not os.path.isfile(cfg_path):
+        try:
+            fstat = os.stat(cfg_path)
+        except Exception:
             logError('Users and Groups ERROR: Cannot find roles file in path `{}`!'.format(cfg_path))
             return False
 
+        stamp = (fstat.st_mtime, fstat.st_size)
+        # Lock-free read; the cache is replaced, never changed
+        cache = self.roles_cache
+        if cache and cache[0] == stamp:
+            return cache[1]
+
+        with self.auth_lock:
+            # Maybe another thread parsed the file in the meantime
+            cache = self.roles_cache
+            if cache and cache[0] == stamp:
+                return cache[1]
+            roles = self._read_users_and_groups(cfg_path)
+            # Don't cache the errors, try again next time
+            if roles and roles.get('users'):
+                self.roles_cache = (stamp, roles)
+            return roles
+
+
+    def _reset_users_and_groups(self):
+        """
+        Force reloading the users and groups, after editing the file.
+        """
+        self.roles_cache = None
+
+
+    def _parse_users_and_groups(self):
+        """
+        Parse users and groups and return the values.
+        This returns a copy of the cached data, so it can be changed.
+        """
+        logFull('CeProject:_parse_users_and_groups')
+        roles = self._load_users_and_groups()
+        if not roles:
+            return roles
+        return copy.deepcopy(roles)
+
+
+    def _read_users_and_groups(self, cfg_path):
+        """
+        Read and parse the users and groups file.
+        """
+        logFull('CeProject:_read_users_and_groups')
+
         try:
             cfg = iniparser.ConfigObj(cfg_path, create_empty=True, write_empty_values=True)
         except Exception as e:
@@ -923,6 +1108,7 @@ class Project(object):
                 self.roles[name] = args[0][0]
                 with self.usr_lock:
                     cfg.write()
+                self._reset_users_and_groups()
             except Exception, e:
                 return '*ERROR* : Exception : `{}` !'.format(e)
             del cfg
@@ -997,6 +1183,7 @@ class Project(object):
             cfg['users'][name]['timeout'] = usr_timeout
             with self.usr_lock:
                 cfg.write()
+            self._reset_users_and_groups()
             logDebug('Set user `{}` in group `{}`, with timeout `{}`, in Users and Groups.'.format(name, usr_group, usr_timeout))
             del cfg
 
@@ -1016,6 +1203,7 @@ class Project(object):
                 del cfg['users'][name]
                 with self.usr_lock:
                     cfg.write()
+                self._reset_users_and_groups()
             except Exception, e:
                 return '*ERROR* : Exception : `{}` !'.format(e)
             logDebug('Permanently removed user `{}` from Users and Groups.'.format(name))
@@ -1042,6 +1230,7 @@ class Project(object):
             cfg['groups'][name]['roles'] = ', '.join(roles)
             with self.usr_lock:
                 cfg.write()
+            self._reset_users_and_groups()
             logDebug('Set group `{}` with roles `{}`, in Users and Groups.'.format(name, roles))
             del cfg
             # Reload users configuration
@@ -1059,6 +1248,7 @@ class Project(object):
                 del cfg['groups'][name]
                 with self.usr_lock:
                     cfg.write()
+                self._reset_users_and_groups()
             except Exception, e:
                 return '*ERROR* : Exception : `{}` !'.format(e)
             logDebug('Permanently removed group `{}` from Users and Groups.'.format(name))
@@ -1125,12 +1315,11 @@ class Project(object):
             return TagOrView
 
 
-    @staticmethod
-    def get_clearcase_config(user, cc_key):
+    def get_clearcase_config(self, user, cc_key):
         """
         Auto detect if ClearCase Test Config Path is active.
         """
-        if 'ClearCase' in PluginParser(user).getPlugins():
+        if 'ClearCase' in self.get_plugins(user):
             # Get all ClearCase data from clearcase XML
             ccConfigs = ClearCaseParser(user).getConfigs()
             # If the key is disabled, or wrong ...
@@ -1236,6 +1425,19 @@ class Project(object):
             return self.localFs.list_user_files(user, fdir, hidden, recursive)
 
 
+    def list_files_delta(self, user, fdir, token='', hidden=True, type='fs'):
+        """
+        List files from user's home folder, or ClearCase.
+        Only the changes since the listing identified by `token` are returned.
+        """
+        if type.startswith('clearcase:'):
+            view_or_tag = ':'.join(type.split(':')[1:])
+            view_actv = self._fix_cc_xml_tag(user, view_or_tag)
+            return self.clearFs.list_user_files_delta(user +':'+ view_actv, fdir, token, hidden)
+        else:
+            return self.localFs.list_user_files_delta(user, fdir, token, hidden)
+
+
     def delete_folder(self, fdir, type='fs'):
         """
         Delete a folder from user's home folder, or ClearCase.
@@ -1424,7 +1626,7 @@ class Project(object):
             return False
 
         self.users[user][key] = value
-        self._dump()
+        self._dump(user)
         return True
 
 
@@ -1479,7 +1681,7 @@ class Project(object):
 
         try:
             self.users[user]['eps'][epname][key] = value
-            self._dump()
+            self._dump(user)
             return True
         except Exception as e:
             logWarning('Cannot set EP `{}` info `{} = {}`: `{}`!'.format(epname, key, value, e))
@@ -1500,7 +1702,7 @@ class Project(object):
         if epname not in eps:
             logDebug('Project: Invalid EP name `{}` !'.format(epname))
             return False
-        if suite_id not in eps[epname]['suites'].get_suites():
+        if not eps[epname]['suites'].has_suite(suite_id):
             logDebug('Project: Invalid Suite ID `{}` !'.format(suite_id))
             return False
 
@@ -1524,7 +1726,7 @@ class Project(object):
         if epname not in eps:
             logDebug('Project: Invalid EP name `{}` !'.format(epname))
             return False
-        if suite_id not in eps[epname]['suites'].get_suites():
+        if not eps[epname]['suites'].has_suite(suite_id):
             logDebug('Project: Invalid Suite ID `{}` !'.format(suite_id))
             return False
 
@@ -1544,7 +1746,7 @@ class Project(object):
         if epname not in eps:
             logDebug('Project: Invalid EP name `{}` !'.format(epname))
             return False
-        if suite_id not in eps[epname]['suites'].get_suites():
+        if not eps[epname]['suites'].has_suite(suite_id):
             logDebug('Project: Invalid Suite ID `{}` !'.format(suite_id))
             return False
         if not key or key == 'children':
@@ -1559,7 +1761,7 @@ class Project(object):
             logDebug('Project: Invalid Suite node `{}` !'.format(suite_id))
             return False
         suite_node[key] = value
-        self._dump()
+        self._dump(user)
         return True
 
 
@@ -1577,7 +1779,7 @@ class Project(object):
         if epname not in eps:
             logWarning('Project: Invalid EP name `{}` !'.format(epname))
             return False
-        if file_id not in eps[epname]['suites'].get_files():
+        if not eps[epname]['suites'].has_file(file_id):
             logWarning('Project: Invalid File ID `{}` !'.format(file_id))
             return False
 
@@ -1601,7 +1803,7 @@ class Project(object):
         if epname not in eps:
             logWarning('Project: Invalid EP name `{}` !'.format(epname))
             return False
-        if file_id not in eps[epname]['suites'].get_files():
+        if not eps[epname]['suites'].has_file(file_id):
             logWarning('Project: Invalid File ID `{}` !'.format(file_id))
             return False
         if not key:
@@ -1616,7 +1818,7 @@ class Project(object):
             logWarning('Project: Invalid File node `{}` !'.format(file_id))
             return False
         file_node[key] = value
-        self._dump()
+        self._dump(user)
         return True
 
 
@@ -1767,6 +1969,7 @@ class Project(object):
         reversed = dict((v, k) for k, v in EXEC_STATUS.iteritems())
 
         if ret:
+            self.rsrv.service.push_ep_status(user, {epname: reversed[new_status]})
             if msg:
                 logDebug('Status changed for EP `{} {}` - {}.\n\tMessage: `{}`.'.format(
                     user, epname, reversed[new_status], msg))
@@ -1826,24 +2029,21 @@ class Project(object):
                     db_auto_save = self.get_user_info(user, 'db_auto_save')
                     if db_auto_save and save_to_db:
                         logDebug('Project: Preparing to save into database...')
-                        time.sleep(2) # Wait all the logs
-                        ret = self.save_to_database(user)
-                        if ret:
-                            logDebug('Project: Saving to database was successful!')
+                        # Saved in background, after 2 seconds, to wait all the logs
+                        job_id = self.save_to_database_async(user, delay=2)
+                        if job_id:
+                            logDebug('Project: Saving to database in background, job `{}`.'.format(job_id))
                         else:
                             logDebug('Project: Could not save to database!')
 
                     # Execute "onStop" for all plugins!
-                    parser = PluginParser(user)
-                    plugins = parser.getPlugins()
-                    for pname in plugins:
+                    for pname in self.get_plugins(user):
                         plugin = self._build_plugin(user, pname,  {'ce_stop': 'automatic'})
                         try:
                             plugin.onStop()
                         except Exception:
                             trace = traceback.format_exc()[33:].strip()
                             logWarning('Error on running plugin `{} onStop` - Exception: `{}`!'.format(pname, trace))
-                    del parser, plugins
 
                     # Cycle all files to change the PENDING status to NOT_EXEC
                     eps_pointer = self.users[user]['eps']
@@ -1907,6 +2107,9 @@ class Project(object):
         # This will always happen when the START button is pressed, if CE is stopped
         if executionStatus in [STATUS_STOP, STATUS_INVALID] and new_status == STATUS_RUNNING:
 
+            # The save to database from the previous stop must finish before the reset
+            self.dbmgr.wait_jobs(user)
+
             proj_reset = False
 
             # If the Msg contains 2 paths, separated by comma
@@ -1957,16 +2160,15 @@ class Project(object):
                     return reversed[STATUS_STOP]
 
             # Execute "onStart" for all plugins!
-            parser = PluginParser(user)
-            plugins = parser.getPlugins()
-            for pname in plugins:
-                plugin = self._build_plugin(user, pname)
+            # The live logs must use the new plugins
+            self.log_plugins.pop(user, None)
+            for pname in self.get_plugins(user):
+                plugin = self._build_plugin(user, pname, refresh=True)
                 try:
                     plugin.onStart()
                 except Exception:
                     trace = traceback.format_exc()[34:].strip()
                     logWarning('Error on running plugin `{} onStart` - Exception: `{}`!'.format(pname, trace))
-            del parser, plugins
 
             if not real_eps:
                 msg = '*ERROR* User `{}` doesn\'t have any '\
@@ -2016,16 +2218,20 @@ class Project(object):
                         del self.users[user]['eps'][epname]
                     # The new name
                     epname = anonim_ep
-                # Set the NEW EP status
-                self.set_ep_info(user, epname, 'status', new_status)
-                # Send START to EP Manager
-                resp = rpyc_srv.exposed_start_ep(epname, user)
-                started_eps.append(resp)
-                if not resp:
-                    # Reset the EP status to stop
-                    self.set_ep_info(user, epname, 'status', STATUS_STOP)
-
-            if True not in started_eps:
+                started_eps.append(epname)
+
+            # Set the NEW status for all EPs
+            self._set_eps_status(user, started_eps, new_status)
+            # Send START to all EP Managers, in parallel
+            results = self._call_eps(user, started_eps, rpyc_srv.exposed_start_ep)
+
+            failed_eps = [epname for epname in started_eps if not results.get(epname)]
+            if failed_eps:
+                # Reset the EP status to stop
+                self._set_eps_status(user, failed_eps, STATUS_STOP)
+                logWarning('User `{}` cannot start EPs: {}.'.format(user, failed_eps))
+
+            if True not in results.values():
                 msg = '*ERROR* Cannot start the EPs for User `{}`!'.format(user)
                 logError(msg)
                 return msg
@@ -2044,16 +2250,13 @@ class Project(object):
                     logError('Post Script failed!')
 
             # Execute "onStop" for all plugins... ?
-            parser = PluginParser(user)
-            plugins = parser.getPlugins()
-            for pname in plugins:
+            for pname in self.get_plugins(user):
                 plugin = self._build_plugin(user, pname, {'ce_stop': 'manual'})
                 try:
                     plugin.onStop()
                 except Exception:
                     trace = traceback.format_exc()[34:].strip()
                     logWarning('Error on running plugin `{} onStop` - Exception: `{}`!'.format(pname, trace))
-            del parser, plugins
 
             # Backup the logs when user pressed STOP
             self.backup_logs(user)
@@ -2065,6 +2268,7 @@ class Project(object):
 
             eps_pointer = self.users[user]['eps']
             statuses_changed = 0
+            stopped_eps = []
 
             for epname in project_eps:
                 if epname == '__anonymous__' and anonim_ep:
@@ -2072,18 +2276,28 @@ class Project(object):
                     epname = anonim_ep
                 elif epname not in real_eps:
                     continue
-                # All files, for current EP
-                files = eps_pointer[epname]['suites'].get_files()
-                for file_id in files:
-                    current_status = self.get_file_info(user, epname, file_id).get('status', -1)
-                    # Change the files with PENDING status, to NOT_EXEC
-                    if current_status in [STATUS_PENDING, -1]:
-                        self.set_file_info(user, epname, file_id, 'status', STATUS_NOT_EXEC)
-                        statuses_changed += 1
-                # Set the NEW EP status
-                self.set_ep_info(user, epname, 'status', new_status)
-                # Send STOP to EP Manager
-                rpyc_srv.exposed_stop_ep(epname, user)
+                if epname in eps_pointer:
+                    stopped_eps.append(epname)
+
+            with self.stt_lock:
+                for epname in stopped_eps:
+                    suites = eps_pointer[epname]['suites']
+                    # All files, for current EP
+                    for file_id in suites.get_files():
+                        file_node = suites.find_id(file_id)
+                        # Change the files with PENDING status, to NOT_EXEC
+                        if file_node is not None and file_node.get('status', -1) in [STATUS_PENDING, -1]:
+                            file_node['status'] = STATUS_NOT_EXEC
+                            statuses_changed += 1
+
+            # Set the NEW status for all EPs; this also saves the file statuses
+            self._set_eps_status(user, stopped_eps, new_status)
+            # Send STOP to all EP Managers, in parallel
+            results = self._call_eps(user, stopped_eps, rpyc_srv.exposed_stop_ep)
+
+            failed_eps = [epname for epname in stopped_eps if not results.get(epname)]
+            if failed_eps:
+                logWarning('User `{}` cannot stop EPs: {}.'.format(user, failed_eps))
 
             if statuses_changed:
                 logDebug('User `{}` changed `{}` file statuses from '
@@ -2093,11 +2307,8 @@ class Project(object):
         else:
             # Change status on all project and real EPs !
             project_eps = self.parsers[user].getActiveEps()
-            for epname in project_eps:
-                if epname not in real_eps:
-                    continue
-                # Set the NEW EP status
-                self.set_ep_info(user, epname, 'status', new_status)
+            # Set the NEW status for all EPs
+            self._set_eps_status(user, [ep for ep in project_eps if ep in real_eps], new_status)
 
         # All active EPs for this project, refresh after all settings...
         project_eps = self.parsers[user].getActiveEps()
@@ -2116,6 +2327,58 @@ class Project(object):
         return reversed[new_status]
 
 
+    def _set_eps_status(self, user, epnames, new_status):
+        """
+        Internal function. Set the status for a list of EPs, at once.
+        The project is saved only once.
+        """
+        eps = self.users[user]['eps']
+        with self.stt_lock:
+            for epname in epnames:
+                if epname in eps:
+                    eps[epname]['status'] = new_status
+        self._dump(user)
+
+        # The EPs waiting for a new status don't have to ask for it
+        reversed = dict((v, k) for k, v in EXEC_STATUS.iteritems())
+        self.rsrv.service.push_ep_status(user, dict((ep, reversed[new_status]) for ep in epnames))
+
+
+    def _call_eps(self, user, epnames, func):
+        """
+        Internal function. Call `func(epname, user, timeout)` for a list of EPs,
+        using at most `ep_workers` threads. Used to start and stop the EPs.
+        Returns a dict with the result for each EP; the result is False if the call failed.
+        """
+        results = {}
+        pending = list(epnames)[::-1]
+        res_lock = allocate_lock()  # Pending EPs and results lock
+
+        def worker():
+            while 1:
+                with res_lock:
+                    if not pending:
+                        return
+                    epname = pending.pop()
+                try:
+                    result = func(epname, user, self.ep_timeout)
+                except Exception as e:
+                    logWarning('User `{}`, EP `{}` call error: `{}`!'.format(user, epname, e))
+                    result = False
+                with res_lock:
+                    results[epname] = result
+
+        workers = [threading.Thread(target=worker) for _ in range(min(self.ep_workers, len(epnames)))]
+        for thr in workers:
+            thr.start()
+        for thr in workers:
+            thr.join()
+
+        logDebug('User `{}` called `{}` for `{}` EPs: `{}` successful.'.format(user, func.__name__,
+            len(epnames), len([ep for ep in results if results[ep]])))
+        return results
+
+
     def get_file_status_all(self, user, epname=None, suite_id=None):
         """
         Return the status of all files, in order.
@@ -2182,6 +2445,62 @@ class Project(object):
         return final
 
 
+    def _apply_file_status(self, user, epname, file_node, new_status, time_elapsed=0.0):
+        """
+        Helper function. Change the status of one file node, without any checks.\n
+        Returns the status string and the message for the summary log.
+        """
+        filename = os.path.split(file_node['file'])[1]
+
+        # Sets file status
+        file_node['status'] = new_status
+        reversed = dict((v, k) for k, v in testStatus.iteritems())
+        status_str = reversed[new_status]
+
+        # Write all statuses in logs, because all files will be saved to database
+        if status_str == 'not executed':
+            status_str = '*NO EXEC*'
+        else:
+            status_str = '*%s*' % status_str.upper()
+
+        if new_status == STATUS_WORKING:
+            return status_str, ''
+
+        # Inject information into Files. This will be used when saving into database.
+        now = datetime.datetime.today()
+
+        file_node['twister_tc_status'] = status_str.replace('*', '')
+        file_node['twister_tc_crash_detected'] = file_node.get('twister_tc_crash_detected', 0)
+        file_node['twister_tc_time_elapsed']   = int(time_elapsed)
+        file_node['twister_tc_date_started']   = (now - datetime.timedelta(seconds=time_elapsed)).isoformat()
+        file_node['twister_tc_date_finished']  = now.isoformat()
+
+        suite_node = self.users[user]['eps'][epname]['suites'].find_id(file_node['suite']) or {}
+        suite_name = suite_node.get('name') or ''
+
+        logMessage = ' {ep}::{suite}::{file} | {status} | {elapsed} | {date}\n'.format(
+                ep = epname.center(9), suite = suite_name.center(9), file = filename.center(28),
+                status = status_str.center(11),
+                elapsed = ('%.2fs' % time_elapsed).center(10),
+                date = now.strftime('%a %b %d, %H:%M:%S'))
+
+        return status_str, logMessage
+
+
+    def _write_summary(self, user, logMessage):
+        """
+        Helper function. Append one message in the summary log.
+        """
+        # Get logSummary path from framework config
+        logPath = self.users[user]['log_types']['logSummary']
+        resp = self.localFs.write_user_file(user, logPath, logMessage, 'a')
+
+        if isinstance(resp, str):
+            logError('Summary log file for `{}` cannot be written! User won\'t see any statistics!'.format(user))
+            return False
+        return True
+
+
     def set_file_status(self, user, epname, file_id, new_status=10, time_elapsed=0.0):
         """
         Set status for one file and write in log summary.
@@ -2205,49 +2524,84 @@ class Project(object):
             logDebug('Project: Invalid File ID `{}` !'.format(file_id))
             return False
 
-        filename = os.path.split(data['file'])[1]
-        suite = data['suite']
+        status_str, logMessage = self._apply_file_status(user, epname, data, new_status, time_elapsed)
+        self._dump(user)
+        # The EPs waiting for this file don't have to ask for it
+        self.rsrv.service.push_file_status(user, epname, file_id, new_status)
 
-        # Sets file status
-        self.set_file_info(user, epname, file_id, 'status', new_status)
-        reversed = dict((v, k) for k, v in testStatus.iteritems())
-        status_str = reversed[new_status]
+        if logMessage:
+            self._write_summary(user, logMessage)
+
+        # Return string
+        return status_str
 
-        # Write all statuses in logs, because all files will be saved to database
-        if status_str == 'not executed':
-            status_str = '*NO EXEC*'
-        else:
-            status_str = '*%s*' % status_str.upper()
 
-        if new_status != STATUS_WORKING:
+    def report_file_result(self, user, epname, file_id, new_status=None, time_elapsed=0.0, variables=None, log_msg=''):
+        """
+        Bulk update for one file, called by the EP before and after running a test.\n
+        Sets the custom file variables (eg: `_reason`), the file status
+        (if the status is not None) and the `last seen alive` flag of the EP,
+        then writes the message (eg: the START/ END markers) in the test logs.\n
+        Returns a pair with the file status string and the EP status string.
+        """
+        logFull('CeProject:report_file_result user `{}`.'.format(user))
+        r = self.authenticate(user)
+        if not r:
+            return False
+        eps = self.users[user]['eps']
 
-            # Inject information into Files. This will be used when saving into database.
-            now = datetime.datetime.today()
+        if epname not in eps:
+            logWarning('Project: Invalid EP name `{}` !'.format(epname))
+            return False
+        if not eps[epname]['suites'].has_file(file_id):
+            logWarning('Project: Invalid File ID `{}` !'.format(file_id))
+            return False
+        if new_status is not None and new_status not in testStatus.values():
+            logError('Project: Status value `{}` is not in the list of defined statuses: `{}`!'
+                     ''.format(new_status, sorted(testStatus.values())) )
+            return False
 
-            self.set_file_info(user, epname, file_id, 'twister_tc_status', status_str.replace('*', ''))
-            self.set_file_info(user, epname, file_id, 'twister_tc_crash_detected',
-                                    data.get('twister_tc_crash_detected', 0))
-            self.set_file_info(user, epname, file_id, 'twister_tc_time_elapsed',   int(time_elapsed))
-            self.set_file_info(user, epname, file_id, 'twister_tc_date_started',
-                                    (now - datetime.timedelta(seconds=time_elapsed)).isoformat())
-            self.set_file_info(user, epname, file_id, 'twister_tc_date_finished',  (now.isoformat()))
-            suite_name = self.get_suite_info(user, epname, suite).get('name')
+        # A dict, or a sequence of (key, value) pairs
+        variables = dict(variables or ())
+        status_str = None
+        logMessage = ''
 
-            logMessage = ' {ep}::{suite}::{file} | {status} | {elapsed} | {date}\n'.format(
-                    ep = epname.center(9), suite = suite_name.center(9), file = filename.center(28),
-                    status = status_str.center(11),
-                    elapsed = ('%.2fs' % time_elapsed).center(10),
-                    date = now.strftime('%a %b %d, %H:%M:%S'))
+        # This operation must be atomic !
+        with self.stt_lock:
+            file_node = eps[epname]['suites'].find_id(file_id)
 
-            # Get logSummary path from framework config
-            logPath = self.get_user_info(user, 'log_types')['logSummary']
-            resp = self.localFs.write_user_file(user, logPath, logMessage, 'a')
+            # Custom variables must be set before the status (eg: crash detected)
+            for key, value in variables.iteritems():
+                if not key or key == 'type':
+                    logWarning('Project: Invalid Key `{}` !'.format(key))
+                    continue
+                file_node[key] = value
 
-            if isinstance(resp, str):
-                logError('Summary log file for `{}` cannot be written! User won\'t see any statistics!'.format(user))
+            if new_status is not None:
+                status_str, logMessage = self._apply_file_status(user, epname, file_node,
+                    new_status, time_elapsed)
 
-        # Return string
-        return status_str
+            eps[epname]['last_seen_alive'] = time.strftime('%Y-%m-%d %H:%M:%S')
+            ep_status = eps[epname].get('status', STATUS_INVALID)
+
+        self._dump(user)
+        # The EPs waiting for this file don't have to ask for it
+        if new_status is not None:
+            self.rsrv.service.push_file_status(user, epname, file_id, new_status)
+
+        if logMessage:
+            self._write_summary(user, logMessage)
+
+        if log_msg:
+            log_types = self.users[user]['log_types']
+            for log_type in ['logRunning', 'logDebug', 'logTest']:
+                if log_type in log_types:
+                    log_size = self.localFs.append_user_file(user, log_types[log_type], log_msg)
+                    # The message is written in one piece, the markers cannot be split
+                    self._log_offsets_scan(user, log_types[log_type], log_msg, log_size, False)
+
+        reversed = dict((v, k) for k, v in EXEC_STATUS.iteritems())
+        return (status_str, reversed.get(ep_status, 'invalid'))
 
 
     def set_file_status_all(self, user, epname=None, new_status=10):
@@ -2397,13 +2751,12 @@ class Project(object):
             finfo['Runnable'] = "true"
 
             # Add file for the user, in a specific suite
-            suite = SuitesManager.find_id(suite_id)
-            suite['children'][file_id] = finfo
+            SuitesManager.add_file(suite_id, file_id, finfo)
 
             # Add the file in suites.xml ?
             # self.setPersistentFile(self, user, suite, fname)
 
-        self._dump()
+        self._dump(user)
         logDebug('File ID `{}` added at the end of suite `{}`.'.format(file_id, suite_id))
         return True
 
@@ -2458,7 +2811,7 @@ class Project(object):
             # All files from Suite ID
             suite_id = rest
 
-            if suite_id not in SuitesManager.get_suites():
+            if not SuitesManager.has_suite(suite_id):
                 log = '*ERROR* Invalid Suite ID `{}` !'.format(suite_id)
                 logError(log)
                 return log
@@ -2472,7 +2825,7 @@ class Project(object):
             file_id = rest
             suite_id = None
 
-            if file_id not in SuitesManager.get_files(None, True):
+            if not SuitesManager.has_file(file_id):
                 log = '*ERROR* Invalid File ID `{}` !'.format(file_id)
                 logError(log)
                 return log
@@ -2534,9 +2887,9 @@ class Project(object):
                 file_index = self.test_ids[user].index(file_id)
                 self.test_ids[user].pop(file_index)
                 # Remove file from suites
-                del suite_node['children'][file_id]
+                SuitesManager.del_file(file_id)
 
-        self._dump()
+        self._dump(user)
         return ', '.join(files)
 
 
@@ -2918,10 +3271,60 @@ class Project(object):
         return self.dbmgr.save_to_database(user)
 
 
-    def _build_plugin(self, user, plugin, extra_data={}):
+    def save_to_database_async(self, user, delay=0):
+        """
+        Queue a save to database for a user, in background.
+        Returns the job ID; the job is followed with `save_job_status`.
+        """
+        logFull('CeProject:save_to_database_async user `{}`.'.format(user))
+        r = self.authenticate(user)
+        if not r:
+            return False
+        return self.dbmgr.save_to_database_async(user, delay)
+
+
+    def save_job_status(self, user, job_id=''):
+        """
+        Status and progress of a save to database job,
+        or all the jobs of the user, if the job ID is empty.
+        """
+        logFull('CeProject:save_job_status user `{}`.'.format(user))
+        if not job_id:
+            return self.dbmgr.save_jobs(user)
+        job = self.dbmgr.save_job_status(job_id)
+        if job.get('user') != user:
+            return '*ERROR* Invalid job ID `{}`, for user `{}`!'.format(job_id, user)
+        return job
+
+
+    def get_plugins(self, user):
         """
-        Parses the list of plugins and creates an instance of the requested plugin.
-        All the data is reloaded from plugins.xml, every time.
+        All the enabled plugins of the user, from the plugin registry.
+        plugins.xml and the plugin files are loaded again only when they change.
+        """
+        return self.plugin_registry.getPlugins(user)
+
+
+    def reload_plugins(self, user):
+        """
+        Reload plugins.xml and all the plugin modules of the user,
+        and drop the plugin instances; they will be created again, on the next call.
+        """
+        logDebug('CeProject:reload_plugins user `{}`.'.format(user))
+        self.plugin_registry.reload(user)
+        for key in self.plugins.keys():
+            if key.split(' ')[0] == user:
+                self.plugins.pop(key, None)
+        self.log_plugins.pop(user, None)
+        return True
+
+
+    def _build_plugin(self, user, plugin, extra_data={}, refresh=False):
+        """
+        Creates an instance of the requested plugin, or re-uses the old instance.
+        If plugins.xml, or the plugin file were changed, the plugin data is updated;
+        if the plugin file was changed, the plug-in is recreated.
+        The data is also updated when there is extra_data, or on refresh.
         If the `_plugin_reload` key is found in the extra_data, the plug-in must be recreated.
         """
         logFull('CeProject:_build_plugin user `{}`.'.format(user))
@@ -2929,17 +3332,21 @@ class Project(object):
         key = user +' '+ plugin
         plug_ptr = False
 
-        # If the plug-in was already created, re-use it, unless it is Forced to Reload
-        if key in self.plugins and '_plugin_reload' not in extra_data:
-            plug_ptr = self.plugins.get(key)
-
-        parser = PluginParser(user)
         # All the info about the current plug
-        pdict = parser.getPlugins().get(plugin)
+        pdict = self.get_plugins(user).get(plugin)
         if not pdict:
             logError('Plug-ins: Cannot find plug-in name `{}`!'.format(plugin))
             return False
-        del parser
+
+        # If the plug-in was already created, re-use it, unless it is Forced to Reload
+        if key in self.plugins and '_plugin_reload' not in extra_data:
+            plug_conf, plug_ptr = self.plugins[key]
+            # Nothing changed, the plug-in is ready
+            if plug_conf is pdict and not (extra_data or refresh):
+                return plug_ptr
+            # The plugin module was reloaded, the old instance is useless
+            if plug_ptr.__class__ is not pdict['plugin']:
+                plug_ptr = False
 
         data = dict(self.get_user_info(user))
         data.update(pdict)
@@ -2975,7 +3382,7 @@ class Project(object):
                 logError('Plug-ins: Warning! Overwriting the `data` attr from plug-in `{}`!'.format(plugin))
             plugin = plug_ptr
 
-        self.plugins[key] = plugin
+        self.plugins[key] = (pdict, plugin)
         return plugin
 
 
@@ -3023,9 +3430,60 @@ class Project(object):
         return binascii.b2a_base64(data)
 
 
-    def find_log(self, user, ltype, file_id, file_name, epname=None):
+    def _log_offsets_scan(self, user, log_path, log_string, log_size, split=True):
+        """
+        Internal function. Records the byte offsets of the START/ END markers
+        found in a chunk that was just appended in a log, so `find_log` can read
+        only the slice of one test file.\n
+        `log_size` is the size of the log, after writing the chunk.
+        If the markers can be `split` between chunks, the end of the previous chunk is kept.
+        """
+        # The append failed
+        if isinstance(log_size, str) or log_size is None:
+            return False
+
+        key = (user, log_path)
+        tail = ''
+        if split:
+            tail = self.log_tails.get(key, '')
+            self.log_tails[key] = (tail + log_string)[-self.log_tail_size:]
+        text = tail + log_string
+
+        if '<<< ' not in text:
+            return True
+
+        base = log_size - len(text)
+        offsets = self.log_offsets.setdefault(key, {})
+
+        for match in LOG_MARKER.finditer(text):
+            # This marker was found in the previous chunk
+            if match.end() <= len(tail):
+                continue
+            file_id = match.group(2)
+            if match.group(1) == 'START':
+                offsets[file_id] = [base + match.start(), None]
+            elif file_id in offsets:
+                offsets[file_id][1] = base + match.end()
+
+        return True
+
+
+    def _log_offsets_reset(self, user, log_name=None):
+        """
+        Internal function. Forget the byte offsets of one log, or all the logs of a user.
+        """
+        for key in self.log_offsets.keys() + self.log_tails.keys():
+            if key[0] != user:
+                continue
+            if log_name and os.path.split(key[1])[1] != log_name:
+                continue
+            self.log_offsets.pop(key, None)
+            self.log_tails.pop(key, None)
+
+
+    def _find_log_path(self, user, ltype, epname=None):
         """
-        Parses the log file of one EP and returns the log of one test file.
+        Internal function. Returns the path of one log type, or None.
         """
         log_folder = self.get_user_info(user, 'logs_path')
         log_types  = self.get_user_info(user, 'log_types')
@@ -3033,28 +3491,109 @@ class Project(object):
         if ltype == 'logCli':
             _, logCli = os.path.split(log_types.get(ltype, 'CLI.log'))
             # Logs Path + EP Name + CLI Name
-            logPath = log_folder + os.sep + epname +'_'+ logCli
+            return log_folder + os.sep + epname +'_'+ logCli
         elif ltype in log_types:
-            logPath = log_types[ltype]
+            return log_types[ltype]
         else:
             logDebug('Find Log: Cannot find log type `{}` for user `{}`!'.format(ltype, user))
+            return None
+
+
+    def _find_log_range(self, user, logPath, file_id, file_name):
+        """
+        Internal function. Read the log of one test file, using the recorded byte offsets.
+        Returns None if the offsets are not known, or they are not valid anymore.
+        """
+        offsets = self.log_offsets.get((user, logPath), {}).get(file_id)
+        if not offsets or not offsets[1]:
+            return None
+
+        data = self.localFs.read_user_file(user, logPath, 'r', offsets[0], offsets[1])
+
+        if data.startswith('<<< START filename: `{}:{}'.format(file_id, file_name)):
+            return data
+
+        logDebug('Find Log: Invalid offsets for `{}:{}` in log `{}`!'.format(file_id, file_name, logPath))
+        return None
+
+
+    @staticmethod
+    def _find_log_slice(data, file_id, file_name):
+        """
+        Internal function. Search the log of one test file in the complete log.
+        """
+        fbegin = data.find('<<< START filename: `{}:{}'.format(file_id, file_name))
+        if fbegin == -1:
+            return None
+
+        fend = data.find('<<< END filename: `{}:{}'.format(file_id, file_name))
+        fend += len('<<< END filename: `{}:{}` >>>'.format(file_id, file_name))
+
+        return data[fbegin:fend]
+
+
+    def find_log(self, user, ltype, file_id, file_name, epname=None):
+        """
+        Returns the log of one test file, from the log file of one EP.\n
+        If the offsets of the file were recorded, only the slice of the test is read,
+        otherwise, the complete log is parsed.
+        """
+        logPath = self._find_log_path(user, ltype, epname)
+        if not logPath:
             return '*no log*'
 
+        data = self._find_log_range(user, logPath, file_id, file_name)
+        if data is not None:
+            return data
+
         data = self.localFs.read_user_file(user, logPath)
 
         if data.startswith('*ERROR*'):
             logDebug(data)
             return '*no log*'
 
-        fbegin = data.find('<<< START filename: `{}:{}'.format(file_id, file_name))
-        if fbegin == -1:
+        data = self._find_log_slice(data, file_id, file_name)
+        if data is None:
             logDebug('Find Log: Cannot find `{}:{}` in log `{}`!'.format(file_id, file_name, logPath))
             return '*no log*'
 
-        fend = data.find('<<< END filename: `{}:{}'.format(file_id, file_name))
-        fend += len('<<< END filename: `{}:{}` >>>'.format(file_id, file_name))
+        return data
 
-        return data[fbegin:fend]
+
+    def find_logs(self, user, ltype, files, epname=None):
+        """
+        Returns the logs of many test files, from the log file of one EP.\n
+        `files` is a list of pairs (file ID, file name); the result is a dictionary
+        of file ID -> log. The complete log is parsed at most once,
+        for the files without recorded offsets.
+        """
+        logPath = self._find_log_path(user, ltype, epname)
+        if not logPath:
+            return dict((file_id, '*no log*') for file_id, _ in files)
+
+        result = {}
+        missing = []
+
+        for file_id, file_name in files:
+            data = self._find_log_range(user, logPath, file_id, file_name)
+            if data is None:
+                missing.append((file_id, file_name))
+            else:
+                result[file_id] = data
+
+        if not missing:
+            return result
+
+        data = self.localFs.read_user_file(user, logPath)
+
+        if data.startswith('*ERROR*'):
+            logDebug(data)
+            data = ''
+
+        for file_id, file_name in missing:
+            result[file_id] = self._find_log_slice(data, file_id, file_name) or '*no log*'
+
+        return result
 
 
     def log_message(self, user, logType, logMessage):
@@ -3082,36 +3621,101 @@ class Project(object):
     def log_live(self, user, epname, logMessage):
         """
         Writes CLI messages in a big log, so all output can be checked LIVE.\n
-        Called from the EP.
+        Called from the EP. The message is base64 encoded.
         """
         logFull('CeProject:log_live user `{}`.'.format(user))
 
-        logFolder = self.get_user_info(user, 'logs_path')
+        try:
+            log_string = binascii.a2b_base64(logMessage)
+        except Exception:
+            logError('Log Error for `{}`: Invalid base64 log!'.format(user))
+            return False
 
-        if not logFolder:
-            logError('Log Error for `{}`! Invalid logs folder `{}`!'.format(user, logFolder))
+        r = self._log_live_queue(user, epname, log_string)
+        if isinstance(r, str):
             return False
+        return True
+
+
+    def log_live_stream(self, user, epname, frame, compressed=True):
+        """
+        Writes CLI messages in a big log, so all output can be checked LIVE.\n
+        Called from the EP. The frame is binary, usually compressed with zlib.
+        The frames are queued and written in background; the result is the number of seconds
+        the EP should wait before sending the next frame, or an error string.
+        """
+        logFull('CeProject:log_live_stream user `{}`.'.format(user))
+
+        if compressed:
+            try:
+                frame = zlib.decompress(frame)
+            except Exception as e:
+                err = '*ERROR* Log Error for `{}`: Invalid compressed log: `{}`!'.format(user, e)
+                logError(err)
+                return err
+
+        return self._log_live_queue(user, epname, frame)
+
 
+    def _log_live_queue(self, user, epname, log_string):
+        """
+        Internal function. Queue a chunk of CLI log, for one EP.\n
+        Returns the back pressure delay for the EP, in seconds.
+        """
         if epname not in self.users[user]['eps']:
-            logError('Log Error for `{}`: Invalid EP name `{}` !'.format(user, epname))
-            return False
+            err = '*ERROR* Log Error for `{}`: Invalid EP name `{}` !'.format(user, epname)
+            logError(err)
+            return err
 
-        try:
-            log_string = binascii.a2b_base64(logMessage)
-        except Exception:
-            logError('Log Error for `{}`: Invalid base64 log!'.format(user))
+        if not log_string:
+            return 0.0
+
+        key = (user, epname)
+        with self.liv_lock:
+            self.live_logs.setdefault(key, []).append(log_string)
+            size = self.live_sizes.get(key, 0) + len(log_string)
+            self.live_sizes[key] = size
+
+        if size <= self.live_max_size:
+            return 0.0
+        # The EP is too chatty; the writer thread needs time
+        return min(5.0, self.live_interval * size / self.live_max_size)
+
+
+    def _log_live_plugins(self, user):
+        """
+        Internal function. Returns the plugins used for the live logs.
+        They are built once for each user, and rebuilt when a new execution starts.
+        """
+        plugins = self.log_plugins.get(user)
+        if plugins is None:
+            plugins = []
+            for pname in self.get_plugins(user):
+                plugin = self._build_plugin(user, pname, {'log_type': 'cli'})
+                if plugin:
+                    plugins.append((pname, plugin))
+            self.log_plugins[user] = plugins
+        return plugins
+
+
+    def _log_live_write(self, user, epname, log_string):
+        """
+        Internal function. Run the plugins and the Panic Detect on a chunk of CLI log,
+        then append it to the log of the EP.
+        """
+        logFolder = self.get_user_info(user, 'logs_path')
+
+        if not logFolder:
+            logError('Log Error for `{}`! Invalid logs folder `{}`!'.format(user, logFolder))
             return False
 
         # Execute "onLog" for all plugins
-        plugins = PluginParser(user).getPlugins()
-        for pname in plugins:
-            plugin = self._build_plugin(user, pname, {'log_type': 'cli'})
+        for pname, plugin in self._log_live_plugins(user):
             try:
                 plugin.onLog(epname, log_string)
             except Exception as e:
                 trace = traceback.format_exc()[34:].strip()
-                logWarning('Error on running plugin `{} onStop` for `{}` - Exception: `{}`!'.format(pname, user, trace))
-        del plugins
+                logWarning('Error on running plugin `{} onLog` for `{}` - Exception: `{}`!'.format(pname, user, trace))
 
         # Calling Panic Detect
         pd = self._panic_detect_log_parse(user, epname, log_string)
@@ -3124,7 +3728,40 @@ class Project(object):
         if pd:
             self.log_message(user, 'logRunning', 'PANIC DETECT: Execution stopped.')
 
-        return self.localFs.write_user_file(user, logPath, log_string, 'a')
+        log_size = self.localFs.append_user_file(user, logPath, log_string)
+        self._log_offsets_scan(user, logPath, log_string, log_size)
+        return log_size
+
+
+    def _flush_live_logs(self):
+        """
+        Internal function. Write all the queued CLI logs.\n
+        This is called by the live logs thread and when the server stops.
+        """
+        with self.lfl_lock:
+            with self.liv_lock:
+                queued = self.live_logs
+                self.live_logs = {}
+                self.live_sizes = {}
+
+            for (user, epname), chunks in queued.iteritems():
+                try:
+                    self._log_live_write(user, epname, ''.join(chunks))
+                except Exception as e:
+                    trace = traceback.format_exc()[34:].strip()
+                    logError('Log Error for `{}`, EP `{}`: `{}`!'.format(user, epname, trace))
+
+
+    def _log_live_loop(self):
+        """
+        Internal function. Live logs thread.
+        """
+        while 1:
+            time.sleep(self.live_interval)
+            try:
+                self._flush_live_logs()
+            except Exception as e:
+                logWarning('Live logs thread error: `{}`!'.format(e))
 
 
     def reset_log(self, user, log_name):
@@ -3156,6 +3793,10 @@ class Project(object):
             logWarning('Log path `{}`, for `{}` cannot be found!'.format(log_name, user))
             return False
 
+        # The queued CLI logs belong to the old log
+        self._flush_live_logs()
+        self._log_offsets_reset(user, log_name)
+
         # This will overwrite the file completely
         ret = self.localFs.write_user_file(user, logPath, '')
 
@@ -3214,6 +3855,10 @@ class Project(object):
         logFull('CeProject:reset_logs user `{}`.'.format(user))
         logsPath = self.get_user_info(user, 'logs_path')
 
+        # The queued CLI logs belong to the old logs
+        self._flush_live_logs()
+        self._log_offsets_reset(user)
+
         # Find all user log files. Validate first.
         logs = self.localFs.list_user_files(user, logsPath)
         if not (logs and isinstance(logs, dict) and logs.get('children')):
@@ -3240,42 +3885,133 @@ class Project(object):
             return False
 
 
+    def _panic_detect_load(self):
+        """
+        Reload the Panic Detect expressions, only if the config file changed.
+        """
+        try:
+            fstat = os.stat(self.pdConfigPath)
+            stamp = (fstat.st_mtime, fstat.st_size)
+        except Exception:
+            stamp = None
+
+        if stamp and stamp == self.pd_stamp:
+            return self.panicDetectRegularExpressions
+
+        try:
+            with open(self.pdConfigPath, 'rb') as config:
+                self.panicDetectRegularExpressions = json.load(config)
+        except Exception as e:
+            logWarning('Panic Detect: cannot load config `{}`: `{}`!'.format(self.pdConfigPath, e))
+            self.panicDetectRegularExpressions = {}
+
+        self.pd_stamp = stamp
+        # The expressions must be compiled again
+        self.pd_engines = {}
+        return self.panicDetectRegularExpressions
+
+
+    def _panic_detect_engine(self, user):
+        """
+        Compile the enabled Panic Detect expressions of one user.\n
+        The simple expressions are combined into a single pattern, with one
+        named group for each expression. The expressions with groups (they might
+        use back references), or with inline flags, are matched one by one.
+        """
+        engine = self.pd_engines.get(user)
+        if engine is not None:
+            return engine
+
+        simple = []
+        others = []
+
+        for key, value in sorted(self.panicDetectRegularExpressions.get(user, {}).iteritems()):
+            if value.get('enabled') != 'true':
+                continue
+            expr = value.get('expression') or ''
+            try:
+                comp = re.compile(expr)
+            except Exception as e:
+                logWarning('Panic Detect: invalid expression `{}` for user `{}`: `{}`!'.format(expr, user, e))
+                continue
+            if comp.groups or re.search(r'\(\?[iLmsux]+\)', expr):
+                others.append((expr, comp))
+            else:
+                simple.append(expr)
+
+        combined = None
+        if simple:
+            try:
+                combined = re.compile('|'.join('(?P<pd{}>{})'.format(i, expr) for i, expr in enumerate(simple)))
+            except Exception:
+                others = [(expr, re.compile(expr)) for expr in simple] + others
+                simple = []
+
+        engine = (combined, simple, others)
+        self.pd_engines[user] = engine
+        return engine
+
+
     def _panic_detect_log_parse(self, user, epname, log_string):
         """
-        Panic Detect parse log mechanism.
+        Panic Detect parse log mechanism.\n
+        The end of the previous log chunk is kept for each EP, so an expression
+        split between two chunks is still found.
         """
         logFull('CeProject:_panic_detect_log_parse user `{}`.'.format(user))
         status = False
-        self.panic_detect_config(user, {'command': 'list'})
-
-        with open(self.pdConfigPath, 'rb') as config:
-            self.panicDetectRegularExpressions = json.load(config)
+        self._panic_detect_load()
 
         if user not in self.panicDetectRegularExpressions:
             return status
 
         # Verify if for current suite Panic Detect is enabled
-        suiteID = self.get_ep_info(user, epname).get('curent_suite')
+        ep_info = self.users[user]['eps'].get(epname, {})
+        suiteID = ep_info.get('curent_suite')
         # When running first, the current_suite is not defined yet
-        if not suiteID:
+        if not suiteID or not ep_info.get('suites'):
             return status
 
-        enabled = self.get_suite_info(user, epname, suiteID).get('pd')
+        enabled = (ep_info['suites'].find_id(suiteID) or {}).get('pd')
 
         if not enabled or enabled.lower() == 'false':
             return status
 
-        for key, value in self.panicDetectRegularExpressions[user].iteritems():
-            if value.get('enabled') == 'true':
-                try:
-                    if re.search(value['expression'], log_string):
-                        # Stop EP
-                        self.set_exec_status(user, epname, STATUS_STOP,
-                            msg='Panic detect activated, expression `{}` found in CLI log!'.format(value['expression']))
-                        status = True
-                except Exception as e:
-                    trace = traceback.format_exc()[34:].strip()
-                    logError(trace)
+        combined, simple, others = self._panic_detect_engine(user)
+        if not (combined or others):
+            return status
+
+        tail = self.pd_tails.get((user, epname), '')
+        text = tail + log_string
+        self.pd_tails[(user, epname)] = text[-self.pd_tail_size:]
+        found = None
+
+        try:
+            # Only the matches that end in the new chunk; the old ones were already checked
+            if combined:
+                for match in combined.finditer(text):
+                    if match.end() > len(tail):
+                        found = simple[int(match.lastgroup[2:])]
+                        break
+            if not found:
+                for expr, comp in others:
+                    for match in comp.finditer(text):
+                        if match.end() > len(tail):
+                            found = expr
+                            break
+                    if found:
+                        break
+        except Exception as e:
+            trace = traceback.format_exc()[34:].strip()
+            logError(trace)
+
+        if found:
+            # The next run must not match this chunk again
+            self.pd_tails[(user, epname)] = ''
+            # Stop EP
+            self.set_exec_status(user, epname, STATUS_STOP,
+                msg='Panic detect activated, expression `{}` found in CLI log!'.format(found))
+            status = True
 
         return status
 
@@ -3292,8 +4028,7 @@ class Project(object):
         """
         logFull('CeProject:panic_detect_config user `{}`.'.format(user))
 
-        with open(self.pdConfigPath, 'rb') as config:
-            self.panicDetectRegularExpressions = json.load(config)
+        self._panic_detect_load()
 
         panicDetectCommands = {
             'simple': [
@@ -3362,6 +4097,7 @@ class Project(object):
                     config = open(self.pdConfigPath, 'wb')
                     json.dump(self.panicDetectRegularExpressions, config)
                     config.close()
+                    self.pd_engines = {}
 
                 #response['data'] = regExpID
                 response = regExpID
@@ -3393,6 +4129,7 @@ class Project(object):
                     config = open(self.pdConfigPath, 'wb')
                     json.dump(self.panicDetectRegularExpressions, config)
                     config.close()
+                    self.pd_engines = {}
 
                 #response['data'] = regExpID
                 response = True
@@ -3415,6 +4152,7 @@ class Project(object):
                     config = open(self.pdConfigPath, 'wb')
                     json.dump(self.panicDetectRegularExpressions, config)
                     config.close()
+                    self.pd_engines = {}
 
                 #response['data'] = regExpID
                 response = True
@@ -1,7 +1,7 @@
 
 # File: CeReports.py ; This file is part of Twister.
 
-# version: 3.005
+# version: 3.006
 
 # Copyright (C) 2012-2014 , Luxoft
 
@@ -43,6 +43,7 @@ import binascii
 import MySQLdb
 import cherrypy
 from collections import OrderedDict
+from thread import allocate_lock
 from mako.template import Template
 
 TWISTER_PATH = os.getenv('TWISTER_PATH')
@@ -61,6 +62,24 @@ if mako.__version__ < '0.7':
 
 
 
+def _json_default(obj):
+    """
+    Dates are sent as strings.
+    """
+    if isinstance(obj, datetime.datetime):
+        return obj.strftime('%Y-%m-%d %H:%M:%S')
+    return None
+
+
+def _like(text):
+    """
+    A MySQL LIKE pattern that finds the text anywhere.
+    """
+    text = text.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+    return '%' + text + '%'
+
+
+
 class ReportingServer(object):
     """
     Reporting server class.
@@ -72,6 +91,12 @@ class ReportingServer(object):
     glob_redirects = {}
     glob_links   = {}
 
+    rep_cache = OrderedDict() # Query results, the oldest first
+    cache_lock = allocate_lock() # Query results lock
+    cache_ttl = 60.0      # Query results expire after this many seconds
+    cache_size = 64       # Max number of query results kept
+    cache_rows = 100000   # Bigger query results are not kept
+
 
     def __init__(self, project):
         """
@@ -94,19 +119,22 @@ class ReportingServer(object):
             logError('Report Server: Null DB.XML file for user `{}`! Nothing to do!'.format(usr))
             return False
 
-        # Create database parser IF necessary, or FORCED...
-        if force or (usr not in self.db_parser):
+        # The parser is cached by the database manager, until the DB.XML files change
+        parser = self.project.dbmgr._db_config(usr)[0]
 
-            self.db_parser[usr] = True
+        # Create the reports IF necessary, or FORCED...
+        if force or (self.db_parser.get(usr) is not parser):
+
+            self.db_parser[usr] = parser
             self.glob_fields[usr]  = OrderedDict()
             self.glob_reports[usr] = OrderedDict()
             self.glob_redirects[usr] = OrderedDict()
+            self.invalidate_cache(usr)
 
-            usr_roles = self.project._parse_users_and_groups()
-            shared_db_path = usr_roles['shared_db_cfg']
+            usr_roles = self.project._load_users_and_groups()
             db_cfg_role = 'CHANGE_DB_CFG' in usr_roles['users'][usr]['roles']
             # Get reports will automatically handle private/ shared DB.xml
-            report_queries = DBParser(usr, db_file, shared_db_path).get_reports(db_cfg_role)
+            report_queries = parser.get_reports(db_cfg_role)
 
             for host_db in report_queries:
 
@@ -133,6 +161,130 @@ class ReportingServer(object):
         return True
 
 
+    def invalidate_cache(self, usr=None):
+        """
+        Forget the query results of a user, or of all users.
+        Called when new results are saved in the database.
+        """
+        with self.cache_lock:
+            if usr is None:
+                self.rep_cache.clear()
+            else:
+                for key in [k for k in self.rep_cache if k[0] == usr]:
+                    del self.rep_cache[key]
+
+
+    def _query(self, usr, curs, query, args=None):
+        """
+        Execute a query and return the headers and the rows.
+        The results are cached for `cache_ttl` seconds, by user + query + arguments.
+        """
+        key = (usr, query, tuple(args) if args is not None else None)
+        now = time.time()
+
+        with self.cache_lock:
+            cached = self.rep_cache.pop(key, None)
+            if cached and now - cached[0] < self.cache_ttl:
+                # Most recently used is last
+                self.rep_cache[key] = cached
+                return cached[1]
+
+        curs.execute(query, args)
+        headers = [desc[0] for desc in curs.description]
+        rows = curs.fetchall()
+
+        if len(rows) <= self.cache_rows:
+            with self.cache_lock:
+                self.rep_cache[key] = (now, (headers, rows))
+                while len(self.rep_cache) > self.cache_size:
+                    self.rep_cache.popitem(last=False)
+
+        return headers, rows
+
+
+    def _headers(self, usr, curs, query):
+        """
+        The headers of a query, without reading all the rows.
+        """
+        try:
+            return self._query(usr, curs, 'SELECT * FROM ({}) AS twister_rep LIMIT 0'.format(query))[0]
+        except MySQLdb.Error:
+            # Duplicate column names cannot be selected from a sub-query
+            return self._query(usr, curs, query)[0]
+
+
+    def _json_page(self, usr, curs, query, params):
+        """
+        DataTables server-side mode: the page, the sorting and the filters are done in SQL.
+        Returns the headers, the total number of rows, the filtered number of rows and the page.
+        """
+        start = max(int(params.get('iDisplayStart', 0)), 0)
+        length = int(params.get('iDisplayLength', 10))
+        if length < 0:
+            length = 18446744073709551615 # All the rows
+
+        headers = self._headers(usr, curs, query)
+        cols = ['`{}`'.format(h.replace('`', '``')) for h in headers]
+
+        where = []
+        args = []
+        if params.get('sSearch'):
+            where.append("CONCAT_WS(' ', {}) LIKE %s".format(', '.join(cols)))
+            args.append(_like(params['sSearch']))
+        for i, col in enumerate(cols):
+            if params.get('sSearch_{}'.format(i)):
+                where.append('{} LIKE %s'.format(col))
+                args.append(_like(params['sSearch_{}'.format(i)]))
+
+        order = []
+        for i in range(int(params.get('iSortingCols', 0))):
+            col = int(params.get('iSortCol_{}'.format(i), 0))
+            if 0 <= col < len(cols):
+                order.append('{} {}'.format(col + 1, 'DESC' if params.get('sSortDir_{}'.format(i)) == 'desc' else 'ASC'))
+
+        total = self._query(usr, curs, 'SELECT COUNT(*) FROM ({}) AS twister_rep'.format(query))[1][0][0]
+
+        # The user query can contain `%`, that must be escaped when using arguments
+        body = 'FROM ({}) AS twister_rep'.format(query.replace('%', '%%'))
+        if where:
+            body += ' WHERE ' + ' AND '.join(where)
+            filtered = self._query(usr, curs, 'SELECT COUNT(*) ' + body, args)[1][0][0]
+        else:
+            filtered = total
+        if order:
+            body += ' ORDER BY ' + ', '.join(order)
+
+        rows = self._query(usr, curs, 'SELECT * ' + body + ' LIMIT %s, %s', args + [start, length])[1]
+        return headers, total, filtered, rows
+
+
+    @staticmethod
+    def _page_rows(rows, params):
+        """
+        DataTables server-side mode, for the rows calculated in memory.
+        Returns the filtered number of rows and the page.
+        """
+        start = max(int(params.get('iDisplayStart', 0)), 0)
+        length = int(params.get('iDisplayLength', 10))
+
+        search = params.get('sSearch', '').lower()
+        if search:
+            rows = [r for r in rows if search in ' '.join(str(v) for v in r).lower()]
+        for i in range(len(rows[0]) if rows else 0):
+            col_search = params.get('sSearch_{}'.format(i), '').lower()
+            if col_search:
+                rows = [r for r in rows if col_search in str(r[i]).lower()]
+
+        for i in reversed(range(int(params.get('iSortingCols', 0)))):
+            col = int(params.get('iSortCol_{}'.format(i), 0))
+            if rows and 0 <= col < len(rows[0]):
+                rows = sorted(rows, key=lambda r: r[col], reverse=params.get('sSortDir_{}'.format(i)) == 'desc')
+
+        if length < 0:
+            return len(rows), list(rows[start:])
+        return len(rows), list(rows[start:start + length])
+
+
     @cherrypy.expose
     def index(self, usr=''):
         """
@@ -269,17 +421,14 @@ class ReportingServer(object):
                             msg='Cannot build query!<br><br>Field `<b>{}</b>` doesn\'t '\
                             'have a query!'.format(opt.replace('@', '')))
 
-                    # Execute User Query
+                    # Execute User Query, or use the cached options
                     try:
-                        curs.execute(u_query)
+                        u_vals = self._query(usr, curs, u_query)[1]
                     except MySQLdb.Error as e:
                         output = Template(filename=TWISTER_PATH + '/server/template/rep_error.htm')
                         return output.render(links=self.glob_links[usr], title=report, usr=usr,
                             msg='Error in query `{}`!<br><br><b>MySQL Error {}</b>: {}!'.format(
                                 u_query, e.args[0], e.args[1]))
-
-                    try:
-                        u_vals = curs.fetchall()
                     except Exception, e:
                         output = Template(filename=TWISTER_PATH + '/server/template/rep_error.htm')
                         return output.render(links=self.glob_links[usr], title=report, usr=usr,
@@ -335,15 +484,14 @@ class ReportingServer(object):
         user_choices = user_choices.replace('@', '').replace('=', '="')+'"'
         del ajax_links
 
+        # Only the headers are needed here; the rows are sent by `json`
         try:
-            curs.execute(query)
+            descr = self._headers(usr, curs, query)
         except MySQLdb.Error as e:
             output = Template(filename=TWISTER_PATH + '/server/template/rep_error.htm')
             return output.render(title=report, links=self.glob_links[usr], usr=usr,
                 msg='Error in query `{}`!<br><br><b>MySQL Error {}</b>: {}!'.format(query, e.args[0], e.args[1]))
 
-        descr = [desc[0] for desc in curs.description]
-
         # Write DEBUG
         #DEBUG.write(report +' -> '+ user_choices +' -> '+ query + '\n\n') ; DEBUG.flush()
 
@@ -362,24 +510,25 @@ class ReportingServer(object):
                 query_compr = query_compr.replace(field, str(u_select))
 
             try:
-                curs.execute(query_compr)
+                headers_tot = self._headers(usr, curs, query_compr)
             except MySQLdb.Error as e:
                 output = Template(filename=TWISTER_PATH + '/server/template/rep_error.htm')
                 return output.render(title=report, links=self.glob_links[usr], usr=usr,
                     msg='Error in query `{}`!<br><br><b>MySQL Error {}</b>: {}!'.format(query_compr, e.args[0], e.args[1]))
 
-            headers_tot = [desc[0] for desc in curs.description]
-
             # Update headers: must contain both headers.
             descr = descr + ['vs.'] + headers_tot
 
             # Write DEBUG
             #DEBUG.write(report +' -> '+ user_choices +' -> '+ query_compr + '\n\n') ; DEBUG.flush()
 
+        # The tables without charts are paged by the server
+        server_side = report_dict['type'] not in ['PieChart', 'LineChart', 'BarChart']
+
         output = Template(filename=TWISTER_PATH + '/server/template/rep_base.htm')
         return output.render(usr=usr, title=report, links=self.glob_links[usr],
                              ajax_link=ajax_link, user_choices=user_choices,
-                             report=descr, chart=report_dict['type'])
+                             report=descr, chart=report_dict['type'], server_side=server_side)
 
 
     @cherrypy.expose
@@ -434,19 +583,30 @@ class ReportingServer(object):
             # Replace @variables@ with user chosen value
             query = query.replace(field, str(u_select))
 
+        query_total = report_dict['sqltotal']
+        query_compr = report_dict['sqlcompr']
+
+        # DataTables server-side mode sends `sEcho`, with the page, the sorting and the filters
+        params = cherrypy.request.params
+        server_side = 'sEcho' in params
+
+        # Normal Query, the page is selected in SQL
+        if server_side and not query_total and not query_compr:
+            try:
+                headers, total, filtered, rows = self._json_page(usr, curs, query, params)
+                return json.dumps({'sEcho': int(params['sEcho']), 'iTotalRecords': total,
+                    'iTotalDisplayRecords': filtered, 'headers': headers, 'type': report_dict['type'],
+                    'aaData': rows}, default=_json_default)
+            except MySQLdb.Error as e:
+                logDebug('Report Server: Cannot page report `{}` in SQL, will page in memory: `{}`.'.format(report, e))
+
         try:
-            curs.execute(query)
+            headers, rows = self._query(usr, curs, query)
         except MySQLdb.Error as e:
             output = {'aaData':[], 'error':'Error in query `{}`! MySQL Error {}: {}!'.format(query, e.args[0], e.args[1])}
             return json.dumps(output, indent=2)
-
-        headers = [desc[0] for desc in curs.description]
-        rows = curs.fetchall()
         del query
 
-        query_total = report_dict['sqltotal']
-        query_compr = report_dict['sqlcompr']
-
 
         # ... Calculate SQL Query Total ...
         if query_total:
@@ -460,14 +620,11 @@ class ReportingServer(object):
                 query_total = query_total.replace(field, str(u_select))
 
             try:
-                curs.execute(query_total)
+                headers_tot, rows_tot = self._query(usr, curs, query_total)
             except MySQLdb.Error as e:
                 output = {'aaData':[], 'error':'Error in query total `{}`! MySQL Error {}: {}!'.format(query_total, e.args[0], e.args[1])}
                 return json.dumps(output, indent=2)
 
-            headers_tot = [desc[0] for desc in curs.description]
-            rows_tot = curs.fetchall()
-
             if len(headers) != len(headers_tot):
                 output = {'aaData':[], 'error':'The first query has {} columns and the second has {} columns!'
                     .format(len(headers), len(headers_tot))}
@@ -515,15 +672,12 @@ class ReportingServer(object):
                 query_compr = query_compr.replace(field, str(u_select))
 
             try:
-                curs.execute(query_compr)
+                headers_tot, rows_tot = self._query(usr, curs, query_compr)
             except MySQLdb.Error as e:
                 output = {'aaData':[], 'error':'Error in query compare `{}`! '\
                     'MySQL Error {}: {}!'.format(query_total, e.args[0], e.args[1])}
                 return json.dumps(output, indent=2)
 
-            headers_tot = [desc[0] for desc in curs.description]
-            rows_tot = curs.fetchall()
-
             if len(headers) != len(headers_tot): # Must be the same number of columns
                 output = {'aaData':[], 'error':'The first query has {} columns and the second has {} columns!'
                     .format(len(headers), len(headers_tot))}
@@ -554,6 +708,12 @@ class ReportingServer(object):
             calc_rows = rows
             del rows
 
+        if server_side:
+            filtered, page = self._page_rows(calc_rows, params)
+            return json.dumps({'sEcho': int(params['sEcho']), 'iTotalRecords': len(calc_rows),
+                'iTotalDisplayRecords': filtered, 'headers': headers, 'type': report_dict['type'],
+                'aaData': page}, default=_json_default)
+
         if (not calc_rows) or (not calc_rows[0:1]):
             output = {'aaData':[], 'error':'The select is empty!'}
             return json.dumps(output, indent=2)
@@ -563,9 +723,8 @@ class ReportingServer(object):
         else:
             isDate = False
 
-        dthandler = lambda obj: obj.strftime('%Y-%m-%d %H:%M:%S') if isinstance(obj, datetime.datetime) else None
         return json.dumps({'headers':headers, 'type':report_dict['type'], 'isDate':isDate, 'aaData':calc_rows},
-            indent=2, default=dthandler)
+            default=_json_default)
 
 
     @cherrypy.expose
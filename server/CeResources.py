@@ -1,7 +1,7 @@
 
 # File: CeResources.py ; This file is part of Twister.
 
-# version: 3.001
+# version: 3.002
 
 # Copyright (C) 2012-2013 , Luxoft
 
@@ -76,54 +76,135 @@ CONSTANT_DICTIONARY = {'version': 0, 'name': '/', 'meta': {}, 'children': {}}
 
 #
 
+# Index of IDs for the trees of the Resource Allocator (the devices and the systems
+# of each user): id(root) -> [root, {ID: (pointer, path)} or None, generation];
+# the entry keeps the root alive, so the id is not reused while it's indexed.
+# The other nodes (reserved copies, sub-trees) are not indexed, only walked.
+_id_indexes = {}
+
+def _ids_trees(roots):
+    '''
+    Index only these trees; the old indexes of the other (replaced) trees are dropped.
+    '''
+    indexes = {}
+    for root in roots:
+        entry = _id_indexes.get(id(root))
+        if not entry or entry[0] is not root:
+            entry = [root, None, 0]
+        indexes[id(root)] = entry
+    _id_indexes.clear()
+    _id_indexes.update(indexes)
+
+
+def _ids_changed(root):
+    '''
+    Must be called after nodes are added, moved or deleted in a tree.
+    Only the index of this tree is dropped.
+    '''
+    entry = _id_indexes.get(id(root))
+    if entry and entry[0] is root:
+        entry[1] = None
+        entry[2] += 1
+
+
+def _build_id_index(parent_node):
+    '''
+    Walk the tree once and map each ID to the pointer and the path of the node.
+    '''
+    entry = _id_indexes.get(id(parent_node))
+    if entry and entry[0] is not parent_node:
+        entry = None
+    generation = entry[2] if entry else 0
+    index = {}
+    stack = [(parent_node, [])]
+    while stack:
+        node, path = stack.pop()
+        if not isinstance(node, dict):
+            continue
+        node_id = node.get('id')
+        if node_id is not None and node_id not in index:
+            index[node_id] = (node, path)
+        children = node.get('children')
+        # Check depth
+        if not isinstance(children, dict) or len(path) > 25:
+            continue
+        for name, child in children.iteritems():
+            stack.append((child, path + [name]))
+
+    # Keep the index only for the indexed trees, if the tree didn't change while walking it
+    if entry and entry[2] == generation:
+        entry[1] = index
+    return index
+
+
+def _id_index(parent_node):
+    '''
+    Returns the index of IDs for a parent node, building it if needed.
+    '''
+    entry = _id_indexes.get(id(parent_node))
+    if entry and entry[0] is parent_node and entry[1] is not None:
+        return entry[1]
+    return _build_id_index(parent_node)
+
+
+def _find_id(parent_node, node_id):
+    '''
+    Returns the pair (pointer, path) of one node ID, or None.
+    The index is rebuilt only after `_ids_changed`; a hit is also checked by following
+    the path, and if the node was moved without `_ids_changed`, the index is rebuilt once.
+    '''
+    if not parent_node:
+        return None
+    found = _id_index(parent_node).get(node_id)
+    if not found:
+        return None
+    if found[0].get('id') == node_id and _find_pointer(parent_node, found[1]) is found[0]:
+        return found
+    found = _build_id_index(parent_node).get(node_id)
+    if found and found[0].get('id') == node_id and _find_pointer(parent_node, found[1]) is found[0]:
+        return found
+    return None
+
+
+def _id_exists(parent_node, node_id):
+    '''
+    Quick check for new IDs. Doesn't rebuild the index.
+    '''
+    return node_id in _id_index(parent_node)
+
+
 def _recursive_find_id(parent_node, node_id, path=[]):
     '''
     Parent Node is a dict of nodes with structure Name: {Id, Meta, Children}.
     Node ID must be a unique ID.
     '''
-    # The node is valid ?
-    if not parent_node:
-        return False
-    # Found the node with the correct id !
-    if parent_node.get('id') == node_id:
-        result = dict(parent_node)
-        result['path'] = path
-        return result
-    # This node has children ?
-    if not parent_node.get('children'):
+    found = _find_id(parent_node, node_id)
+    if not found:
         return False
-    # Check depth
-    if len(path) > 25:
-        return False
-
-    try:
-        path.pop(-1)
-    except:
-        pass
-
-    for node in parent_node.get('children'):
-        result = _recursive_find_id(parent_node['children'][node], node_id, path)
-        if result:
-            path.insert(0, node)
-            result['path'] = path
-            return result
+    result = dict(found[0])
+    result['path'] = list(found[1])
+    return result
 
 
-def _recursive_refresh_id(node):
+def _recursive_refresh_id(node, ids=None):
     """ refresh ids """
+    # All the IDs that must be avoided, collected once
+    if ids is None:
+        ids = set(_id_index(node))
 
     res_id = False
     while not res_id:
         res_id = hexlify(os.urandom(5))
         # If by any chance, this ID already exists, generate another one!
-        if _recursive_find_id(node, res_id, []):
+        if res_id in ids:
             res_id = False
 
+    ids.add(res_id)
     node.update([('id', res_id), ])
 
     if node['children']:
         for c in node['children']:
-            node['children'][c] = _recursive_refresh_id(node['children'][c])
+            node['children'][c] = _recursive_refresh_id(node['children'][c], ids)
 
     return node
 
@@ -434,10 +515,10 @@ class ResourceAllocator(_cptools.XMLRPCController):
 
         self.project = project
 
-        self.resources = CONSTANT_DICTIONARY
+        self.resources = copy.deepcopy(CONSTANT_DICTIONARY)
         self.reservedResources = dict()
         self.lockedResources = dict()
-        self.systems = CONSTANT_DICTIONARY
+        self.systems = copy.deepcopy(CONSTANT_DICTIONARY)
         self.acc_lock = thread.allocate_lock() # Task change lock
         self.ren_lock = thread.allocate_lock() # Rename lock
         self.imp_lock = thread.allocate_lock() # Import lock
@@ -445,6 +526,14 @@ class ResourceAllocator(_cptools.XMLRPCController):
         self.load_lock = thread.allocate_lock() # Save lock
         self.res_file = '{}/config/resources.json'.format(TWISTER_PATH)
         self._loadedUsers = dict()
+        # Parsed system SUTs, for each SUT folder
+        self._sutStores = dict()
+        # The SUT store entries copied in the systems of each user
+        self._sutCopies = dict()
+        # Last time the SUTs of each user were checked
+        self._sutPolls = dict()
+        # The SUT files and the user SUTs are checked at most once every X seconds
+        self.sut_poll = 1.0
         self._load(True)
 
         logInfo('Resource Allocator initialization took `{:.4f}` sec.'.format(time.time()-ti))
@@ -478,37 +567,28 @@ class ResourceAllocator(_cptools.XMLRPCController):
                 user_roles = self.user_roles(props)
                 user = user_roles.get('user')
                 if user in self._loadedUsers:
-                    # Get the user rpyc connection suts and count
-                    try:
-                        userConn = self.project._find_local_client(user)
-                        userSutsLen = copy.deepcopy(userConn.root.exposed_get_suts_len())
-                        loadedLen = 0
-                        for c in self._loadedUsers[user]['children']:
-                            if c.split('.')[-1] == 'user':
-                                loadedLen += 1
-                        if not userSutsLen == loadedLen:
-                            userSuts = copy.deepcopy(userConn.root.get_suts())
-                            if userSuts:
-                                self.systems['children'].update(userSuts)
-
-                                userSystems = CONSTANT_DICTIONARY
-                                userSystems['children'].update(userSuts)
-                                self._loadedUsers.update([(user, userSystems), ])
-                    except Exception as e:
-                        if verbose:
-                            logError('_load ERROR:: {} for user {}'.format(e, self.get_user_name()))
+                    # Get the user rpyc connection suts and count, but don't ask the user client every time
+                    if time.time() - self._sutPolls.get(user, 0) >= self.sut_poll:
+                        self._sutPolls[user] = time.time()
+                        try:
+                            userConn = self.project._find_local_client(user)
+                            userSutsLen = copy.deepcopy(userConn.root.exposed_get_suts_len())
+                            loadedLen = 0
+                            for c in self._loadedUsers[user]['children']:
+                                if c.split('.')[-1] == 'user':
+                                    loadedLen += 1
+                            if not userSutsLen == loadedLen:
+                                userSuts = copy.deepcopy(userConn.root.get_suts())
+                                if userSuts:
+                                    self._loadedUsers[user]['children'].update(userSuts)
+                                    _ids_changed(self._loadedUsers[user])
+                        except Exception as e:
+                            if verbose:
+                                logError('_load ERROR:: {} for user {}'.format(e, self.get_user_name()))
 
                     self.systems = self._loadedUsers[user]
                     try:
-                        sutsPath = self.project.get_user_info(user, 'sys_sut_path')
-                        if not sutsPath:
-                            sutsPath = '{}/config/sut/'.format(TWISTER_PATH)
-                        sutPaths = [p for p in os.listdir(sutsPath) if os.path.isfile(os.path.join(sutsPath, p))\
-                         and p.split('.')[-1] == 'json']
-                        for sutPath in sutPaths:
-                            sutName = '.'.join(['.'.join(sutPath.split('.')[:-1]  + ['system'])])
-                            with open(os.path.join(sutsPath, sutPath), 'r') as f:
-                                self.systems['children'].update([(sutName, json.load(f)), ])
+                        self._load_system_suts(user)
                     except Exception as e:
                         if verbose:
                             logError('_load ERROR:: {} for user {}'.format(e, self.get_user_name()))
@@ -520,9 +600,7 @@ class ResourceAllocator(_cptools.XMLRPCController):
         with self.load_lock:
 
             if not self.resources.get('children'):
-                self.resources = CONSTANT_DICTIONARY
-            if not self.systems.get('children'):
-                self.systems = CONSTANT_DICTIONARY
+                self.resources = copy.deepcopy(CONSTANT_DICTIONARY)
 
             # try to load test bed resources file
             try:
@@ -538,7 +616,8 @@ class ResourceAllocator(_cptools.XMLRPCController):
                     logError('RA: There are no devices to load for user {}! `{}`!'.format(self.get_user_name(), e))
             # try to load SUT file
             try:
-                self.systems   = CONSTANT_DICTIONARY
+                # Each user has its own systems
+                self.systems = copy.deepcopy(CONSTANT_DICTIONARY)
 
                 if verbose:
                     logDebug('RA: Systems root loaded successfully for user {}.'.format(self.get_user_name()))
@@ -546,16 +625,7 @@ class ResourceAllocator(_cptools.XMLRPCController):
                 try:
                     user_roles = self.user_roles(props)
                     user = user_roles.get('user')
-                    sutsPath = self.project.get_user_info(user, 'sys_sut_path')
-                    if not sutsPath:
-                        sutsPath = '{}/config/sut/'.format(TWISTER_PATH)
-                    sutPaths = [p for p in os.listdir(sutsPath)\
-                        if os.path.isfile(os.path.join(sutsPath, p))\
-                             and p.split('.')[-1] == 'json']
-                    for sutPath in sutPaths:
-                        sutName = '.'.join(['.'.join(sutPath.split('.')[:-1]  + ['system'])])
-                        with open(os.path.join(sutsPath, sutPath), 'r') as f:
-                            self.systems['children'].update([(sutName, json.load(f)), ])
+                    self._load_system_suts(user)
                 except Exception as e:
                     if verbose:
                         logError('_load ERROR:: {} for user {}'.format(e, self.get_user_name()))
@@ -568,11 +638,7 @@ class ResourceAllocator(_cptools.XMLRPCController):
                     userSuts = copy.deepcopy(userConn.root.get_suts())
                     if userSuts:
                         self.systems['children'].update(userSuts)
-
-                    userSystems  = CONSTANT_DICTIONARY
-                    if userSuts:
-                        userSystems['children'].update(userSuts)
-                    self._loadedUsers.update([(user, userSystems), ])
+                    self._loadedUsers.update([(user, self.systems), ])
                 except Exception as e:
                     if verbose:
                         logError('_load ERROR:: {} for user {}'.format(e, self.get_user_name()))
@@ -582,6 +648,8 @@ class ResourceAllocator(_cptools.XMLRPCController):
             except Exception as e:
                 if verbose:
                     logError('RA: There are no SUTs to load for user {} ! `{}`!'.format(self.get_user_name(), e))
+
+            self._index_trees()
         r = None
         if not r == True and not r == None:
             logDebug('_load ERROR: {} for user {}'.format(r, self.get_user_name()))
@@ -590,6 +658,89 @@ class ResourceAllocator(_cptools.XMLRPCController):
         return True
 
 
+    def _index_trees(self):
+        """ Index the IDs of the devices and of the systems of each user """
+        _ids_trees([self.resources, self.systems] + self._loadedUsers.values())
+
+
+    def _sut_store(self, sutsPath):
+        """
+        Returns the system SUTs from one folder, as a dict of SUT name -> (file stamp, SUT).
+        The SUT files are parsed again only when the modification time or size change
+        and the folder is checked at most once every `sut_poll` seconds.
+        """
+        store = self._sutStores.setdefault(sutsPath, {'checked': 0, 'suts': {}})
+        if time.time() - store['checked'] < self.sut_poll:
+            return store['suts']
+
+        suts = dict()
+        for sutPath in os.listdir(sutsPath):
+            fpath = os.path.join(sutsPath, sutPath)
+            if sutPath.split('.')[-1] != 'json' or not os.path.isfile(fpath):
+                continue
+            sutName = '.'.join(sutPath.split('.')[:-1] + ['system'])
+            fstat = os.stat(fpath)
+            stamp = (fstat.st_mtime, fstat.st_size)
+            old = store['suts'].get(sutName)
+            if old and old[0] == stamp:
+                suts[sutName] = old
+                continue
+            try:
+                with open(fpath, 'r') as f:
+                    suts[sutName] = (stamp, json.load(f))
+            except Exception as e:
+                logWarning('Cannot load SUT file `{}`: `{}`!'.format(fpath, e))
+                # Probably written right now; keep the old SUT, until the next check
+                if old:
+                    suts[sutName] = old
+
+        store['suts'] = suts
+        store['checked'] = time.time()
+        return suts
+
+
+    def _load_system_suts(self, user):
+        """
+        Update the system SUTs in the current systems, from the SUT store.
+        Only the SUTs that changed on disk are replaced, and the deleted ones are removed.
+        """
+        sutsPath = self.project.get_user_info(user, 'sys_sut_path')
+        if not sutsPath:
+            sutsPath = '{}/config/sut/'.format(TWISTER_PATH)
+
+        children = self.systems['children']
+        copies = self._sutCopies.setdefault(user, {})
+        suts = self._sut_store(sutsPath)
+        changed = False
+        # The SUT files deleted since the last load
+        for sutName in [n for n in copies if n not in suts]:
+            del copies[sutName]
+            fpath = os.path.join(sutsPath, '.'.join(sutName.split('.')[:-1] + ['json']))
+            if not os.path.isfile(fpath) and children.pop(sutName, None) is not None:
+                changed = True
+        for sutName, entry in suts.iteritems():
+            if sutName in children and copies.get(sutName) is entry:
+                continue
+            # Each user has its own systems, the SUTs are changed in place
+            children[sutName] = copy.deepcopy(entry[1])
+            copies[sutName] = entry
+            changed = True
+        if changed:
+            _ids_changed(self.systems)
+
+
+    def _sut_changed(self, sutName=None):
+        """
+        Called after the system SUTs are written, renamed or deleted by the CE.
+        The SUT folders are checked again on the next load and the stored SUT is dropped,
+        so a saved SUT is not replaced with the old copy and a deleted SUT doesn't come back.
+        """
+        for store in self._sutStores.itervalues():
+            store['checked'] = 0
+            if sutName:
+                store['suts'].pop(sutName, None)
+
+
     def _save(self, root_id=ROOT_DEVICE, props={}, resource_name = None, username = None):
         '''
         Function used to write the changes on HDD.
@@ -633,14 +784,6 @@ class ResourceAllocator(_cptools.XMLRPCController):
                 v = self.systems.get('version', 1)
                 self.systems['version'] = v
 
-                systemsChildren = copy.deepcopy(self.systems['children'])
-                self.systems['children'] = dict()
-
-                self.systems = CONSTANT_DICTIONARY
-
-                self.systems['children'] = copy.deepcopy(systemsChildren)
-                del systemsChildren
-
                 userSuts = list()
                 systemSuts = list()
                 #logError('||||save sys', user, self.systems)
@@ -694,6 +837,7 @@ class ResourceAllocator(_cptools.XMLRPCController):
                             except Exception as e:
                                 log.append(e)
                                 logError('User {}: Saving ERROR system:: `{}`.'.format(self.get_user_name(), e))
+                        self._sut_changed(child)
 
                     # update loaded users systems
                     self._loadedUsers.update([(user, self.systems), ])
@@ -789,6 +933,7 @@ class ResourceAllocator(_cptools.XMLRPCController):
             if root_id == ROOT_DEVICE:
                 try:
                     self.resources = xml_to_res(params_xml, {}, ROOT_DEVICE)
+                    self._index_trees()
                 except Exception as e:
                     msg = 'User {}: Import XML: Exception `{}`.'.format(self.get_user_name(), e)
                     logError(msg)
@@ -815,8 +960,9 @@ class ResourceAllocator(_cptools.XMLRPCController):
                     sutContent = xml_to_res(params_xml, {}, ROOT_SUT)
                     sutContent = sutContent.popitem()[1]
                     sutContent.update([('path', sutName.split()), ])
-                    sutContent = _recursive_refresh_id(sutContent)
+                    sutContent = _recursive_refresh_id(sutContent, set(_id_index(self.systems)))
                     self.systems['children'].update([(sutName, sutContent), ])
+                    _ids_changed(self.systems)
                 except Exception as e:
                     msg = 'User {}: Import XML: Exception `{}`.'.format(self.get_user_name(), e)
                     logError(msg)
@@ -908,6 +1054,7 @@ class ResourceAllocator(_cptools.XMLRPCController):
         resp = True
         if sut_type == 'system':
             resp = self.project.localFs.write_system_file(sut_file, json.dumps(xml_ret, indent=4), 'w')
+            self._sut_changed()
         else:
             resp = self.project.localFs.write_user_file(user, sut_file, json.dumps(xml_ret, indent=4), 'w')
 
@@ -1207,6 +1354,7 @@ class ResourceAllocator(_cptools.XMLRPCController):
                 # content
                 if self.systems['children'].get(query) is not None:
                     self.systems['children'][query] = sutContent
+                    _ids_changed(self.systems)
 
                 return retDict
 
@@ -1396,10 +1544,11 @@ class ResourceAllocator(_cptools.XMLRPCController):
                 while not res_id:
                     res_id = hexlify(os.urandom(5))
                     # If by any chance, this ID already exists, generate another one!
-                    if _recursive_find_id(resources, res_id, []):
+                    if _id_exists(resources, res_id):
                         res_id = False
 
                 parent_p['children'][name] = {'id': res_id, 'meta': props, 'children': {}}
+                _ids_changed(resources)
 
                 epnames_tag = '_epnames_{}'.format(username)
 
@@ -1425,6 +1574,7 @@ class ResourceAllocator(_cptools.XMLRPCController):
                         if '*ERROR*' in r:
                             # do clean up
                             parent_p['children'].pop(name)
+                            _ids_changed(resources)
                     else:
                         logDebug('User {}: Created {} `{}`, id `{}` : `{}` .'\
                             .format(self.get_user_name(), root_name,\
@@ -1591,6 +1741,7 @@ class ResourceAllocator(_cptools.XMLRPCController):
                     new_string = 'res_p["children"]["{}"]'.format('"]["children"]["'.join(new_path[1:]))
                     exec( new_string + ' = ' + exec_string )
                     exec( 'del ' + exec_string )
+                    _ids_changed(resources)
                 else:
                     # update the path for a TB
                     res_p.update([('path', [new_name]), ])
@@ -1715,6 +1866,7 @@ class ResourceAllocator(_cptools.XMLRPCController):
             else:
                 logDebug('User {}: Executing `{}` ...'.format(self.get_user_name(), 'del ' + exec_string ))
                 exec( 'del ' + exec_string )
+                _ids_changed(resources)
                 logDebug('User {}: Deleted {} path `{}`.'.format(self.get_user_name(), root_name, '/'.join(res_path)))
 
             return True
@@ -1781,6 +1933,7 @@ class ResourceAllocator(_cptools.XMLRPCController):
                 file_name += '.json'
 
                 os.remove(sutsPath+'/'+file_name)
+                self._sut_changed(node_path[0])
             else:
                 # Get the user rpyc connection connection
                 try:
@@ -1811,6 +1964,7 @@ class ResourceAllocator(_cptools.XMLRPCController):
             parent_p = _get_res_pointer(self.systems, '/')
             if parent_p is not None and parent_p['children'].get(sut_to_remove) is not None:
                 parent_p['children'].pop(sut_to_remove)
+                _ids_changed(self.systems)
         # end temporary fix
 
         # SUT file can be user or system file
@@ -1820,6 +1974,7 @@ class ResourceAllocator(_cptools.XMLRPCController):
                 sutsPath = '{}/config/sut/'.format(TWISTER_PATH)
             try:
                 os.remove(sutsPath + res_query.split('.')[0] + '.json')
+                self._sut_changed(res_query.split('/')[-1])
                 delete_sut_memory(res_query.split('/')[-1])
                 return True
             except Exception as e:
@@ -2205,6 +2360,7 @@ class ResourceAllocator(_cptools.XMLRPCController):
                         if not sutsPath:
                             sutsPath = '{}/config/sut/'.format(TWISTER_PATH)
                         os.remove(os.path.join(sutsPath, '.'.join(child.split('.')[:-1] + ['json'])))
+                        self._sut_changed(child)
                     else:
                         # Get the user rpyc connection connection
                         try:
@@ -2215,6 +2371,7 @@ class ResourceAllocator(_cptools.XMLRPCController):
 
             resources['children'].update([(_res_pointer['path'][0], _res_pointer), ])
             #resources['children'].update([(res_path[0], _res_pointer), ])
+            _ids_changed(resources)
 
             # Check for modifications
             if res_pointer != _res_pointer:
@@ -2296,6 +2453,7 @@ class ResourceAllocator(_cptools.XMLRPCController):
                         if not sutsPath:
                             sutsPath = '{}/config/sut/'.format(TWISTER_PATH)
                         os.remove(os.path.join(sutsPath, '.'.join(child.split('.')[:-1] + ['json'])))
+                        self._sut_changed(child)
                     else:
                         # Get the user rpyc connection connection
                         try:
@@ -2305,6 +2463,7 @@ class ResourceAllocator(_cptools.XMLRPCController):
                             logError('User {}: Save resource ERROR:: `{}`.'.format(self.get_user_name(), e))
 
             resources['children'].update([(_res_pointer['path'][0], _res_pointer), ])
+            _ids_changed(resources)
 
             # Check for modifications
             if res_pointer != _res_pointer:
@@ -2375,9 +2534,9 @@ class ResourceAllocator(_cptools.XMLRPCController):
             while not res_id:
                 res_id = hexlify(os.urandom(5))
                 # If by any chance, this ID already exists, generate another one!
-                if _recursive_find_id(resources, res_id, []):
+                if _id_exists(resources, res_id):
                     res_id = False
-            _res_pointer = _recursive_refresh_id(_res_pointer)
+            _res_pointer = _recursive_refresh_id(_res_pointer, set(_id_index(resources)))
             _res_pointer.update([('path', [name]), ])
 
             resources['children'].update([(name, _res_pointer), ])
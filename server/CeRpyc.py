@@ -1,7 +1,7 @@
 
 # File: CeRpyc.py ; This file is part of Twister.
 
-# version: 3.025
+# version: 3.026
 
 # Copyright (C) 2012-2014 , Luxoft
 
@@ -30,9 +30,14 @@ import sys
 import time
 import json
 import thread
+import hashlib
+import tarfile
+import cStringIO
 import traceback
+import zlib
 import rpyc
 from pprint import pformat
+from collections import OrderedDict
 from lxml import etree
 
 TWISTER_PATH = os.getenv('TWISTER_PATH')
@@ -47,7 +52,6 @@ from common.constants  import *
 from common.helpers    import *
 from common.tsclogging import *
 from common.tsclogging import getLogLevel, setLogLevel
-from common.xmlparser  import PluginParser
 
 #
 
@@ -72,6 +76,29 @@ class CeRpycService(rpyc.Service):
     conns = {}
     conn_lock = thread.allocate_lock()
 
+    # Indexes of the connections, updated with `_index_conn`, under the conn lock:
+    # ('user', user), ('hello', user, hello), ('ep', user, epname), ('host', ip)
+    # -> set of connection addresses
+    conn_index = {}
+    # The index keys of each connection address
+    conn_keys = {}
+
+    # Packed libraries, for each pair of user + library name, least recently used first:
+    # (the stamp of the library paths, the md5 hash, the data, the time of the last check)
+    libs = OrderedDict()
+    libs_lock = thread.allocate_lock()
+    # One lock for each library, so a library is packed only once
+    libs_locks = {}
+    # The packed libraries are kept up to this size, in bytes
+    libs_max_size = 256 * 1024 * 1024
+    # The library paths are checked for changes at most once every X seconds
+    libs_check = 2.0
+
+    # The last ClearCase file downloaded in chunks by each EP:
+    # (user, EP name) -> (file ID or path, file text)
+    cc_files = {}
+    cc_files_lock = thread.allocate_lock()
+
 
     def exposed_get_log_level(self):
         """
@@ -109,6 +136,42 @@ class CeRpycService(rpyc.Service):
             return ''
 
 
+    @classmethod
+    def _index_conn(self, str_addr):
+        """
+        Helper function to update the indexes of one connection.
+        Must be called with the conn lock, after the connection data changed.
+        Only the logged in connections are indexed.
+        """
+        for key in self.conn_keys.pop(str_addr, []):
+            addrs = self.conn_index.get(key)
+            if addrs is None:
+                continue
+            addrs.discard(str_addr)
+            if not addrs:
+                del self.conn_index[key]
+
+        data = self.conns.get(str_addr)
+        if not data or not data.get('user') or not data.get('checked'):
+            return
+
+        user = data['user']
+        keys = [('user', user)]
+        hello = data.get('hello')
+        if hello:
+            # The hello can be searched by the full name, or by the type (ex: `ep::name`)
+            keys.append(('hello', user, hello))
+            if ':' in hello:
+                keys.append(('hello', user, hello.split(':')[0]))
+            keys.append(('host', str_addr.split(':')[0]))
+            for epname in data.get('eps') or []:
+                keys.append(('ep', user, epname))
+
+        for key in keys:
+            self.conn_index.setdefault(key, set()).add(str_addr)
+        self.conn_keys[str_addr] = keys
+
+
     def on_connect(self):
         """
         On client connect
@@ -149,6 +212,7 @@ class CeRpycService(rpyc.Service):
         try:
             with self.conn_lock:
                 del self.conns[str_addr]
+                self._index_conn(str_addr)
         except Exception as e:
             logError('EE: Disconnect error: {}.'.format(e))
 
@@ -181,43 +245,16 @@ class CeRpycService(rpyc.Service):
         #         usr, addr, (hello or None), (epname or None), len(self.conns),
         #         pformat(self.conns, width=140)))
 
-        found = False
-
-        # Cycle all active connections (clients, eps, libs, cli)
-        for str_addr, data in self.conns.iteritems():
-            # Skip invalid connections, without log-in, or without hello
-            if not data.get('user') or not data.get('checked') or not data.get('hello'):
-                continue
-            if user != data['user']:
-                continue
-            # Searching for a specific hello
-            if not (':' in data['hello'] and hello == data['hello'].split(':')[0] or hello == data['hello']):
-                continue
-
+        # Only the logged in connections, with a hello, are indexed
+        with self.conn_lock:
+            found = self.conn_index.get(('hello', user, hello), set())
+            # If we are looking for a specific EP inside a client
+            if found and epname:
+                found = found & self.conn_index.get(('ep', user, epname), set())
             # If address is required, check
-            if addr:
-                # Invalid address !
-                if str_addr.split(':')[0] not in addr:
-                    continue
-
-                # If we are looking for a specific EP inside a client
-                if epname and epname in data.get('eps'):
-                    found = str_addr
-                    break
-                # If not looking for a specific EP, it's ok
-                elif not epname:
-                    found = str_addr
-                    break
-            # Address is not required
-            else:
-                # If we are looking for a specific EP inside a client
-                if epname and epname in data.get('eps'):
-                    found = str_addr
-                    break
-                # If not looking for a specific EP, it's ok
-                elif not epname:
-                    found = str_addr
-                    break
+            if found and addr:
+                found = found & set().union(*[self.conn_index.get(('host', a), set()) for a in addr])
+            found = next(iter(found)) if found else False
 
         # logDebug('Found conn:: {}'.format(pformat(self.conns.get(found), width=140)))
 
@@ -258,6 +295,8 @@ class CeRpycService(rpyc.Service):
             del extra['user']
         if 'checked' in extra:
             del extra['checked']
+        if 'push' in extra:
+            del extra['push']
         if 'eps' in extra:
             # Register the VALID eps...
             self.register_eps(extra['eps'])
@@ -267,6 +306,7 @@ class CeRpycService(rpyc.Service):
             old_data = self.conns.get(str_addr, {})
             old_data.update(extra)
             self.conns[str_addr] = old_data
+            self._index_conn(str_addr)
 
         return True
 
@@ -289,6 +329,7 @@ class CeRpycService(rpyc.Service):
             old_data = self.conns.get(str_addr, {})
             old_data.update({'checked': resp, 'user': user})
             self.conns[str_addr] = old_data
+            self._index_conn(str_addr)
 
         logDebug('User login: `{}`: {}.'.format(user, 'success' if resp else 'failure'))
         return resp
@@ -753,12 +794,12 @@ class CeRpycService(rpyc.Service):
             return False
         eps = []
 
-        for str_addr, data in self.conns.iteritems():
+        with self.conn_lock:
             # There might be more clients for a user...
             # And this Addr might be an EP, not a client
-            if user is not None and user == data.get('user') and data.get('checked'):
+            for str_addr in self.conn_index.get(('user', user), []):
                 # If this connection has registered EPs, append them
-                e = data.get('eps')
+                e = self.conns[str_addr].get('eps')
                 if e:
                     eps.extend(e)
 
@@ -808,27 +849,26 @@ class CeRpycService(rpyc.Service):
                 raise Exception('The EPs were not registered!')
 
             # Before register, find the clients that have already registered these EPs!
-            for c_addr, data in self.conns.iteritems():
-                # Skip invalid connections, without log-in
-                if not data.get('user') or not data.get('checked'):
+            # There might be more clients for a user. Must find all of them.
+            for c_addr in list(self.conn_index.get(('user', user), [])):
+                data = self.conns[c_addr]
+                # This current Addr might be an EP, not a client
+                # If this connection has registered EPs
+                if not data.get('eps'):
                     continue
-                # There might be more clients for a user. Must find all of them.
-                if user == data['user']:
-                    # This current Addr might be an EP, not a client
-                    # If this connection has registered EPs
-                    if not data.get('eps'):
-                        continue
-                    old_eps   = set(data.get('eps'))
-                    new_eps   = set(eps)
-                    diff_eps  = old_eps - new_eps
-                    intersect = old_eps & new_eps
-                    if intersect:
-                        logDebug('Un-register EP list {} from `{}` and register them on `{}`.'\
-                                 ''.format(sorted(intersect), c_addr, str_addr))
-                    # Delete the EPs that must be deleted
-                    self.conns[c_addr]['eps'] = sorted(diff_eps)
+                old_eps   = set(data.get('eps'))
+                new_eps   = set(eps)
+                diff_eps  = old_eps - new_eps
+                intersect = old_eps & new_eps
+                if intersect:
+                    logDebug('Un-register EP list {} from `{}` and register them on `{}`.'\
+                             ''.format(sorted(intersect), c_addr, str_addr))
+                # Delete the EPs that must be deleted
+                self.conns[c_addr]['eps'] = sorted(diff_eps)
+                self._index_conn(c_addr)
 
             self.conns[str_addr]['eps'] = eps
+            self._index_conn(str_addr)
 
         logInfo('Registered client manager for user `{}`\n\t-> Client from `{}` ++ {}.'.format(user, str_addr, eps))
         return True
@@ -879,10 +919,11 @@ class CeRpycService(rpyc.Service):
 
 
     @classmethod
-    def exposed_start_ep(self, epname, usr=None):
+    def exposed_start_ep(self, epname, usr=None, timeout=None):
         """
         Start EP for client.
         This must work from any ExecManager instance.
+        If the client doesn't answer in `timeout` seconds, the call fails.
         """
         logFull('CeRpyc:exposed_start_ep')
         if isinstance(self, CeRpycService):
@@ -901,7 +942,12 @@ class CeRpycService(rpyc.Service):
         conn = self.conns.get(addr, {}).get('conn')
 
         try:
-            result = conn.root.start_ep(epname)
+            if timeout:
+                result = rpyc.async(conn.root.start_ep)(epname)
+                result.set_expiry(timeout)
+                result = result.value
+            else:
+                result = conn.root.start_ep(epname)
             logDebug('Starting `{}:{}`..... {} !'.format(user, epname, result))
             return result
         except:
@@ -911,10 +957,11 @@ class CeRpycService(rpyc.Service):
 
 
     @classmethod
-    def exposed_stop_ep(self, epname, usr=None):
+    def exposed_stop_ep(self, epname, usr=None, timeout=None):
         """
         Stop EP for client.
         This must work from any ExecManager instance.
+        If the client doesn't answer in `timeout` seconds, the call fails.
         """
         logFull('CeRpyc:exposed_stop_ep')
         if isinstance(self, CeRpycService):
@@ -933,7 +980,12 @@ class CeRpycService(rpyc.Service):
         conn = self.conns.get(addr, {}).get('conn')
 
         try:
-            result = conn.root.stop_ep(epname)
+            if timeout:
+                result = rpyc.async(conn.root.stop_ep)(epname)
+                result.set_expiry(timeout)
+                result = result.value
+            else:
+                result = conn.root.stop_ep(epname)
             logDebug('Stopping `{}:{}`..... {} !'.format(user, epname, result))
             return result
         except:
@@ -986,6 +1038,90 @@ class CeRpycService(rpyc.Service):
         return reversed[data.get('status', 8)]
 
 
+    def exposed_subscribe_events(self, epname, file_ids=()):
+        """
+        Called by an EP, to receive its status changes and the status changes
+        of some files (the dependencies) on this connection, instead of polling.
+        The file IDs replace the previous list. Returns the current EP status.
+        """
+        logFull('CeRpyc:exposed_subscribe_events')
+        user = self._check_login()
+        if not user:
+            return False
+
+        if epname not in self.project.get_user_info(user, 'eps'):
+            logDebug('*ERROR* Invalid EP name `{}` !'.format(epname))
+            return False
+
+        # The remote functions are looked up once, here, on the thread of this EP,
+        # so a push from another thread never waits for a round trip to this EP
+        str_addr = self._get_addr()
+        with self.conn_lock:
+            push = self.conns[str_addr].get('push')
+        if not push:
+            try:
+                push = (rpyc.async(self._conn.root.ep_status_changed),
+                    rpyc.async(self._conn.root.file_status_changed))
+            except Exception as e:
+                logWarning('Cannot subscribe EP `{}:{}` to events: `{}`!'.format(user, epname, e))
+                return False
+
+        with self.conn_lock:
+            self.conns[str_addr]['events'] = epname
+            self.conns[str_addr]['watch'] = set(file_ids)
+            self.conns[str_addr]['push'] = push
+
+        return self.exposed_get_ep_status(epname)
+
+
+    @classmethod
+    def _push_events(self, user, select):
+        """
+        Internal function. Select the subscribed connections of one user:
+        `select(data)` returns the arguments of the event, or None.
+        Returns pairs of (async ep_status_changed, async file_status_changed) and arguments.
+        """
+        with self.conn_lock:
+            found = []
+            for str_addr in self.conn_index.get(('user', user), []):
+                data = self.conns[str_addr]
+                if not data.get('push'):
+                    continue
+                args = select(data)
+                if args is not None:
+                    found.append((data['push'], args))
+        return found
+
+
+    @classmethod
+    def push_ep_status(self, user, statuses):
+        """
+        Push the new status of some EPs to the subscribed EPs.
+        The statuses are a dict of EP name: status string.
+        The calls are async, the Central Engine never waits for the EPs.
+        """
+        found = self._push_events(user, lambda data: statuses.get(data['events']))
+        for push, status in found:
+            try:
+                push[0](status)
+            except Exception as e:
+                logDebug('Cannot push the EP status to `{}:{}`: `{}`!'.format(user, status, e))
+
+
+    @classmethod
+    def push_file_status(self, user, epname, file_id, status):
+        """
+        Push the new status of one file to the EPs that watch it.
+        The calls are async, the Central Engine never waits for the EPs.
+        """
+        found = self._push_events(user, lambda data: (file_id in data.get('watch', ())) or None)
+        for push, _ in found:
+            try:
+                push[1](epname, file_id, status)
+            except Exception as e:
+                logDebug('Cannot push the status of file `{}:{}`: `{}`!'.format(user, file_id, e))
+
+
     def exposed_get_ep_status_all(self):
         """
         Return execution status for all EPs. (stopped, paused, running, invalid)
@@ -1050,6 +1186,21 @@ class CeRpycService(rpyc.Service):
         return self.project.set_file_status(user, epname, file_id, new_status, time_elapsed)
 
 
+    def exposed_report_file_result(self, epname, file_id, new_status=None, time_elapsed=0.0, variables=(), log_msg=''):
+        """
+        Bulk update for one file: custom variables, status, last seen alive and log markers.
+        The variables should be a tuple of (key, value) pairs, to travel in one round trip.
+        Returns a pair with the file status and the EP status.
+        Called from the Runner.
+        """
+        logFull('CeRpyc:exposed_report_file_result')
+        user = self._check_login()
+        if not user:
+            return False
+        return self.project.report_file_result(user, epname, file_id, new_status,
+            time_elapsed, variables, log_msg)
+
+
     def exposed_set_file_status_all(self, epname, new_status):
         """
         Reset file status for all files of one EP.
@@ -1086,7 +1237,150 @@ class CeRpycService(rpyc.Service):
         user = self._check_login()
         if not user:
             return False
+        return self._cached_library(user, name)[1]
+
+
+    def exposed_download_libraries(self, libs, chunk=0):
+        """
+        Sends a list of libraries to the EP, to be syncronized.
+        The EP sends pairs of (library name, the hash it already has) and receives
+        tuples of (library name, hash, data); the data is empty if the library didn't change.
+        If `chunk` is set, the data is None for the libraries bigger than this,
+        and the EP downloads them with `download_library_chunk`.
+        """
+        logFull('CeRpyc:exposed_download_libraries')
+        user = self._check_login()
+        if not user:
+            return False
+
+        # The ClearCase libraries are not cached, so they are not sent in chunks
+        if self.project.get_clearcase_config(user, 'libs_path'):
+            chunk = 0
+
+        result = []
+        for name, known_hash in libs:
+            lib_hash, data = self._cached_library(user, name)
+            if known_hash and lib_hash == known_hash:
+                data = ''
+            elif chunk and len(data) > chunk and not data.startswith('*ERROR*'):
+                data = None
+            result.append((name, lib_hash, data))
+
+        return tuple(result)
+
+
+    def exposed_download_library_chunk(self, name, lib_hash, fstart=0, fsize=1024*1024, compress=True):
+        """
+        Sends a chunk of a packed library to the EP, starting at `fstart`.
+        Returns a tuple (data, library size); the data is zlib compressed, if `compress`.
+        If the library changed since the download started (other hash), returns an error.
+        """
+        logFull('CeRpyc:exposed_download_library_chunk')
+        user = self._check_login()
+        if not user:
+            return False
+
+        cur_hash, data = self._cached_library(user, name)
+        if data.startswith('*ERROR*'):
+            return data
+        if lib_hash and cur_hash != lib_hash:
+            return '*ERROR* Library `{}` changed during the download!'.format(name)
 
+        chunk = data[fstart:fstart + fsize]
+        if compress:
+            chunk = zlib.compress(chunk, 1)
+        return chunk, len(data)
+
+
+    @staticmethod
+    def _lib_stamp(path):
+        """
+        Returns the last modification time, the size and the number of files
+        of a library file or folder, or None if the path doesn't exist.
+        """
+        try:
+            if not os.path.isdir(path):
+                fstat = os.stat(path)
+                return (fstat.st_mtime, fstat.st_size, 1)
+            mtime, size, count = 0, 0, 0
+            for root, dirs, files in os.walk(path):
+                # The mtime of a folder changes when files are added or removed
+                mtime = max(mtime, os.stat(root).st_mtime)
+                for fname in files:
+                    fstat = os.stat(os.path.join(root, fname))
+                    mtime = max(mtime, fstat.st_mtime)
+                    size += fstat.st_size
+                    count += 1
+            return (mtime, size, count)
+        except Exception:
+            return None
+
+
+    def _cached_library(self, user, name):
+        """
+        Returns the hash and the data of one library.\n
+        The packed libraries are kept in memory and they are packed again
+        only when the files from the user or the global library path change.
+        """
+        # Maybe the name begins with /
+        name = name.lstrip('/')
+
+        # The ClearCase libraries are not cached
+        if self.project.get_clearcase_config(user, 'libs_path'):
+            data = self._download_library(user, name)
+            return hashlib.md5(data).hexdigest(), data
+
+        user_lib = self.project.get_user_info(user, 'libs_path').rstrip('/') + '/'
+        glob_lib_path = (TWISTER_PATH + '/lib/' + name).replace('//', '/')
+        key = (user, name)
+
+        with self.libs_lock:
+            lock = self.libs_locks.setdefault(key, thread.allocate_lock())
+
+        with lock:
+            with self.libs_lock:
+                cached = self.libs.get(key)
+            if cached and time.time() - cached[3] < self.libs_check:
+                self._keep_library(key, cached)
+                return cached[1], cached[2]
+
+            stamp = (self._lib_stamp(user_lib + name), self._lib_stamp(glob_lib_path))
+            if cached and cached[0] == stamp:
+                self._keep_library(key, cached[:3] + (time.time(),))
+                return cached[1], cached[2]
+
+            data = self._download_library(user, name)
+            lib_hash = hashlib.md5(data).hexdigest()
+
+            # The errors are not cached
+            if data.startswith('*ERROR*'):
+                with self.libs_lock:
+                    self.libs.pop(key, None)
+            else:
+                self._keep_library(key, (stamp, lib_hash, data, time.time()))
+
+        return lib_hash, data
+
+
+    def _keep_library(self, key, entry):
+        """
+        Save a packed library as the most recently used and drop the
+        least recently used libraries, over `libs_max_size` bytes.
+        """
+        with self.libs_lock:
+            self.libs.pop(key, None)
+            self.libs[key] = entry
+            size = sum(len(lib[2]) for lib in self.libs.itervalues())
+            while size > self.libs_max_size and len(self.libs) > 1:
+                old_key, old = self.libs.popitem(last=False)
+                self.libs_locks.pop(old_key, None)
+                size -= len(old[2])
+
+
+    def _download_library(self, user, name):
+        """
+        Reads or packs one library, without cache.
+        """
         # Maybe the name begins with /
         name = name.lstrip('/')
         # Global lib path
@@ -1096,9 +1390,6 @@ class CeRpycService(rpyc.Service):
             """
             Just read a file.
             """
-            import tarfile
-            import cStringIO
-
             if not os.path.exists(glob_lib_path):
                 err = '*ERROR* Invalid library `{}`!'.format(glob_lib_path)
                 return err
@@ -1121,11 +1412,10 @@ class CeRpycService(rpyc.Service):
                     return err
 
             else:
-                os.chdir(root)
                 io = cStringIO.StringIO()
                 # Write the folder tar.gz into memory
                 with tarfile.open(fileobj=io, mode='w:gz') as binary:
-                    binary.add(name=fname, recursive=True)
+                    binary.add(name=os.path.join(root, fname), arcname=fname, recursive=True)
                 if '/' in name:
                     logDebug('User `{}` requested global `deep` library `{}`.'.format(user, fname))
                 else:
@@ -1218,15 +1508,13 @@ class CeRpycService(rpyc.Service):
         return data
 
 
-    def exposed_download_file(self, epname, file_info):
+    def _download_file_path(self, user, epname, file_info, first=True):
         """
-        Sends requested file to the EP, to be executed.
+        Find the path of a file requested by the EP: a test file path, or a file ID.
+        The ClearCase revision is set only for the `first` chunk of a file.
+        Returns a tuple (file path, ClearCase view), or False.
         """
-        logFull('CeRpyc:exposed_download_file')
-        user = self._check_login()
-        if not user:
-            return False
-
+        logFull('CeRpyc:_download_file_path')
         if epname not in self.project.get_user_info(user, 'eps'):
             logDebug('*ERROR* Invalid EP name `{}` !'.format(epname))
             return False
@@ -1235,42 +1523,112 @@ class CeRpycService(rpyc.Service):
 
         # If this is a test file path
         if os.path.isfile(tests_path + os.sep + file_info):
-            filename = tests_path + os.sep + file_info
+            return tests_path + os.sep + file_info, None
 
         # If this is a file ID
-        else:
-            file_id = file_info
-            data = self.project.get_file_info(user, epname, file_id)
-            if not data:
-                logError('*ERROR* Invalid File ID `{}` !'.format(file_id))
-                return False
+        file_id = file_info
+        data = self.project.get_file_info(user, epname, file_id)
+        if not data:
+            logError('*ERROR* Invalid File ID `{}` !'.format(file_id))
+            return False
 
-            filename = data['file']
+        filename = data['file']
 
-            # Auto detect if ClearCase Test Config Path is active
-            ccConfig = self.project.get_clearcase_config(user, 'tests_path')
-            if ccConfig and data.get('clearcase'):
-                logDebug('Execution process `{}:{}` requested ClearCase file `{}`.'.format(user, epname, filename))
-                # Set TC Revision variable
+        # Auto detect if ClearCase Test Config Path is active
+        ccConfig = self.project.get_clearcase_config(user, 'tests_path')
+        if ccConfig and data.get('clearcase'):
+            # Set TC Revision variable
+            if first:
                 self.project.set_file_info(user, epname, file_id, 'twister_tc_revision', -1)
-                view = ccConfig['view']
-                # Read ClearCase TestCase file
-                text = self.project.read_file(user, filename, type='clearcase:' + view)
-                return text
-            # End of ClearCase hack !
+            return filename, ccConfig['view']
+        # End of ClearCase hack !
+
+        # Fix ~ $HOME path (from project XML)
+        if filename.startswith('~'):
+            filename = userHome(user) + filename[1:]
+        # Fix incomplete file path (from project XML)
+        if not os.path.isfile(filename):
+            filename = tests_path + os.sep + filename
+
+        return filename, None
 
-            # Fix ~ $HOME path (from project XML)
-            if filename.startswith('~'):
-                filename = userHome(user) + filename[1:]
-            # Fix incomplete file path (from project XML)
-            if not os.path.isfile(filename):
-                filename = tests_path + os.sep + filename
+
+    def exposed_download_file(self, epname, file_info):
+        """
+        Sends requested file to the EP, to be executed.
+        """
+        logFull('CeRpyc:exposed_download_file')
+        user = self._check_login()
+        if not user:
+            return False
+
+        found = self._download_file_path(user, epname, file_info)
+        if not found:
+            return False
+        filename, view = found
+
+        if view:
+            logDebug('Execution process `{}:{}` requested ClearCase file `{}`.'.format(user, epname, filename))
+            # Read ClearCase TestCase file
+            return self.project.read_file(user, filename, type='clearcase:' + view)
 
         logDebug('Execution process `{}:{}` requested file `{}`.'.format(user, epname, filename))
 
         return self.project.localFs.read_user_file(user, filename, 'rb')
 
 
+    def exposed_download_file_chunk(self, epname, file_info, fstart=0, fsize=1024*1024, compress=True):
+        """
+        Sends a chunk of the requested file to the EP, starting at `fstart`.
+        Returns a tuple (data, file size); the data is zlib compressed, if `compress`.
+        Big files never travel in one piece, and a broken download can be resumed.
+        """
+        logFull('CeRpyc:exposed_download_file_chunk')
+        user = self._check_login()
+        if not user:
+            return False
+
+        key = (user, epname)
+        if fstart:
+            # The ClearCase file read for the first chunk
+            with self.cc_files_lock:
+                cc_file = self.cc_files.get(key)
+                # Drop it after the last chunk
+                if cc_file and fstart + fsize >= len(cc_file[1]):
+                    self.cc_files.pop(key, None)
+            if cc_file and cc_file[0] == file_info:
+                text = cc_file[1]
+                data = text[fstart:fstart + fsize]
+                if compress:
+                    data = zlib.compress(data, 1)
+                return data, len(text)
+
+        found = self._download_file_path(user, epname, file_info, not fstart)
+        if not found:
+            return False
+        filename, view = found
+
+        if not fstart:
+            logDebug('Execution process `{}:{}` requested file `{}`, in chunks.'.format(user, epname, filename))
+
+        if view:
+            # ClearCase files are small; read the text once and slice it
+            text = self.project.read_file(user, filename, type='clearcase:' + view)
+            if not isinstance(text, str) or text.startswith('*ERROR*'):
+                return text
+            with self.cc_files_lock:
+                if len(text) > fsize:
+                    self.cc_files[key] = (file_info, text)
+                else:
+                    self.cc_files.pop(key, None)
+            data = text[fstart:fstart + fsize]
+            if compress:
+                data = zlib.compress(data, 1)
+            return data, len(text)
+
+        return self.project.localFs.read_user_file_chunk(user, filename, fstart, fsize, compress)
+
+
 # # #   Plugins   # # #
 
 
@@ -1282,12 +1640,23 @@ class CeRpycService(rpyc.Service):
         user = self._check_login()
         if not user:
             return False
-        parser = PluginParser(user)
-        pluginsList = parser.getPlugins()
+        pluginsList = self.project.get_plugins(user)
         logFull('List Plug-ins: user `{}` has: {}.'.format(user, pluginsList))
         return pluginsList.keys()
 
 
+    def exposed_reload_plugins(self):
+        """
+        Reload the plugins config and the plugin files.
+        The plugins are created again, on the next call.
+        """
+        logFull('CeRpyc:exposed_reload_plugins')
+        user = self._check_login()
+        if not user:
+            return False
+        return self.project.reload_plugins(user)
+
+
     def exposed_run_plugin(self, plugin, args):
         """
         Exposed API for running plug-ins from Execution Processes.
@@ -1360,6 +1729,18 @@ class CeRpycService(rpyc.Service):
         return self.project.log_live(user, epname, log_message)
 
 
+    def exposed_log_live_stream(self, epname, frame, compressed=True):
+        """
+        Writes CLI messages in a big log, binary frames, compressed with zlib.
+        Returns the number of seconds the EP should wait before the next frame.
+        """
+        logFull('CeRpyc:exposed_log_live_stream')
+        user = self._check_login()
+        if not user:
+            return False
+        return self.project.log_live_stream(user, epname, frame, compressed)
+
+
     def exposed_reset_log(self, log_name):
         """
         Resets one log.
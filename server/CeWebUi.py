@@ -1,7 +1,7 @@
 
 # File: CeWebUi.py ; This file is part of Twister.
 
-# version: 3.003
+# version: 3.004
 
 # Copyright (C) 2012-2013 , Luxoft
 
@@ -197,7 +197,7 @@ class WebInterface(object):
         cherrypy.response.headers['Cache-Control'] = 'no-cache, no-store, must-revalidate'
         cherrypy.response.headers['Pragma']  = 'no-cache'
         cherrypy.response.headers['Expires'] = 0
-        return open(TWISTER_PATH + '/config/project_users.json', 'r').read()
+        return self.project.load_dump()
 
 
     @cherrypy.expose
@@ -1,7 +1,7 @@
 
 # File: CeXmlRpc.py ; This file is part of Twister.
 
-# version: 3.013
+# version: 3.014
 
 # Copyright (C) 2012-2014 , Luxoft
 
@@ -337,6 +337,17 @@ class CeXmlRpc(_cptools.XMLRPCController):
         return self.project.list_files(user, fdir, hidden, recursive, type)
 
 
+    @cherrypy.expose
+    def list_files_delta(self, fdir, token='', hidden=True, type='fs'):
+        """
+        List files from user's home folder, or ClearCase.
+        Returns only the changes since the listing identified by `token`;
+        with an empty or expired token, the complete listing is returned.
+        """
+        user = cherrypy.session.get('username')
+        return self.project.list_files_delta(user, fdir, token, hidden, type)
+
+
     @cherrypy.expose
     def delete_folder(self, fdir, type='fs'):
         """
@@ -645,6 +656,26 @@ class CeXmlRpc(_cptools.XMLRPCController):
         return ret
 
 
+    @cherrypy.expose
+    def commit_to_database_async(self, user):
+        """
+        Same as `commit_to_database`, but the results are saved in background.\n
+        Returns a job ID immediately; the job is followed with `commit_status`.
+        """
+        logDebug('CE: Queue save into database for user `{}`...'.format(user))
+        return self.project.save_to_database_async(user, delay=2)
+
+
+    @cherrypy.expose
+    def commit_status(self, user, job_id=''):
+        """
+        Status of a database save job: queued, running, done or failed,
+        the progress as (files done, total files), the retries and the error.\n
+        If the job ID is empty, returns all the jobs of the user.
+        """
+        return self.project.save_job_status(user, job_id)
+
+
     @cherrypy.expose
     def get_shared_db(self):
         """
@@ -1311,11 +1342,20 @@ class CeXmlRpc(_cptools.XMLRPCController):
         List all user plugins.
         """
         logFull('CeXmlRpc:list_plugins user `{}`.'.format(user))
-        parser = PluginParser(user)
-        pluginsList = parser.getPlugins()
+        pluginsList = self.project.get_plugins(user)
         return pluginsList.keys()
 
 
+    @cherrypy.expose
+    def reload_plugins(self, user):
+        """
+        Reload the plugins config and the plugin files.
+        The plugins are created again, on the next call.
+        """
+        logFull('CeXmlRpc:reload_plugins user `{}`.'.format(user))
+        return self.project.reload_plugins(user)
+
+
     @cherrypy.expose
     def run_plugin(self, user, plugin, args):
         """
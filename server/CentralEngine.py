@@ -1,6 +1,6 @@
 #!/usr/bin/env python2.7
 
-# version: 3.005
+# version: 3.006
 
 # File: CentralEngine.py ; This file is part of Twister.
 
@@ -118,6 +118,9 @@ if __name__ == "__main__":
     def close():
         """ Close server. """
         RPYC_SERVER.close()
+        # Save the last changes of the project
+        PROJ._flush_dump()
+        PROJ._flush_live_logs()
         del PROJ.manager
 
     PROJ.ip_port = ('127.0.0.1', SERVER_PORT)
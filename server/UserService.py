@@ -1,7 +1,7 @@
 
 # File: UserService.py ; This file is part of Twister.
 
-# version: 3.015
+# version: 3.016
 
 # Copyright (C) 2012-2014 , Luxoft
 
@@ -33,12 +33,18 @@ import re
 import sys
 import pwd
 import grp
+import json
+import stat
 import time
+import zlib
 import shutil
+import tempfile
 import subprocess
+import thread
 import tarfile
 import cStringIO
 import multiprocessing
+from collections import OrderedDict
 
 
 import rpyc
@@ -73,6 +79,16 @@ def logError(msg):
     """ error """
     log_msg("ERROR", msg)
 
+# Default size of a file chunk, sent over RPyc
+CHUNK_SIZE = 1024 * 1024
+# At most this many files are kept open for append
+APPEND_MAX = 32
+# A file that was not appended for this many seconds is closed (eg: the EP run ended)
+APPEND_IDLE = 60.0
+# The stat of the folder entries is cached for this many seconds;
+# writing into a file doesn't change the modification time of the folder
+STAT_TTL = 10.0
+
 pattern = re.compile('from[\s]+([\w]+).*?[\s]+import|[\s]*import[\s]+([\w]+)[\s]*\n')
 
 def worker(files):
@@ -94,6 +110,246 @@ if sys.version < '2.7':
 
 
 lastMsg = ''
+appendFiles = OrderedDict() # Files kept open for append, for each path: (file, last write), oldest first
+appendLock = thread.allocate_lock() # Append files lock
+uidNames = {}    # User names, for each UID
+gidNames = {}    # Group names, for each GID
+dirNames = {}    # Sorted names and stat of the entries from each folder, with the folder modification time
+listSnapshots = [] # Last listings, for the delta mode: (token, folder, flat listing)
+
+
+def user_name(uid):
+    """ User name for one UID, cached """
+    try:
+        return uidNames[uid]
+    except KeyError:
+        pass
+    try:
+        name = pwd.getpwuid(uid).pw_name
+    except Exception:
+        name = uid
+    uidNames[uid] = name
+    return name
+
+def group_name(gid):
+    """ Group name for one GID, cached """
+    try:
+        return gidNames[gid]
+    except KeyError:
+        pass
+    try:
+        name = grp.getgrgid(gid).gr_name
+    except Exception:
+        name = gid
+    gidNames[gid] = name
+    return name
+
+def folder_names(path):
+    """
+    Sorted names from one folder and the stat cache of its entries (see `entry_stat`),
+    cached by the folder modification time; the stat cache is emptied every `STAT_TTL` seconds.
+    A folder changed in the last 2 seconds is not cached, the mtime might not be precise enough.
+    """
+    now = time.time()
+    mtime = os.stat(path).st_mtime
+    cached = dirNames.get(path)
+    if cached and cached['mtime'] == mtime:
+        if now - cached['checked'] > STAT_TTL:
+            cached['stats'] = {}
+            cached['checked'] = now
+        return cached['names'], cached['stats']
+    names = sorted(os.listdir(path), key=str.lower)
+    stats = {}
+    if now - mtime > 2:
+        if len(dirNames) > 100000:
+            dirNames.clear()
+        dirNames[path] = {'mtime': mtime, 'names': names, 'stats': stats, 'checked': now}
+    return names, stats
+
+def entry_stat(path, fname, stats):
+    """
+    Stat of one folder entry, as (mode, uid, gid, size, mtime), or None; cached in `stats`.
+    """
+    try:
+        return stats[fname]
+    except KeyError:
+        pass
+    try:
+        fstat = os.stat(path + '/' + fname)
+        fstat = (fstat.st_mode, fstat.st_uid, fstat.st_gid, fstat.st_size, fstat.st_mtime)
+    except Exception:
+        fstat = None
+    stats[fname] = fstat
+    return fstat
+
+def path_matcher(patterns):
+    """
+    Returns a function that checks if a path starts, or ends with one of the patterns.
+    Long lists (eg: the results of a search) are checked with a set of prefixes and suffixes.
+    """
+    if isinstance(patterns, basestring):
+        patterns = (patterns,)
+    elif isinstance(patterns, (list, tuple)):
+        patterns = tuple(patterns)
+    else:
+        return None
+    if not patterns:
+        return None
+    if len(patterns) <= 32 or '' in patterns:
+        return lambda path: path.startswith(patterns) or path.endswith(patterns)
+    pset = set(patterns)
+    def match(path):
+        for i in xrange(1, len(path) + 1):
+            if path[:i] in pset or path[-i:] in pset:
+                return True
+        return False
+    return match
+
+def list_folder(folder, hidden=True, recursive=True, accept=[], reject=[]):
+    """
+    List all files from a folder. `recursive` can be True, False, or the number of levels.
+    """
+    if folder[0] == '~':
+        folder = USER_HOME + folder[1:]
+    if folder == '/':
+        base_path = '/'
+        logWarning('*WARN* Listing folders from system ROOT.')
+        recursive = False
+    else:
+        base_path = folder.rstrip('/')
+
+    if not os.path.isdir(folder):
+        err = '*ERROR* Invalid folder path `{}`!'.format(folder)
+        logWarning(err)
+        return err
+
+    # Number of levels; -1 means all
+    if recursive is True:
+        depth = -1
+    elif not recursive:
+        depth = 1
+    else:
+        depth = int(recursive)
+
+    # If Accept is active and file doesn't match, ignore file
+    accept_m = path_matcher(accept)
+    # If Reject is active and file matches, ignore the file
+    reject_m = path_matcher(reject)
+    len_path = len(base_path) + 1
+
+    def dirList(path, level):
+        """
+        Create recursive list of folders and files from base path.
+        The format of a node is: {"path": "/..." "data": "name", "folder":true|false, "children": []}
+        """
+        # The node is valid ?
+        if not path:
+            return False
+        # Cleanup '/'
+        if path != '/':
+            path = path.rstrip('/')
+
+        dlist = [] # Folders list
+        flist = [] # Files list
+
+        try:
+            names, stats = folder_names(path)
+        except Exception as e:
+            logWarning('*WARN* Cannot list folder `{}`: `{}`!'.format(path, e))
+            return []
+
+        # Cycle a folder
+        for fname in names:
+            # Ignore hidden files
+            if hidden and fname[0] == '.':
+                continue
+
+            long_path = path + '/' + fname
+
+            # Meta info, one stat for each file, cached with the folder
+            fstat = entry_stat(path, fname, stats)
+
+            is_dir = fstat is not None and stat.S_ISDIR(fstat[0])
+            is_file = fstat is not None and stat.S_ISREG(fstat[0])
+
+            if is_file and accept_m and not accept_m(long_path):
+                continue
+            if is_file and reject_m and reject_m(long_path):
+                continue
+
+            if fstat is not None:
+                meta_info = '{}|{}|{}|{}'.format(user_name(fstat[1]), group_name(fstat[2]), fstat[3],
+                    time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(fstat[4])))
+            else:
+                meta_info = ''
+
+            # Semi long path
+            short_path = long_path[len_path:]
+            # Data to append
+            nd = {'path': short_path, 'data': fname, 'meta': meta_info}
+
+            if is_dir:
+                nd['folder'] = True
+                # Recursive !
+                if level != 1:
+                    children = dirList(long_path, level - 1)
+                else:
+                    children = []
+                if children in [False, None]:
+                    continue
+                nd['children'] = children
+                dlist.append(nd)
+            else:
+                flist.append(nd)
+
+        # Folders first, files second
+        return dlist + flist
+
+    paths = {
+        'path' : '/',
+        'data' : base_path,
+        'folder' : True,
+        'children' : dirList(base_path, depth) or []
+    }
+
+    clen = len(paths['children'])
+    logDebug('Listing dir `{}`, it has `{}` direct children.'.format(base_path, clen))
+    return paths
+
+def flatten_listing(node, result):
+    """ Flat listing: path -> node without children """
+    for child in node.get('children', []):
+        nd = dict(child)
+        nd.pop('children', None)
+        result[child['path']] = nd
+        flatten_listing(child, result)
+    return result
+
+
+def close_append_files(idle=0):
+    """
+    Close the files kept open for append, that were not written in the last `idle` seconds,
+    and the oldest files over the limit.
+    """
+    now = time.time()
+    with appendLock:
+        for fpath, (f, used) in appendFiles.items():
+            if len(appendFiles) <= APPEND_MAX and now - used < idle:
+                break
+            del appendFiles[fpath]
+            try:
+                f.close()
+            except Exception:
+                pass
+
+
+def close_idle_files():
+    """
+    Thread that closes the append files of the finished runs.
+    """
+    while 1:
+        time.sleep(APPEND_IDLE / 2)
+        close_append_files(APPEND_IDLE)
 
 #
 
@@ -160,9 +416,9 @@ class UserService(rpyc.Service):
 
 
     @staticmethod
-    def exposed_read_file(fpath, flag='r', fstart=0):
+    def exposed_read_file(fpath, flag='r', fstart=0, fend=None):
         """
-        Read 1 file.
+        Read 1 file, or the bytes from `fstart` to `fend`.
         Less spam, please.
         """
         global lastMsg
@@ -184,7 +440,10 @@ class UserService(rpyc.Service):
                     lastMsg = msg
                 if fstart:
                     f.seek(fstart)
-                fdata = f.read()
+                if fend is None:
+                    fdata = f.read()
+                else:
+                    fdata = f.read(max(0, fend - fstart))
                 if len(fdata) > 20*1000*1000:
                     err = '*ERROR* File data too long `{}`: {}!'.format(fpath, len(fdata))
                     logWarning(err)
@@ -196,6 +455,35 @@ class UserService(rpyc.Service):
             return err
 
 
+    @staticmethod
+    def exposed_read_file_chunk(fpath, fstart=0, fsize=CHUNK_SIZE, compress=False):
+        """
+        Read `fsize` bytes from 1 file, starting at `fstart`.
+        Returns a tuple (data, file size), so the caller knows when to stop,
+        or an error string.
+        """
+        if fpath[0] == '~':
+            fpath = USER_HOME + fpath[1:]
+        if not os.path.isfile(fpath):
+            err = '*ERROR* No such file `{}`!'.format(fpath)
+            logWarning(err)
+            return err
+        fsize = min(max(int(fsize), 1), 16 * CHUNK_SIZE)
+        try:
+            with open(fpath, 'rb') as f:
+                total = os.fstat(f.fileno()).st_size
+                if fstart:
+                    f.seek(fstart)
+                fdata = f.read(fsize)
+        except Exception as e:
+            err = '*ERROR* Cannot read file `{}`! {}'.format(fpath, e)
+            logWarning(err)
+            return err
+        if compress:
+            fdata = zlib.compress(fdata, 1)
+        return fdata, total
+
+
     @staticmethod
     def exposed_write_file(fpath, fdata, flag='a'):
         """
@@ -227,6 +515,45 @@ class UserService(rpyc.Service):
             return err
 
 
+    @staticmethod
+    def exposed_append_file(fpath, fdata):
+        """
+        Append data in a file, using a file handle that is kept open.
+        Used for the live logs, so the file is not opened for every chunk.
+        Returns the size of the file, after writing.
+        """
+        if fpath[0] == '~':
+            fpath = USER_HOME + fpath[1:]
+        with appendLock:
+            f = appendFiles.pop(fpath, (None, 0))[0]
+            try:
+                # The file was deleted, or replaced
+                if f and os.fstat(f.fileno()).st_ino != os.stat(fpath).st_ino:
+                    f.close()
+                    f = None
+            except Exception:
+                if f:
+                    f.close()
+                f = None
+            try:
+                if not f:
+                    f = open(fpath, 'ab')
+                f.write(fdata)
+                f.flush()
+                size = os.fstat(f.fileno()).st_size
+                # The last written file goes at the end
+                appendFiles[fpath] = (f, time.time())
+            except Exception as e:
+                if f:
+                    f.close()
+                err = '*ERROR* Cannot append into file `{}`! {}'.format(fpath, e)
+                logWarning(err)
+                return err
+        if len(appendFiles) > APPEND_MAX:
+            close_append_files(APPEND_IDLE)
+        return size
+
+
     @staticmethod
     def exposed_copy_file(fpath, newpath):
         """
@@ -273,6 +600,10 @@ class UserService(rpyc.Service):
         if fpath[0] == '~':
             fpath = USER_HOME + fpath[1:]
         try:
+            with appendLock:
+                f = appendFiles.pop(fpath, (None, 0))[0]
+            if f:
+                f.close()
             os.remove(fpath)
             logDebug('Deleted file `{}`.'.format(fpath))
             return True
@@ -300,130 +631,62 @@ class UserService(rpyc.Service):
 
 
     @staticmethod
-    def exposed_list_files(folder, hidden=True, recursive=True, accept=[], reject=[]):
+    def exposed_list_files(folder, hidden=True, recursive=True, accept=[], reject=[], as_json=False):
         """
-        List all files, recursively.
+        List all files, recursively, or only a few levels.
+        If `as_json` is True, the listing is returned as a JSON string,
+        which is much faster than accessing a remote dictionary.
         """
-        if folder[0] == '~':
-            folder = USER_HOME + folder[1:]
-        if folder == '/':
-            base_path = '/'
-            logWarning('*WARN* Listing folders from system ROOT.')
-            recursive = False
-        else:
-            base_path = folder.rstrip('/')
-
-        if not os.path.isdir(folder):
-            err = '*ERROR* Invalid folder path `{}`!'.format(folder)
-            logWarning(err)
-            return err
-
-        def dirList(path):
-            """
-            Create recursive list of folders and files from base path.
-            The format of a node is: {"path": "/..." "data": "name", "folder":true|false, "children": []}
-            """
-            # The node is valid ?
-            if not path:
-                return False
-            # Cleanup '/'
-            if path != '/':
-                path = path.rstrip('/')
-            # This is folder ?
-            if os.path.isfile(path):
-                return False
-
-            len_path = len(base_path) + 1
-            dlist = [] # Folders list
-            flist = [] # Files list
-
+        paths = list_folder(folder, hidden, recursive, accept, reject)
+        if as_json and isinstance(paths, dict):
             try:
-                names = sorted(os.listdir(path), key=str.lower)
-            except Exception as e:
-                logWarning('*WARN* Cannot list folder `{}`: `{}`!'.format(path, e))
-                return []
-
-            # Cycle a folder
-            for fname in names:
-                long_path  = path + '/' + fname
-
-                # If Accept is active and file doesn't match, ignore file
-                if accept and os.path.isfile(long_path):
-                    valid = True
-                    if isinstance(accept, list):
-                        # If nothing from the Accept matches the file
-                        if True not in [(long_path.startswith(f) or long_path.endswith(f)) for f in accept]:
-                            valid = False
-                    elif isinstance(accept, str):
-                        if not (long_path.startswith(accept) or long_path.endswith(accept)):
-                            valid = False
-                    if not valid:
-                        continue
-
-                # If Reject is active and file matches, ignore the file
-                if reject and os.path.isfile(long_path):
-                    valid = True
-                    if isinstance(reject, list):
-                        # If nothing from the Reject matches the file
-                        if True in [(long_path.startswith(f) or long_path.endswith(f)) for f in reject]:
-                            valid = False
-                    elif isinstance(reject, str):
-                        if long_path.startswith(reject) or long_path.endswith(reject):
-                            valid = False
-                    if not valid:
-                        continue
-
-                # Ignore hidden files
-                if hidden and fname[0] == '.':
-                    continue
-                # Meta info
-                try:
-                    fstat = os.stat(long_path)
-                    try:
-                        uname = pwd.getpwuid(fstat.st_uid).pw_name
-                    except Exception:
-                        uname = fstat.st_uid
-                    try:
-                        gname = grp.getgrgid(fstat.st_gid).gr_name
-                    except Exception:
-                        gname = fstat.st_gid
-                    meta_info = '{}|{}|{}|{}'.format(uname, gname, fstat.st_size,
-                        time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(fstat.st_mtime)))
-                except Exception:
-                    meta_info = ''
-
-                # Semi long path
-                short_path = long_path[len_path:]
-                # Data to append
-                nd = {'path': short_path, 'data': fname, 'meta': meta_info}
-
-                if os.path.isdir(long_path):
-                    nd['folder'] = True
-                    # Recursive !
-                    if recursive:
-                        children = dirList(long_path)
-                    else:
-                        children = []
-                    if children in [False, None]:
-                        continue
-                    nd['children'] = children
-                    dlist.append(nd)
-                else:
-                    flist.append(nd)
+                return json.dumps(paths)
+            except Exception:
+                # Invalid encoding in some file names
+                pass
+        return paths
 
-            # Folders first, files second
-            return dlist + flist
 
-        paths = {
-            'path' : '/',
-            'data' : base_path,
-            'folder' : True,
-            'children' : dirList(base_path) or []
-        }
+    @staticmethod
+    def exposed_list_files_delta(folder, token='', hidden=True, accept=[], reject=[]):
+        """
+        List all files, recursively, but return only the changes since the listing
+        identified by `token`, as a JSON string. The result has a new token and:
+        - if the token is known: `added` and `changed` nodes (without children) and `removed` paths;
+        - if the token is unknown (eg: the first call), `full` is True and `data` has the complete listing.
+        """
+        paths = list_folder(folder, hidden, True, accept, reject)
+        if not isinstance(paths, dict):
+            return paths
+
+        flat = flatten_listing(paths, {})
+        new_token = os.urandom(8).encode('hex')
+        old = None
+        for snap_token, snap_folder, snap_flat in listSnapshots:
+            if token and snap_token == token and snap_folder == folder:
+                old = snap_flat
+                break
+
+        listSnapshots.append((new_token, folder, flat))
+        # Keep only the last listings
+        del listSnapshots[:-16]
+
+        if old is None:
+            result = {'token': new_token, 'full': True, 'data': paths}
+        else:
+            result = {
+                'token': new_token, 'full': False,
+                'added': [flat[p] for p in sorted(set(flat) - set(old))],
+                'removed': sorted(set(old) - set(flat)),
+                'changed': [flat[p] for p in sorted(set(flat) & set(old)) if flat[p] != old[p]],
+            }
 
-        clen = len(paths['children'])
-        logDebug('Listing dir `{}`, it has `{}` direct children.'.format(base_path, clen))
-        return paths
+        try:
+            return json.dumps(result)
+        except Exception as e:
+            err = '*ERROR* Cannot list folder `{}`: `{}`!'.format(folder, e)
+            logWarning(err)
+            return err
 
 
     @staticmethod
@@ -461,14 +724,45 @@ class UserService(rpyc.Service):
         else:
             root, name = os.path.split(folder)
         logDebug('Tar.gz folder: `{}`, root: `{}`.'.format(name, root))
-        os.chdir(root)
         io = cStringIO.StringIO()
         # Write the folder tar.gz into memory
         with tarfile.open(fileobj=io, mode='w:gz') as binary:
-            binary.add(name=name, recursive=True)
+            binary.add(name=os.path.join(root, name), arcname=name, recursive=True)
         return io.getvalue()
 
 
+    @staticmethod
+    def exposed_targz_folder_file(folder, root=''):
+        """
+        Compress a folder into a temporary file and return the file path.
+        The caller reads it with `read_file_chunk` and deletes it after.
+        """
+        if (root not in folder) or (not os.path.isdir(root)):
+            root = ''
+        if folder[0] == '~':
+            folder = USER_HOME + folder[1:]
+        if not os.path.exists(folder):
+            err = '*ERROR* Invalid path `{}`!'.format(folder)
+            logWarning(err)
+            return err
+        if root:
+            name = folder[len(root):]
+        else:
+            root, name = os.path.split(folder)
+        logDebug('Tar.gz folder: `{}`, root: `{}`, into a file.'.format(name, root))
+        fd, fpath = tempfile.mkstemp(prefix='twister_', suffix='.tar.gz')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                with tarfile.open(fileobj=f, mode='w:gz') as binary:
+                    binary.add(name=os.path.join(root, name), arcname=name, recursive=True)
+        except Exception as e:
+            os.remove(fpath)
+            err = '*ERROR* Cannot compress folder `{}`! {}'.format(folder, e)
+            logWarning(err)
+            return err
+        return fpath
+
+
     @staticmethod
     def exposed_detect_libraries(files):
         """
@@ -545,6 +839,8 @@ if __name__ == '__main__':
 
     USER_HOME = subprocess.check_output('echo ~' + userName, shell=True).strip().rstrip('/')
 
+    thread.start_new_thread(close_idle_files, ())
+
     t = ThreadedServer(UserService, port=int(PORT[0]), protocol_config=config, listener_timeout=1)
     t.start()
 
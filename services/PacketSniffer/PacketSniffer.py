@@ -1,6 +1,6 @@
 #!/usr/bin/env python
 
-# version: 3.001
+# version: 3.002
 #
 # -*- coding: utf-8 -*-
 #
@@ -32,9 +32,11 @@ from rpyc import Service as rpycService
 from rpyc import connect as rpycConnect
 from rpyc.utils.helpers import BgServingThread as rpycBgServingThread
 from uuid import uuid4
-from time import sleep
+from time import sleep, time
 from copy import deepcopy
-from thread import allocate_lock
+from json import dumps
+from Queue import Queue, Empty, Full
+from thread import allocate_lock, start_new_thread
 from scapy.all import Automaton, ATMT, TCP, bind_layers, Packet, NoPayload, Raw
 
 #from PacketSnifferClasses import OpenFlow, CentralEngineObject
@@ -46,6 +48,15 @@ from struct import unpack, pack
 from array import array
 
 
+# packets waiting to be sent to the central engines; when the queue is full,
+# the new packets are dropped and counted
+PUSH_QUEUE_SIZE = 20000
+# a frame has at most this many packets ..
+PUSH_FRAME_SIZE = 500
+# .. and waits at most this many seconds for more packets
+PUSH_FRAME_TIME = 0.25
+
+
 
 
 def all_interfaces():
@@ -117,6 +128,12 @@ class Sniffer(Automaton):
 		self.reinitRetries = 0
 		self.reinitMaxRetries = 4
 
+		# packets are sent in frames, by another thread
+		if not hasattr(self, 'pushQueue'):
+			self.pushQueue = Queue(maxsize=PUSH_QUEUE_SIZE)
+			self.pushDropped = 0
+			start_new_thread(self.push_packets, ())
+
 		#
 		PacketSnifferService.sniffer = self
 
@@ -237,6 +254,54 @@ class Sniffer(Automaton):
 
 		return True
 
+	def push_packets(self):
+		""" send the queued packets to all central engines, in frames """
+
+		sniffer = {
+			'ip': self.userip,
+			'hostname': self.userhost,
+			'username': self.username,
+		}
+
+		while True:
+			packets = []
+			try:
+				packets.append(self.pushQueue.get(timeout=1.0))
+			except Empty:
+				continue
+
+			# fill the frame, until it's full or it's time to send
+			deadline = time() + PUSH_FRAME_TIME
+			while len(packets) < PUSH_FRAME_SIZE:
+				wait = deadline - time()
+				if wait <= 0:
+					break
+				try:
+					packets.append(self.pushQueue.get(timeout=wait))
+				except Empty:
+					break
+
+			# the frame is a string and the arguments a tuple, so they are
+			# sent by value, in one call
+			frame = dumps({
+				'sniffer': sniffer,
+				'dropped': self.pushDropped,
+				'packets': [(head, b2a_base64(source)) for head, source in packets],
+			})
+			args = (('command', 'pushpkts'), ('data', frame))
+
+			with PacketSnifferService.connectionsLock:
+				roots = [c['root'] for c in PacketSnifferService.connections.values() if c]
+
+			for root in roots:
+				try:
+					response = root.run_plugin('PacketSnifferPlugin', args)
+					if (not isinstance(response, dict) or not response.has_key('status') or
+						not response['status']['success']):
+						print('PT debug: Push packets error: {}'.format(response))
+				except Exception as e:
+					print('PT debug: Push packets error: {}'.format(e))
+
 	def packet_head_parse(self, packet):
 		"""  """
 
@@ -315,30 +380,14 @@ class Sniffer(Automaton):
 	def RECEIVING(self, packet):
 		"""  """
 
-		data = {
-			'sniffer': {
-				'ip': self.userip,
-				'hostname': self.userhost,
-				'username': self.username,
-			},
-			'packet_head': self.packet_head_parse(packet),
-			'packet_source': str(packet),
-		}
-		data['packet_head'].update([('id', str(uuid4())), ])
-
-		with PacketSnifferService.connectionsLock:
-			for conn in PacketSnifferService.connections:
-				if PacketSnifferService.connections[conn]:
-					try:
-						response = PacketSnifferService.connections[conn]['root'].run_plugin('PacketSnifferPlugin',
-																		{'command': 'pushpkt',
-																			'data': data})
-						if (not isinstance(response, dict) or not response.has_key('status') or
-							not response['status']['success']):
-							print('PT debug: Push packet error: {}'.format(response))
-					except Exception as e:
-						print('PT debug: Push packet error: {}'.format(e))
-						#pass
+		packetHead = self.packet_head_parse(packet)
+		packetHead.update([('id', str(uuid4())), ])
+
+		# never wait for the central engines here
+		try:
+			self.pushQueue.put_nowait((packetHead, str(packet)))
+		except Full:
+			self.pushDropped += 1
 
 		raise self.WAITING()
 
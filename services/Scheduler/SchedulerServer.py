@@ -1,7 +1,7 @@
 
 # File: SchedulerServer.py ; This file is part of Twister.
 
-# version: 3.002
+# version: 3.003
 
 # Copyright (C) 2012-2014 , Luxoft
 
@@ -31,10 +31,11 @@ socket.setdefaulttimeout(3)
 import xmlrpclib
 import logging
 import json
+import heapq
 
 import time
 import calendar
-from datetime import datetime
+from datetime import datetime, timedelta
 from ConfigParser import SafeConfigParser
 
 import cherrypy
@@ -56,11 +57,123 @@ def userHome(user):
     return subprocess.check_output('echo ~' + user, shell=True).strip()
 
 
+def _parse_cron(expr):
+    '''
+    Parse a cron expression: minute, hour, day of month, month, day of week.
+    Returns a tuple with the sorted values of each field, or None.
+    '''
+    limits = ((0, 59), (0, 23), (1, 31), (1, 12), (0, 7))
+    fields = expr.split()
+    if len(fields) != 5:
+        return None
+
+    result = []
+    for field, (low, high) in zip(fields, limits):
+        values = set()
+        for part in field.split(','):
+            step = 1
+            if '/' in part:
+                part, step = part.split('/', 1)
+                step = int(step)
+            if part == '*':
+                start, end = low, high
+            elif '-' in part:
+                start, end = [int(v) for v in part.split('-', 1)]
+            else:
+                start = int(part)
+                end = high if step > 1 else start
+            if start < low or end > high or start > end or step < 1:
+                return None
+            values.update(range(start, end + 1, step))
+        result.append(tuple(sorted(values)))
+
+    # Sunday is 0, or 7
+    if 7 in result[4]:
+        result[4] = tuple(sorted(set(result[4]) - set([7]) | set([0])))
+    # If both days are restricted, any of them matches
+    result.append(fields[2] == '*')
+    result.append(fields[4] == '*')
+    return tuple(result)
+
+
+def _next_cron(cron, after):
+    '''
+    Returns the first time matching a parsed cron expression, after the `after` timestamp.
+    '''
+    minutes, hours, mdays, months, wdays, any_mday, any_wday = cron
+    start = datetime.fromtimestamp(int(after)).replace(second=0, microsecond=0) + timedelta(minutes=1)
+    day = start.replace(hour=0, minute=0)
+
+    # Enough days to find the 29th of February
+    for _ in range(366 * 8):
+        if day.month in months:
+            mday_ok = day.day in mdays
+            wday_ok = (day.weekday() + 1) % 7 in wdays
+            if any_mday and any_wday:
+                day_ok = True
+            elif any_mday:
+                day_ok = wday_ok
+            elif any_wday:
+                day_ok = mday_ok
+            else:
+                day_ok = mday_ok or wday_ok
+            if day_ok:
+                for hour in hours:
+                    for minute in minutes:
+                        fire = day.replace(hour=hour, minute=minute)
+                        if fire >= start:
+                            return time.mktime(fire.timetuple())
+        day += timedelta(days=1)
+
+    return None
+
+
+def _next_fire(date_time, after):
+    '''
+    Returns the next activation of a task, as a timestamp bigger than `after`,
+    or None if the task will never run again.
+    '''
+    dt, proj_type = _fix_date(date_time)
+    if not dt:
+        return None
+
+    if proj_type == 'cron':
+        return _next_cron(dt, after)
+
+    if proj_type == 'one-time':
+        fire = time.mktime(dt)
+        return fire if fire > after else None
+
+    fire = datetime.fromtimestamp(int(after)).replace(hour=dt.tm_hour,
+        minute=dt.tm_min, second=dt.tm_sec, microsecond=0)
+    if proj_type == 'weekly':
+        fire += timedelta(days=(dt.tm_wday - fire.weekday()) % 7)
+        step = timedelta(days=7)
+    else:
+        step = timedelta(days=1)
+
+    while time.mktime(fire.timetuple()) <= after:
+        fire += step
+    return time.mktime(fire.timetuple())
+
+
 def _fix_date(date_time):
     '''
     Receives a date string and returns a Date-Time object and the type of task.
+    A cron expression with 5 fields returns the parsed fields and the type `cron`.
     '''
 
+    # If DT is a cron expression
+    if len(date_time.split()) == 5:
+        try:
+            cron = _parse_cron(date_time)
+        except ValueError:
+            cron = None
+        if not cron:
+            log.error('Invalid Cron format: `{0}` !'.format(date_time))
+            return False, ''
+        return cron, 'cron'
+
     # If DT has both date and time, or a weekday and time
     if ' ' in date_time:
         part1 = date_time.split()[0]
@@ -111,6 +224,8 @@ class SchedulerServer(_cptools.XMLRPCController):
         log.debug('Initializing Server on http://{sched_ip}:{sched_port}/ ...'.format(**__config__))
         self.acc_lock = thread.allocate_lock() # Task change lock
         self.tasks = {}
+        self.version = 0 # Changed every time the tasks change
+        self.wake = threading.Event() # Wakes up the tasks thread
         self._load(v=True)
 
 #
@@ -126,8 +241,12 @@ class SchedulerServer(_cptools.XMLRPCController):
 
         try:
             f = open(path, 'r')
-            self.tasks = json.load(f)
+            tasks = json.load(f)
             f.close() ; del f
+            if tasks != self.tasks:
+                self.tasks = tasks
+                self.version += 1
+                self.wake.set()
             if v:
                 log.debug('Tasks loaded successfully.')
         except:
@@ -148,6 +267,9 @@ class SchedulerServer(_cptools.XMLRPCController):
         json.dump(self.tasks, f, indent=4)
         f.close() ; del f
 
+        self.version += 1
+        self.wake.set()
+
 #
 
     @cherrypy.expose
@@ -347,6 +469,8 @@ class SchedulerServer(_cptools.XMLRPCController):
         if proj_dt:
            task_fixed['date-time'] = proj_dt
            task_fixed['proj-type'] = proj_type
+           # The new date-time doesn't catch up with the old activations
+           task_fixed['last-fire'] = time.time()
 
         if proj_force:
             if proj_force != self.tasks[key]['force']:
@@ -408,24 +532,36 @@ class SchedulerServer(_cptools.XMLRPCController):
 class threadCheckTasks(threading.Thread):
     '''
     Threaded class for checking tasks.
+    The next activation of every task is kept in a priority queue;
+    the thread sleeps until the first activation, or until the tasks change.
     '''
     def __init__(self):
 
         global __config__
         self.errMsg = True
-        self.conns = {}
+        self.conns = {} # Central Engine connection and the last check, for each user
+        self.user_locks = {} # One task at a time, for each user
+        self.catch_up = __config__.get('catch_up', 'once')
+        try:
+            self.catch_up_window = float(__config__.get('catch_up_window', 300))
+        except ValueError:
+            self.catch_up_window = 300.0
         threading.Thread.__init__(self)
 
 
     def getConnection(self, user):
         '''
         Shortcut function to get or reuse a Central Engine connection.
+        The connection is checked only if it was not used in the last minute.
         '''
-        proxy = self.conns.get(user)
+        proxy, checked = self.conns.get(user, (None, 0))
         # Try to reuse the old connection
         if isinstance(proxy, xmlrpclib.ServerProxy):
+            if time.time() - checked < 60.0:
+                return proxy
             try:
                 proxy.echo('ping')
+                self.conns[user] = (proxy, time.time())
                 return proxy
             except:
                 log.debug('Disconnected from the Central Engine. Will reconnect...')
@@ -448,90 +584,139 @@ class threadCheckTasks(threading.Thread):
                 self.errMsg = False
             proxy = None
 
-        self.conns[user] = proxy
+        self.conns[user] = (proxy, time.time())
         return proxy
 
 
-    def run(self):
+    def _queue(self):
         '''
-        Chech time to see if CE must be started.
-        If force, if CE is running, start it again with the new config.
-        Else, don't start CE.
-        If time limit, the status of CE must be recorded;
-        if CE is stopped, the time limit check must be aborted,
-        because it means the job is no longer running !
+        Build the priority queue with the next activation of all tasks.
+        The tasks that ran before, continue from the last activation.
         '''
+        queue = []
+        now = time.time()
+        with root.acc_lock:
+            tasks = dict((k, dict(v)) for k, v in root.tasks.iteritems())
 
-        time.sleep(0.1)
-        global root, programExit
-
-        while not programExit:
-
-            Tasks = root.List()
-
-            # Date time into standard format
-            date_time = time.strptime(time.strftime('%Y-%m-%d %H:%M:%S'), '%Y-%m-%d %H:%M:%S')
-            pure_time = time.strptime(time.strftime('%H:%M:%S'), '%H:%M:%S')
-            week_time = time.strptime(time.strftime('%a %H:%M:%S'), '%a %H:%M:%S')
-
-            # Cycle all known tasks
-            for glob_task in Tasks:
-
-                task_id = glob_task.get('key')
-                if not task_id:
-                    log.error('Badly formed task! No key detected! Debug data: `{0}`.'.format(glob_task))
-                    continue
-
-                task = dict(root.tasks[task_id]) # Make a copy
+        for task_id, task in tasks.iteritems():
+            if not task.get('user') or not task.get('date-time'):
+                log.error('Fatal error in task `{0}`! No user, or no date-time defined!'.format(task_id))
+                continue
+            fire = _next_fire(task['date-time'], task.get('last-fire') or now)
+            if fire:
+                queue.append((fire, task_id))
 
-                user       = task.get('user')
-                proj_file  = str(task.get('project-file'))
-                proj_dt    = task.get('date-time')
-                proj_force = str(task.get('force'))
-                time_limit = task.get('time-limit')
+        heapq.heapify(queue)
+        return queue
 
-                if not user:
-                    log.error('Fatal error in task `{0}`! No user defined!'.format(task_id))
-                    continue
 
-                proxy = self.getConnection(user)
-                # No connection for this user
-                if not isinstance(proxy, xmlrpclib.ServerProxy):
-                    time.sleep(2)
-                    continue
+    def _fire(self, task_id, task):
+        '''
+        Start the Central Engine for 1 task.
+        If force, if CE is running, start it again with the new config.
+        Else, don't start CE.
+        '''
+        user = task['user']
+        proj_file = str(task.get('project-file'))
+        proj_force = str(task.get('force'))
 
-                proj_dt, proj_type = _fix_date(proj_dt)
-                if not proj_dt: continue
-                task.update({'proj-type': proj_type})
+        with self.user_locks.setdefault(user, thread.allocate_lock()):
 
-                # If task is 1 time and the time is not right, continue
-                if proj_type == 'one-time' and proj_dt != date_time:
-                    continue
-                # If the task is daily and the time is not right, continue
-                elif proj_type == 'daily' and proj_dt != pure_time:
-                    continue
-                # If the task is weekly and time is not right, continue
-                elif proj_type == 'weekly' and proj_dt != week_time:
-                    continue
+            proxy = self.getConnection(user)
+            # No connection for this user
+            if not isinstance(proxy, xmlrpclib.ServerProxy):
+                log.error('Cannot run task `{0}`, the Central Engine is down!'.format(task_id))
+                return
 
-                log.debug('Starting {proj-type} task for user {user} :: File `{project-file}`, '
-                      'activation date `{date-time}`, force `{force}`, time limit `{time-limit}`...'.format(**task))
+            log.debug('Starting {proj-type} task for user {user} :: File `{project-file}`, '
+                  'activation date `{date-time}`, force `{force}`, time limit `{time-limit}`...'.format(**task))
 
+            try:
                 # If Force is disabled and Central Engine is already running, break
-                if proj_force != '0' and proxy.get_user_variable(user, 'status') == 'running':
+                if proj_force == '0' and proxy.get_user_variable(user, 'status') == 'running':
                     log.debug('Central Engine is already running! The task will not force!')
-                    continue
+                    return
                 else:
                     # Kill all processes for this user
-                    proxy.set_exec_status_all(user, 0, 'Force stop from Scheduler!'.format(proj_file))
+                    proxy.set_exec_status_all(user, 0, 'Force stop from Scheduler!')
 
                 time.sleep(1)
 
                 # Start Central Engine !
                 proxy.set_exec_status_all(user, 2, '{}/twister/config/fwmconfig.xml,{}'.format(userHome(user), proj_file))
+            except Exception as e:
+                log.error('Cannot run task `{0}`: `{1}`!'.format(task_id, e))
+                # The connection will be checked on the next task
+                self.conns.pop(user, None)
+
+
+    def run(self):
+        '''
+        Wait for the first task in the queue and start it.
+        The activations missed by a slow cycle, or while the Scheduler was down,
+        are handled by the `catch_up` policy:
+        `all` runs all of them, `once` runs only the last one, `none` skips them;
+        the activations older than `catch_up_window` seconds are always skipped.
+        '''
+
+        time.sleep(0.1)
+        global root, programExit
+
+        queue = []
+        version = None
+
+        while not programExit:
+
+            # The tasks were changed, or added
+            if version != root.version:
+                version = root.version
+                queue = self._queue()
+
+            now = time.time()
+
+            # Sleep until the first activation, or until the tasks change
+            if not queue or queue[0][0] > now:
+                wait = min(queue[0][0] - now, 30.0) if queue else 30.0
+                root.wake.wait(wait)
+                root.wake.clear()
+                # Check the tasks file, for the changes made by hand
+                root.List()
+                continue
+
+            fire, task_id = heapq.heappop(queue)
+            with root.acc_lock:
+                task = dict(root.tasks.get(task_id, {}))
+            if not task:
+                continue
+
+            late = now - fire
+
+            # Only the last missed activation counts, for policies `once` and `none`
+            if late > 1.0 and self.catch_up != 'all':
+                next_fire = _next_fire(task['date-time'], max(fire, now - self.catch_up_window - 1.0))
+                while next_fire and next_fire <= now:
+                    fire, next_fire = next_fire, _next_fire(task['date-time'], next_fire)
+                late = now - fire
+
+            if late > 1.0 and (self.catch_up == 'none' or late > self.catch_up_window):
+                log.debug('Skipping task `{0}`, activation missed by {1:.0f}s.'.format(task_id, late))
+                # Policy `all` continues with the activations inside the window
+                if self.catch_up == 'all':
+                    last_fire = max(fire, now - self.catch_up_window)
+                else:
+                    last_fire = now
+            else:
+                thread.start_new_thread(self._fire, (task_id, task))
+                # Policy `all` continues from this activation, the others from now
+                last_fire = fire if self.catch_up == 'all' else now
+
+            with root.acc_lock:
+                if task_id in root.tasks:
+                    root.tasks[task_id]['last-fire'] = last_fire
+                    root._save()
 
-            # Wait before next cycle
-            time.sleep(1)
+            # The queue is built again, with the next activation of this task
+            version = None
 
         log.debug('Closing Tasks thread...')
 
@@ -542,7 +727,8 @@ def load_config():
     global __dir__
     cfg_folder = __dir__ + '/config.ini'
     cfg_dict   =  {'ce_ip': '127.0.0.1', 'ce_port': '8000',
-                   'sched_ip': '0.0.0.0', 'sched_port': '88'}
+                   'sched_ip': '0.0.0.0', 'sched_port': '88',
+                   'catch_up': 'once', 'catch_up_window': '300'}
     cfg = SafeConfigParser({'ALL': '0.0.0.0'})
     cfg.read(cfg_folder)
 